@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from bot.api.views import MessageView, reply_messages, reply_payload
+from bot.services.feedback_pipeline import submit_feedback, submit_feedback_async
+from bot.services.outbound_queue import enqueue_whatsapp_message
+from bot.utils.metrics import get_metrics
+from bot.utils.phone import normalize_whatsapp_number
+from bot.utils.twilio import build_twiml_reply, send_whatsapp_message_async
+
+# The ORM is synchronous, so the bot logic runs in this bounded pool; the
+# event loop itself only waits on sockets and can keep thousands of
+# conversations in flight.
+_db_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_WORKERS, thread_name_prefix="async-db")
+
+
+def _run_db(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run blocking ORM code in the bounded database pool and await the result.
+    """
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context, so the queries are counted
+    # towards the request (see bot.utils.metrics.time_queries)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _db_executor, functools.partial(context.run, _run_db, func, *args, **kwargs)
+    )
+
+
+class AsyncMessageView(View):
+    """
+    Async counterpart of MessageView for the ASGI app: same commands and
+    replies, but Twilio and OpenAI are awaited with async clients and
+    database work is handed to a bounded thread pool.
+    """
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        # Twilio can't send a CSRF token
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def reply(self, sender_number, whatsapp_number, message_sid, body, message, data=None):
+        # Same reply modes as MessageView.reply
+        if settings.TWILIO_REPLY_MODE == "twiml":
+            return HttpResponse(build_twiml_reply(body), content_type="application/xml")
+
+        for chunk, idempotency_key in reply_messages(body, message_sid):
+            if settings.TWILIO_REPLY_MODE == "queue":
+                await run_db(enqueue_whatsapp_message, sender_number, whatsapp_number, chunk, idempotency_key)
+            else:
+                await send_whatsapp_message_async(sender_number, whatsapp_number, chunk)
+        return JsonResponse(reply_payload(message, data))
+
+    async def post(self, request):
+        whatsapp_number = request.POST.get('From')
+        user_message = request.POST.get('Body')
+        message_sid = request.POST.get('MessageSid')
+        sender_number = settings.TWILIO_NUMBER
+
+        if not whatsapp_number:
+            return JsonResponse({"message": "No sender information found."}, status=400)
+        try:
+            number = normalize_whatsapp_number(whatsapp_number)
+        except ValueError:
+            return JsonResponse({"message": "Invalid sender number."}, status=400)
+
+        # Feedback is collected in the worker thread and scheduled on the
+        # event loop once the database work is done
+        feedback = []
+        body, message, data = await run_db(
+            MessageView().handle_once,
+            message_sid,
+            number,
+            user_message,
+            on_feedback=lambda *args: feedback.append(args),
+        )
+        for args in feedback:
+            if isinstance(request, ASGIRequest):
+                submit_feedback_async(*args)
+            else:
+                # Under WSGI this coroutine runs in an event loop that is
+                # closed once the response is sent, taking any task
+                # scheduled on it along; use the thread pipeline instead
+                await run_db(submit_feedback, *args)
+        with get_metrics().span("reply"):
+            return await self.reply(sender_number, whatsapp_number, message_sid, body, message, data)
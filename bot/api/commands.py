@@ -0,0 +1,217 @@
+from bot.models import OrderDishes
+from bot.services import conversation_state
+from bot.services.dish_catalog import get_dish_catalog
+from bot.services.dish_index import search_dishes, similar_dishes
+from bot.services.recommendations import recommend_dishes, split_dietaries
+from bot.utils.metrics import get_metrics
+from bot.utils.timing import LatencyTimer
+
+# What a handler may declare in `needs`:
+# - "latest_order": the user's latest order is loaded before the handler
+#   runs and passed as context.latest_order (None if there isn't one)
+# - "db_read" / "db_write": the handler queries or writes the OLTP database
+# - "index": the handler reads an in-memory index (no database round trip)
+KNOWN_NEEDS = frozenset({"latest_order", "db_read", "db_write", "index"})
+
+
+def normalize_token(token):
+    # "/NEW", " /new " and "/New" all dispatch to /new
+    return token.strip().casefold()
+
+
+class CommandContext:
+    # Everything a handler gets besides the view
+    __slots__ = ("user", "state", "args", "latest_order")
+
+    def __init__(self, user, state, args):
+        self.user = user
+        self.state = state
+        self.args = args
+        self.latest_order = None
+
+
+class Command:
+    def __init__(self, name, handler, aliases=(), help=None, needs=()):
+        unknown = set(needs) - KNOWN_NEEDS
+        if unknown:
+            raise ValueError(f"Unknown needs {sorted(unknown)} for command {name}")
+        self.name = name
+        self.handler = handler
+        self.aliases = tuple(aliases)
+        self.help = help
+        self.needs = frozenset(needs)
+        self.timer = LatencyTimer()
+
+
+class CommandRegistry:
+    """
+    Maps command tokens to handlers.
+
+    The first word of a message is normalized and looked up in a dict, so
+    dispatch costs the same however many commands and aliases exist. Each
+    command declares what it needs (see KNOWN_NEEDS) so the dispatcher can
+    load it up front, and keeps a latency timer of its own.
+
+    Handlers are called as handler(view, context) and return the same
+    (body, action description, data) tuple as MessageView.handle_message.
+    """
+
+    def __init__(self):
+        self._commands = []
+        self._tokens = {}
+
+    def register(self, name, *aliases, help=None, needs=()):
+        """
+        Decorator registering a handler under `name` and its `aliases`.
+        """
+        def decorator(handler):
+            command = Command(name, handler, aliases, help, needs)
+            for token in (name, *aliases):
+                token = normalize_token(token)
+                if token in self._tokens:
+                    raise ValueError(f"Command token {token!r} is already registered")
+                self._tokens[token] = command
+            self._commands.append(command)
+            return handler
+        return decorator
+
+    def resolve(self, user_message):
+        """
+        Find the command a message invokes.
+
+        Returns:
+        - Tuple of (Command or None, the rest of the message).
+        """
+        parts = (user_message or "").split(maxsplit=1)
+        if not parts:
+            return None, ""
+        command = self._tokens.get(normalize_token(parts[0]))
+        if command is None:
+            return None, ""
+        return command, parts[1] if len(parts) > 1 else ""
+
+    def dispatch(self, command, view, user, state, args=""):
+        context = CommandContext(user, state, args)
+        with command.timer.time():
+            if "latest_order" in command.needs:
+                context.latest_order = view.get_latest_order(user, state)
+            return command.handler(view, context)
+
+    def __iter__(self):
+        return iter(self._commands)
+
+    def help_text(self):
+        lines = [f'REPLY "{command.name}" {command.help}' for command in self._commands if command.help]
+        return "(Mockup Commands): \n\n" + "\n".join(lines) + "\n"
+
+    def stats(self):
+        # Latency summary per command, see bot.utils.timing.LatencyTimer
+        return {command.name: command.timer.summary() for command in self._commands}
+
+
+commands = CommandRegistry()
+get_metrics().register_collector("command", commands.stats, label="command")
+
+
+@commands.register("/new", "/order", help="to place a new order.", needs={"db_write"})
+def new_order(view, context):
+    order = view.create_random_order(context.user)
+    formatted_order_message = view.format_order_message(view.gather_order_details(order))
+    return (
+        f"Order creation:\n {formatted_order_message}",
+        "Providoor bot: Create a random order",
+        formatted_order_message,
+    )
+
+
+@commands.register(
+    "/latest", "/status",
+    help="to check the latest order status.",
+    needs={"latest_order", "db_read"},
+)
+def latest_order(view, context):
+    if context.latest_order is None:
+        body = "No pending orders found."
+    else:
+        formatted_order_message = view.format_order_message(view.gather_order_details(context.latest_order))
+        body = f"Latest order: \n{formatted_order_message}"
+    return body, "Providoor bot: Returned the latest order", None
+
+
+@commands.register(
+    "/recommend", "/recommendations",
+    help='to get recommendations, e.g. "/recommend vegan".',
+    needs={"index"},
+)
+def recommend(view, context):
+    # Dietary tags may follow the command, e.g. "/recommend vegan gf"
+    dishes = recommend_dishes(context.user.id, k=3, dietaries=split_dietaries(context.args))
+    if not dishes:
+        body = "No recommendations found."
+    else:
+        body = view.format_recommendations_message(dishes)
+    return body, "Providoor bot: Provide recommendations", None
+
+
+def _dish_dicts(dish_ids):
+    # The dish dicts format_recommendations_message renders, in the given order
+    records = get_dish_catalog().get_many(dish_ids)
+    return [
+        {"name": record.name, "price": record.price, "course": record.course,
+         "dietaries": split_dietaries(record.dietaries)}
+        for record in (records.get(dish_id) for dish_id in dish_ids) if record is not None
+    ]
+
+
+@commands.register("/search", help='to find dishes, e.g. "/search spicy curry".', needs={"index"})
+def search(view, context):
+    if not context.args.strip():
+        return 'Tell me what you feel like, e.g. "/search spicy curry".', "Providoor bot: Search dishes", None
+    dishes = _dish_dicts(search_dishes(context.args, k=3))
+    body = view.format_recommendations_message(dishes) if dishes else "No dishes found."
+    return body, "Providoor bot: Search dishes", None
+
+
+@commands.register(
+    "/similar",
+    help="to find dishes like the ones in my latest order.",
+    needs={"latest_order", "db_read", "index"},
+)
+def similar(view, context):
+    if context.latest_order is None:
+        return 'No orders yet. Reply "/new" to place one.', "Providoor bot: Similar dishes", None
+    ordered = list(OrderDishes.objects.filter(order=context.latest_order).values_list("dish_id", flat=True))
+    dishes = _dish_dicts(similar_dishes(ordered, k=3))
+    body = view.format_recommendations_message(dishes) if dishes else "No similar dishes found."
+    return body, "Providoor bot: Similar dishes", None
+
+
+def _ratings_reply(view, context, cursor):
+    message, next_cursor = view.format_ratings_page(context.user, cursor)
+    # The cursor lives in the conversation state, so /more picks up there
+    conversation_state.update_state(context.user.whatsapp_number, ratings_cursor=next_cursor)
+    return message, next_cursor
+
+
+@commands.register(
+    "/ratings", "/myratings",
+    help='to see my ratings, newest first; reply "/more" for the next page.',
+    needs={"db_read"},
+)
+def ratings(view, context):
+    message, _ = _ratings_reply(view, context, None)
+    return f"Your Ratings \n{message}", "Providoor bot: User ratings", message
+
+
+@commands.register("/more", needs={"db_read"})
+def more_ratings(view, context):
+    cursor = (context.state or {}).get("ratings_cursor")
+    if cursor is None:
+        return 'No more ratings. Reply "/ratings" to see your latest ones.', "Providoor bot: More ratings", None
+    message, _ = _ratings_reply(view, context, cursor)
+    return message, "Providoor bot: More ratings", message
+
+
+@commands.register("/help", "/start", "/menu", help="to check this message again.")
+def show_help(view, context):
+    return commands.help_text(), "Providoor bot: Help message", None
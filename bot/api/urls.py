@@ -1,9 +1,13 @@
 from django.urls import path
-from .views import MessageView, PingView,WhatsAppMessageView
+from .views import MessageView, MetricsView, PingView,WhatsAppMessageView
+from .async_views import AsyncMessageView
 
 urlpatterns = [
     path('ping', PingView.as_view(), name='ping'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('whatsapp/message', MessageView.as_view(), name='whatsapp message'),
+    # Async pipeline, for deployments running the ASGI app
+    path('whatsapp/message/async', AsyncMessageView.as_view(), name='whatsapp message async'),
     path('whatsapp/test', WhatsAppMessageView.as_view(), name='whatsapp test'),
     # path('get_recommendations/', GetRecommendationsView.as_view(), name='get_recommendations'),
 ]
\ No newline at end of file
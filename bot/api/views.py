@@ -1,57 +1,93 @@
+import hmac
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from twilio.twiml.messaging_response import MessagingResponse
-from twilio.request_validator import RequestValidator
 from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils import timezone
 from django.shortcuts import get_object_or_404
-from bot.models import Users, Orders, Dishes, OrderDishes, Ratings
-import random
-import datetime
-from bot.utils.twilio import send_whatsapp_message
-from bot.utils.gpt4 import intention_classification
+from bot.models import Users, Orders, OrderDishes
+from bot.api.commands import commands
+from bot.utils.messages import MessageBuilder, split_message
+from bot.utils.metrics import get_metrics
+from bot.utils.phone import normalize_whatsapp_number
+from bot.utils.twilio import send_whatsapp_message, build_twiml_reply
+from bot.services import ratings as rating_service
+from bot.services import conversation_state, idempotency, snowflake_service
+from bot.services.users import upsert_user
+from bot.services.dish_catalog import get_dish_catalog
+from bot.services.dish_sampler import get_dish_sampler
+from bot.services.feedback_pipeline import submit_feedback
+from bot.services.outbound_queue import enqueue_whatsapp_message
+
+# Longer feedback is cut short in the /ratings listing
+RATING_FEEDBACK_PREVIEW = 200
+
+
+def reply_messages(body, message_sid):
+    """
+    Split a reply into the messages sent in "rest" and "queue" mode.
+
+    Long replies go out as several messages; the queue's workers send
+    concurrently, so only "rest" mode guarantees their order.
+
+    Returns:
+    - List of (message body, outbound queue idempotency key) tuples; the
+      key is None when the inbound message had no MessageSid.
+    """
+    return [
+        (chunk, f"reply:{message_sid}:{index}" if message_sid else None)
+        for index, chunk in enumerate(split_message(body))
+    ]
+
+
+def reply_payload(message, data=None):
+    # JSON answer to the webhook in "rest" and "queue" mode
+    payload = {"message": message}
+    if data is not None:
+        payload["data"] = data
+    return payload
 
 class MessageView(APIView):
     """
     View to receive message from Twilio sources, process it
     """
     def gather_order_details(self, order):
-        # Get the dishes for this order
-        order_dishes = OrderDishes.objects.filter(order=order)
-        
+        # Only the order lines are queried; the dishes come from the
+        # in-memory catalog
+        lines = list(OrderDishes.objects.filter(order=order).order_by("id").values_list("quantity", "dish_id"))
+        dishes = get_dish_catalog().get_many([dish_id for _, dish_id in lines])
+
         # Extracting dish details for the message
         details = []
-        for od in order_dishes:
-            dish = od.dish
-            dish_details = {
-                "name": dish.dish_name,
-                "description": dish.dish_description,
-                "price": dish.price,
-                "course": dish.course,
-                "chef": dish.chef_name,
-                "dietaries": dish.dietaries
-            }
-            details.append(dish_details)
+        for quantity, dish_id in lines:
+            dish = dishes.get(dish_id)
+            if dish is not None:
+                details.append(dish.details(quantity))
         return details
 
-    def get_latest_order(self, user):
+    def get_latest_order(self, user, state=None):
         """
         Returns the latest order placed by the user.
 
         Args:
         - user (Users model instance): The user for whom to fetch the latest order.
+        - state (dict): Optional cached conversation state of the user; when
+          given the order is built from it without a query.
 
         Returns:
         - Orders model instance: The latest order placed by the user or None if no order found.
         """
-        
-        try:
-            # Retrieve the latest order for the user based on the order_time
-            latest_order = Orders.objects.filter(user=user).latest('order_time')
-            return latest_order
-        except Orders.DoesNotExist:
-            # If no order is found for the user
+        if state is not None:
+            return conversation_state.cached_latest_order(state)
+
+        # users.latest_order is kept up to date by create_random_order, so
+        # this is a primary key lookup however many orders the user has
+        if user.latest_order_id is None:
             return None
+        return Orders.objects.get(pk=user.latest_order_id)
 
     def add_rating(self, user, order, rating_value, feedback):
         """
@@ -66,53 +102,62 @@ class MessageView(APIView):
         Returns:
         - The created Ratings object.
         """
-        rating = Ratings(user=user, order=order, rating=rating_value, original_feedback=feedback)
-        rating.save()
-        return rating
+        return rating_service.add_rating(user.id, order.id, rating_value, feedback)
 
-    def format_ratings_message(self, user):
+    def format_ratings_page(self, user, cursor=None):
         """
-        Format the rating data for a given user into a readable message.
+        Format one page of a user's ratings into a readable message.
 
         Parameters:
         - user: The user object.
+        - cursor: Where the previous page ended, or None for the first page.
 
         Returns:
-        - A string containing the formatted ratings data.
+        - Tuple of (message, cursor of the next page or None).
         """
-        ratings = Ratings.objects.filter(user=user)
-        
-        if not ratings.exists():
-            return f"No ratings found for user with WhatsApp number {user.whatsapp_number}."
-        
-        formatted_message = f"Ratings for user with WhatsApp number {user.whatsapp_number}:\n\n"
-        
-        for rating in ratings:
-            order_time = rating.order.order_time
-            order_status = rating.order.order_status
-            rating_value = rating.rating
-            feedback = rating.original_feedback
-            
-            formatted_message += f"Order Time: {order_time}\n"
-            formatted_message += f"Order Status: {order_status}\n"
-            formatted_message += f"Rating: {rating_value}\n"
-            formatted_message += f"Feedback: {feedback}\n"
-            formatted_message += "-"*30 + "\n"  # Separator for readability
-        
-        return formatted_message
+        ratings, next_cursor = rating_service.ratings_page(user.id, cursor, settings.RATINGS_PAGE_SIZE)
 
+        if not ratings:
+            if cursor is None:
+                return f"No ratings found for user with WhatsApp number {user.whatsapp_number}.", None
+            return "No more ratings.", None
 
+        builder = MessageBuilder()
+        if cursor is None:
+            builder.add(f"Ratings for user with WhatsApp number {user.whatsapp_number}:\n\n")
+        for order_time, order_status, rating_value, feedback in ratings:
+            if feedback and len(feedback) > RATING_FEEDBACK_PREVIEW:
+                feedback = feedback[:RATING_FEEDBACK_PREVIEW] + "..."
+            builder.add(
+                f"Order Time: {order_time}\n"
+                f"Order Status: {order_status}\n"
+                f"Rating: {rating_value}\n"
+                f"Feedback: {feedback}\n"
+                + "-"*30 + "\n"  # Separator for readability
+            )
+        if next_cursor is not None:
+            builder.add('Reply "/more" to see older ratings.\n')
+        return builder.build(), next_cursor
 
     def create_random_order(self, user):
         # Create an order for the user
-        right_now = datetime.datetime.now()
-        order = Orders.objects.create(user=user, order_time=right_now, order_status="delivered")
-
-        # Pick two random dishes for mocking and create order_dishes records
-        dishes = list(Dishes.objects.all())
-        selected_dishes = random.sample(dishes, 2)
-        for dish in selected_dishes:
-            OrderDishes.objects.create(order=order, dish=dish) 
+        right_now = timezone.now()
+        # Pick two random dishes for mocking from the cached dish ids
+        dish_ids = get_dish_sampler().sample(2)
+        with transaction.atomic():
+            order = Orders.objects.create(user=user, order_time=right_now, order_status="delivered")
+            # Create the order_dishes records in a single INSERT
+            order_dishes = OrderDishes.objects.bulk_create(
+                [OrderDishes(order=order, dish_id=dish_id, quantity=1) for dish_id in dish_ids]
+            )
+            # Move the user's latest order pointer
+            Users.objects.filter(pk=user.pk).update(latest_order=order, updated_at=right_now)
+            user.latest_order = order
+            user.updated_at = right_now
+        conversation_state.record_order(user, order)
+        snowflake_service.record(order)
+        for order_dish in order_dishes:
+            snowflake_service.record(order_dish)
         return order
     
     def format_order_message(self, order_details):
@@ -122,135 +167,169 @@ class MessageView(APIView):
             message += "\n===\n"
             message += (
                 f"Dish: {detail['name']}\n"
+                f"Quantity: {detail['quantity']}\n"
                 f"Price: {detail['price']}\n"
                 f"Course: {detail['course']}\n"
             )
             
         return message
+
+    def format_recommendations_message(self, dishes):
+        # Format recommended dishes for the message
+        message = "You might like:\n"
+        for dish in dishes:
+            message += "\n===\n"
+            message += (
+                f"Dish: {dish['name']}\n"
+                f"Price: {dish['price']}\n"
+                f"Course: {dish['course']}\n"
+            )
+            if dish["dietaries"]:
+                message += f"Dietaries: {', '.join(sorted(dish['dietaries']))}\n"
+
+        return message
     
-    def post(self, request):
-        # Ensure request is from Twilio
-        # ... your Twilio validation code here ...
+    def reply(self, sender_number, whatsapp_number, body, message, data=None):
+        """
+        Reply to the inbound message according to settings.TWILIO_REPLY_MODE.
 
-        # Extract incoming WhatsApp number
-        whatsapp_number = request.data.get('From')  # assuming 'From' contains the number
-        user_message = request.data.get('Body')
-        sender_number = settings.TWILIO_NUMBER # Reply using this Twilio WhatsApp number
+        In "twiml" mode the reply is returned as the TwiML body of the webhook
+        response, so Twilio delivers it without a second API round trip. In
+        "rest" mode it is sent through the Twilio REST API, and in "queue" mode
+        it is handed to the outbound queue (keyed on the inbound MessageSid)
+        for the sender worker; both answer the webhook with a JSON summary.
 
-        if not whatsapp_number:
-            return Response({"message": "No sender information found."}, status=status.HTTP_400_BAD_REQUEST)
+        Parameters:
+        - sender_number: The Twilio WhatsApp number replying.
+        - whatsapp_number: The user's WhatsApp number.
+        - body: The reply text, or None to acknowledge without replying.
+        - message: Short description of the handled action (REST mode only).
+        - data: Optional payload included in the JSON response (REST mode only).
+
+        Returns:
+        - The webhook response.
+        """
+        if settings.TWILIO_REPLY_MODE == "twiml":
+            return HttpResponse(build_twiml_reply(body), content_type="application/xml")
+
+        for chunk, idempotency_key in reply_messages(body, self.message_sid):
+            if settings.TWILIO_REPLY_MODE == "queue":
+                enqueue_whatsapp_message(sender_number, whatsapp_number, chunk, idempotency_key)
+            else:
+                send_whatsapp_message(sender_number, whatsapp_number, chunk)
+        return Response(reply_payload(message, data), status=status.HTTP_200_OK)
+
+    def handle_message(self, whatsapp_number, user_message, on_feedback=submit_feedback):
+        """
+        Run the bot logic for one inbound message.
 
-        # Check if the user exists or create a new one
-        user, created = Users.objects.get_or_create(whatsapp_number=whatsapp_number)
+        Shared by the WSGI view and the async ASGI view, which only differ
+        in how they reply and how feedback classification is scheduled.
+
+        Parameters:
+        - whatsapp_number: The sender's number, normalized to E.164.
+        - user_message: The message text.
+        - on_feedback: Called as on_feedback(user_id, order_id, user_message)
+          for free-text feedback that needs classifying.
+
+        Returns:
+        - Tuple of (reply body or None, action description, optional data).
+        """
+        metrics = get_metrics()
+        # Active numbers are served from the conversation state cache without
+        # a query; otherwise check if the user exists or create a new one
+        with metrics.span("load_user"):
+            state = conversation_state.get_state(whatsapp_number)
+            if state is not None:
+                user, created = conversation_state.cached_user(whatsapp_number, state), False
+            else:
+                user, created = upsert_user(whatsapp_number)
+                if not created:
+                    state = conversation_state.remember_user(user)
 
         # If it's a new user, create a random order and send a welcome message
         if created:
-            # Create an order for the user
-            order = self.create_random_order(user)
-            # Gather order details (assuming this is some function or method you'll create)
-            order_details = self.gather_order_details(order)  
+            with metrics.span("welcome_order"):
+                # Create an order for the user
+                order = self.create_random_order(user)
+                # Gather order details (assuming this is some function or method you'll create)
+                order_details = self.gather_order_details(order)  
 
             # Send welcome message with order details
-            
-            send_whatsapp_message(
-                sender_number,
-                whatsapp_number, 
-                f"""Hello from Providoor Bot! Your order {order_details} has been delivered.\n 
-                We would love to hear your feedback!\n
-                Describe your experience or simply give a rating from 1 to 10.\n\n
-                (Mockup Commands): \n\nREPLY "/new" to place a new order.\n
-                REPLY "/latest" to check the latest order status.\n
-                REPLY "/recommend" to get recommendations.\n
-                REPLY "/ratings" to get all my ratings.\n
-                REPLY "/help" to check this message again.\n
-                """
+            return (
+                f"Hello from Providoor Bot! Your order {order_details} has been delivered.\n"
+                "We would love to hear your feedback!\n"
+                "Describe your experience or simply give a rating from 1 to 10.\n\n"
+                f"{commands.help_text()}",
+                "Providoor bot: Welcome message",
+                None,
             )
+
+        command, args = commands.resolve(user_message)
+        if command is not None:
+            with metrics.span("command"):
+                return commands.dispatch(command, self, user, state, args)
+
+        # If it's an existing user, check if they have any pending orders
+        body = None
+        with metrics.span("get_latest_order"):
+            latest_order = self.get_latest_order(user, state)
+        if latest_order is None:
+            # TODO: No pending orders found, giving some recommendations
+            pass
+        elif not state["pending_feedback"]:
+            # Ratings are unique per order, so a second one would be rejected
+            body = "You have already rated your latest order. Reply \"/new\" to place a new order."
         else:
-            if user_message=="/new":
-                # Create an order for the user
-                random_order = self.create_random_order(user)
-                # Gather order details (assuming this is some function or method you'll create)
-                order_details = self.gather_order_details(random_order)  
-                formatted_order_message = self.format_order_message(order_details)
-                send_whatsapp_message(
-                    sender_number,
-                    whatsapp_number,  #whatsapp_number
-                    f"Order creation:\n {formatted_order_message}"
-                )
-                return Response({"message": "Providoor bot: Create a random order", "data": formatted_order_message}, status=status.HTTP_200_OK)
-            elif user_message=="/latest":
-                # Get the latest order for the user
-                latest_order = self.get_latest_order(user)
-                
-                if latest_order is None:
-                    send_whatsapp_message(
-                        sender_number,
-                        whatsapp_number,  #whatsapp_number
-                        "No pending orders found."
-                    )
-                else:
-                    # Gather order details (assuming this is some function or method you'll create)
-                    order_details = self.gather_order_details(latest_order)  
-                    formatted_order_message = self.format_order_message(order_details)
-                    send_whatsapp_message(
-                        sender_number,
-                        whatsapp_number,  #whatsapp_number
-                        f"Latest order: \n{formatted_order_message}"
-                    )
-                return Response({"message": "Providoor bot: Returned the latest order"}, status=status.HTTP_200_OK)
-            elif user_message=="/recommend":
-                send_whatsapp_message(
-                    sender_number,
-                    whatsapp_number, 
-                    "Recommendations coming soon!"
-                )
-                return Response({"message": "Providoor bot: Provide recommendations"}, status=status.HTTP_200_OK)
-            elif user_message=="/ratings":
-                all_user_ratings_message = self.format_ratings_message(user)
-                if all_user_ratings_message is None:
-                    send_whatsapp_message(
-                        sender_number,
-                        whatsapp_number, 
-                        "No ratings found."
-                    )
-                else:
-                    send_whatsapp_message(
-                        sender_number,
-                        whatsapp_number, 
-                        f"All Ratings \n{all_user_ratings_message}"
-                    )
-                return Response({"message": "Providoor bot: All user ratings", "data": all_user_ratings_message}, status=status.HTTP_200_OK)
-            elif user_message=="/help":
-                send_whatsapp_message(
-                    sender_number,
-                    whatsapp_number, 
-                    """
-                    (Mockup Commands): \n\nREPLY "/new" to place a new order.\n
-                    REPLY "/latest" to check the latest order status.\n
-                    REPLY "/recommend" to get recommendations.\n
-                    REPLY "/ratings" to get all my ratings.\n
-                    REPLY "/help" to check this message again.\n
-                    """
-                )
-                return Response({"message": "Providoor bot: Help message"}, status=status.HTTP_200_OK)
-            # If it's an existing user, check if they have any pending orders
-            latest_order = self.get_latest_order(user)
-            if latest_order is None:
-                # TODO: No pending orders found, giving some recommendations
-                pass
-            else:
-                response = intention_classification(user_message)
-                if(response['function_name'] == "get_user_rating"):
-                    #Insert rating into database
-                    rating = self.add_rating(user, latest_order, response['response']['rating'], user_message)
-                    print(rating)
-                    send_whatsapp_message(
-                        sender_number,
-                        whatsapp_number,
-                        "Thanks for your feedback! We will use it for future recommendations."
-                    )
-                    
-        return Response({"message": "Providoor bot: WhatsAPP message Replied"}, status=status.HTTP_200_OK)
+            # Classification and the rating insert run in the background so
+            # the webhook doesn't wait on the LLM
+            with metrics.span("submit_feedback"):
+                on_feedback(user.id, latest_order.id, user_message)
+            body = "Thanks for your feedback! We will use it for future recommendations."
+
+        return body, "Providoor bot: WhatsAPP message Replied", None
+
+    def handle_once(self, message_sid, whatsapp_number, user_message, on_feedback=submit_feedback):
+        """
+        handle_message, deduplicated on Twilio's MessageSid.
+
+        A retried webhook gets the reply of the first delivery instead of
+        running the bot logic again. In "rest" mode that reply was already
+        sent, so the retry is only acknowledged.
+
+        Returns:
+        - Tuple of (reply body or None, action description, optional data).
+        """
+        result, duplicate = idempotency.process_once(
+            message_sid, lambda: self.handle_message(whatsapp_number, user_message, on_feedback)
+        )
+        if result is None:
+            # The first delivery is still running and will answer
+            return None, "Providoor bot: Duplicate message", None
+        body, message, data = result
+        if duplicate and settings.TWILIO_REPLY_MODE == "rest":
+            body = None
+        return body, message, data
+
+    def post(self, request):
+        # Signature and rate limits are checked by bot.middleware
+
+        # Extract incoming WhatsApp number
+        whatsapp_number = request.data.get('From')  # assuming 'From' contains the number
+        user_message = request.data.get('Body')
+        sender_number = settings.TWILIO_NUMBER # Reply using this Twilio WhatsApp number
+        self.message_sid = request.data.get('MessageSid')
+
+        if not whatsapp_number:
+            return Response({"message": "No sender information found."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            number = normalize_whatsapp_number(whatsapp_number)
+        except ValueError:
+            return Response({"message": "Invalid sender number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        body, message, data = self.handle_once(self.message_sid, number, user_message)
+        with get_metrics().span("reply"):
+            return self.reply(sender_number, whatsapp_number, body, message, data)
 
 class WhatsAppMessageView(APIView):
     # This is a test method to send WhatsApp message
@@ -269,4 +348,20 @@ class WhatsAppMessageView(APIView):
 class PingView(APIView):
     def get(self, request):
         return Response({"message": "pong"}, status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    # Prometheus scrape target, see bot.utils.metrics
+    def get(self, request):
+        metrics = get_metrics()
+        if not metrics.enabled:
+            return HttpResponse("Metrics are disabled", status=404, content_type="text/plain")
+        # The page names views and numbers of every dependency, so it is
+        # never served without a token
+        if not settings.METRICS_TOKEN:
+            return HttpResponse("No metrics token configured", status=403, content_type="text/plain")
+        authorization = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {settings.METRICS_TOKEN}".encode()):
+            return HttpResponse("Invalid metrics token", status=403, content_type="text/plain")
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
     
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class BotConfig(AppConfig):
+    name = "bot"
+
+    def ready(self):
+        from bot import signals  # noqa: F401 (connects the receivers)
@@ -0,0 +1,31 @@
+from django.conf import settings
+
+
+class BotRouter:
+    """
+    Serves the bot's models from the OLTP "default" database and keeps
+    Django away from the Snowflake warehouse, which is only written by the
+    sync job (through explicit .using() calls).
+    """
+
+    app_label = "bot"
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return "default"
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return "default"
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db == obj2._state.db:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.SNOWFLAKE_DB_ALIAS:
+            return False
+        return None
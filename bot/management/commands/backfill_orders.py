@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from bot.models import Orders, Users
+from bot.services.orders import backfill_latest_orders
+
+
+class Command(BaseCommand):
+    help = "Recompute every user's latest_order pointer, e.g. after importing orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated = backfill_latest_orders(Users, Orders, options["batch_size"])
+        self.stdout.write(f"Updated latest order of {updated} users")
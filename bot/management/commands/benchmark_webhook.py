@@ -0,0 +1,225 @@
+import itertools
+import json
+import time
+import tracemalloc
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from bot.api.views import MessageView
+from bot.models import Dishes, OrderDishes, Users
+from bot.services import feedback_pipeline
+from bot.services import ratings as rating_service
+from bot.utils.gpt4 import stub_intention_classification
+from bot.utils.phone import normalize_whatsapp_number
+from bot.utils.querycount import QueryCounter, assert_max_queries
+from bot.utils.timing import percentile, summarize
+from bot.utils.twilio import get_transport
+
+URL = "/api/bot/whatsapp/message"
+FORM = "application/x-www-form-urlencoded"
+NUMBER = "whatsapp:+15550009999"
+# Queries each read path may run however many dishes or ratings it renders
+QUERY_BUDGETS = {"gather_order_details": 1, "format_ratings_page": 1}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the webhook and its order and ratings helpers on a throwaway "
+        "SQLite database, with a fake Twilio transport and a stub classifier. "
+        "Reports latency percentiles, queries and allocations per call and "
+        "fails when a scenario runs more queries than its baseline or gets "
+        "--factor times slower or larger, or when an order or ratings read "
+        "exceeds its fixed query budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200, help="Timed calls per scenario")
+        parser.add_argument("--warmup", type=int, default=20, help="Untimed calls per scenario")
+        parser.add_argument("--dishes", type=int, default=500, help="Dishes on the menu")
+        parser.add_argument("--ratings", type=int, default=50, help="Ratings of the benchmark user")
+        parser.add_argument(
+            "--baselines", default=str(settings.BASE_DIR / "benchmarks" / "baselines.json"),
+            help="JSON file of baseline results per scenario",
+        )
+        parser.add_argument("--write-baselines", action="store_true", help="Save this run as the baselines")
+        parser.add_argument("--factor", type=float, default=2.0, help="Allowed p50 and allocation growth")
+        parser.add_argument(
+            "--slack-ms", type=float, default=0.5,
+            help="Latency growth always allowed, so sub-millisecond scenarios don't fail on noise",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("The benchmark runs on SQLite; set OLTP_ENGINE to django.db.backends.sqlite3")
+
+        # A fresh in-memory database, so runs compare like with like and the
+        # configured database is never written to
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        feedback_pipeline.set_classifier(stub_intention_classification)
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=["testserver"], TWILIO_REPLY_MODE="rest", TWILIO_TRANSPORT="fake",
+                TWILIO_VALIDATE_SIGNATURE=False, WEBHOOK_RATE_PER_IP=0, WEBHOOK_RATE_PER_NUMBER=0,
+                FEEDBACK_PIPELINE_MODE="inline", SNOWFLAKE_WRITE_BEHIND=False, DISH_CATALOG_REFRESH_SECONDS=0,
+            ):
+                results = self.run(options)
+        finally:
+            feedback_pipeline.set_classifier(None)
+            teardown_databases(old_config, verbosity=0)
+
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<24} p50 {result['p50_ms']:7.2f}ms  p95 {result['p95_ms']:7.2f}ms  "
+                f"p99 {result['p99_ms']:7.2f}ms  {result['queries']:2d} queries  {result['alloc_kb']:8.1f} KiB"
+            )
+
+        if options["write_baselines"]:
+            with open(options["baselines"], "w") as handle:
+                json.dump(results, handle, indent=2, sort_keys=True)
+                handle.write("\n")
+            self.stdout.write(f"Wrote baselines to {options['baselines']}")
+            return
+
+        try:
+            with open(options["baselines"]) as handle:
+                baselines = json.load(handle)
+        except FileNotFoundError:
+            self.stdout.write(f"No baselines at {options['baselines']}; run with --write-baselines to record them")
+            return
+
+        failures = self.compare(results, baselines, options["factor"], options["slack_ms"])
+        if failures:
+            raise CommandError("Benchmark regressions:\n" + "\n".join(failures))
+        self.stdout.write("All scenarios within their baselines")
+
+    def seed(self, options):
+        Dishes.objects.bulk_create(
+            [
+                Dishes(
+                    dish_name=f"Dish {i}", dish_description=f"Benchmark dish number {i}", price="19.50",
+                    course=("entree", "main", "dessert")[i % 3], chef_name=f"Chef {i % 20}",
+                    dietaries=("vegan", "gf", None)[i % 3],
+                )
+                for i in range(options["dishes"])
+            ],
+            batch_size=1000,
+        )
+        client = Client()
+        # The first message creates the user
+        client.post(URL, urlencode({"From": NUMBER, "Body": "/help"}), content_type=FORM)
+        user = Users.objects.get(whatsapp_number=normalize_whatsapp_number(NUMBER))
+        view = MessageView()
+        for i in range(options["ratings"]):
+            order = view.create_random_order(user)
+            rating_service.add_rating(user.id, order.id, i % 11, f"Rated {i % 11} out of 10")
+        view.create_random_order(user)
+        return client, user, view
+
+    def check_query_budgets(self, user, view):
+        # A large order and every ratings page, so a query per dish or per
+        # rating would blow the budget
+        order = view.create_random_order(user)
+        OrderDishes.objects.bulk_create(
+            [OrderDishes(order=order, dish=dish, quantity=2) for dish in Dishes.objects.order_by("id")[:50]]
+        )
+        try:
+            with assert_max_queries(QUERY_BUDGETS["gather_order_details"]):
+                view.gather_order_details(order)
+            cursor = None
+            while True:
+                with assert_max_queries(QUERY_BUDGETS["format_ratings_page"]):
+                    _, cursor = view.format_ratings_page(user, cursor)
+                if cursor is None:
+                    break
+        except AssertionError as exc:
+            raise CommandError(f"Query budget exceeded: {exc}")
+
+    def scenarios(self, client, user, view):
+        # name: (setup run untimed before each call or None, call)
+        # Twilio sends a MessageSid with every webhook and the view records
+        # it to answer retries, so each call gets a fresh one like real traffic
+        sids = itertools.count()
+
+        def message(body):
+            def post():
+                payload = urlencode({"From": NUMBER, "Body": body, "MessageSid": f"SM{next(sids):032x}"})
+                return client.post(URL, payload, content_type=FORM)
+            return post
+
+        def new_order():
+            # Feedback is only classified for an order that isn't rated yet
+            view.create_random_order(user)
+
+        return {
+            "post /help": (None, message("/help")),
+            "post /latest": (None, message("/latest")),
+            "post /ratings": (None, message("/ratings")),
+            "post /new": (None, message("/new")),
+            "post feedback": (new_order, message("8/10, lovely")),
+            "create_random_order": (None, lambda: view.create_random_order(user)),
+            "gather_order_details": (None, lambda: view.gather_order_details(user.latest_order)),
+            "format_ratings_page": (None, lambda: view.format_ratings_page(user)),
+        }
+
+    def run(self, options):
+        client, user, view = self.seed(options)
+        get_transport("fake").latency = 0
+        results = {}
+        for name, (setup, call) in self.scenarios(client, user, view).items():
+            setup = setup or (lambda: None)
+            for _ in range(options["warmup"]):
+                setup()
+                call()
+
+            latencies = []
+            queries = 0
+            for _ in range(options["iterations"]):
+                setup()
+                with QueryCounter() as counter:
+                    start = time.perf_counter()
+                    call()
+                    latencies.append(time.perf_counter() - start)
+                queries = max(queries, counter.count)
+
+            # Traced separately, since tracemalloc slows everything down
+            allocations = []
+            tracemalloc.start()
+            for _ in range(min(options["iterations"], 20)):
+                setup()
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                call()
+                allocations.append(tracemalloc.get_traced_memory()[1] - before)
+            tracemalloc.stop()
+
+            summary = summarize(latencies)
+            results[name] = {
+                "p50_ms": round(summary["p50_ms"], 3),
+                "p95_ms": round(summary["p95_ms"], 3),
+                "p99_ms": round(summary["p99_ms"], 3),
+                "queries": queries,
+                "alloc_kb": round(percentile(allocations, 50) / 1024, 1),
+            }
+        # Last, since it leaves the user with a large latest order
+        self.check_query_budgets(user, view)
+        return results
+
+    def compare(self, results, baselines, factor, slack_ms):
+        failures = []
+        for name, result in results.items():
+            baseline = baselines.get(name)
+            if baseline is None:
+                self.stdout.write(f"{name}: no baseline")
+                continue
+            if result["queries"] > baseline["queries"]:
+                failures.append(f"{name}: {result['queries']} queries, baseline {baseline['queries']}")
+            if result["p50_ms"] > baseline["p50_ms"] * factor + slack_ms:
+                failures.append(f"{name}: p50 {result['p50_ms']:.2f}ms, baseline {baseline['p50_ms']:.2f}ms")
+            if result["alloc_kb"] > baseline["alloc_kb"] * factor + 1:
+                failures.append(f"{name}: {result['alloc_kb']:.1f} KiB allocated, baseline {baseline['alloc_kb']:.1f} KiB")
+        return failures
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.services.dish_index import build_dish_index, update_dish_index
+
+
+class Command(BaseCommand):
+    help = "Build the dish similarity index, or update it for new and changed dishes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", help="Index directory (default: DISH_INDEX_PATH)")
+        parser.add_argument("--update", action="store_true", help="Add dishes created since the last build")
+        parser.add_argument("--ids", type=int, nargs="+", help="Re-index these dishes (changed or deleted)")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options["update"] or options["ids"]:
+            try:
+                count = update_dish_index(options["ids"], options["path"])
+            except FileNotFoundError:
+                raise CommandError("No dish index to update yet, run build_dish_index without --update first")
+            action = "Updated"
+        else:
+            count = build_dish_index(options["path"])
+            action = "Indexed"
+        self.stdout.write(f"{action} {count} dishes in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bot.services.recommendations import build_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the /recommend index from all ratings; run it periodically, e.g. from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", help="Where to write the index (default: RECOMMENDATIONS_PATH)")
+        parser.add_argument("--top-n", type=int, help="Candidates kept per user (default: RECOMMENDATIONS_TOP_N)")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        counts = build_index(options["path"], options["top_n"])
+        self.stdout.write(
+            f"Indexed {counts['users']} users over {counts['dishes']} dishes "
+            f"({counts['ratings']} ratings, {counts['similar_pairs']} similar pairs) "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from bot.services import feedback_pipeline
+from bot.utils.gpt4 import stub_intention_classification
+from bot.utils.timing import summarize
+from bot.utils.twilio import get_transport
+
+SYNC_URL = "/api/bot/whatsapp/message"
+ASYNC_URL = "/api/bot/whatsapp/message/async"
+FORM = "application/x-www-form-urlencoded"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the WSGI and ASGI webhooks under concurrent load, with a fake "
+        "Twilio transport and a stub classifier. Runs against a throwaway test "
+        "database, created and dropped by the command."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="Requests per run")
+        parser.add_argument("--users", type=int, default=50, help="Distinct WhatsApp numbers")
+        parser.add_argument("--body", default="/help", help="Message body to send")
+        parser.add_argument("--latency", type=float, default=100, help="Simulated Twilio latency in ms")
+        parser.add_argument("--wsgi-threads", type=int, default=8, help="Worker threads of the WSGI run")
+        parser.add_argument("--asgi-in-flight", type=int, default=500, help="Concurrent requests of the ASGI run")
+
+    def handle(self, *args, **options):
+        numbers = [f"whatsapp:+1555000{i:04d}" for i in range(options["users"])]
+        payloads = [urlencode({"From": numbers[i % len(numbers)], "Body": options["body"]})
+                    for i in range(options["requests"])]
+
+        # The test users and orders never touch the configured database
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        feedback_pipeline.set_classifier(stub_intention_classification)
+        transport = get_transport("fake")
+        transport.latency = options["latency"] / 1000
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=["testserver"], TWILIO_REPLY_MODE="rest", TWILIO_TRANSPORT="fake",
+                TWILIO_VALIDATE_SIGNATURE=False, WEBHOOK_RATE_PER_IP=0, WEBHOOK_RATE_PER_NUMBER=0,
+                SNOWFLAKE_WRITE_BEHIND=False,
+            ):
+                # First messages create the users; keep them out of the timings
+                client = Client()
+                for number in numbers:
+                    client.post(SYNC_URL, urlencode({"From": number, "Body": "/help"}), content_type=FORM)
+
+                self.report("wsgi", *self.run_wsgi(payloads, options["wsgi_threads"]))
+                self.report("asgi", *asyncio.run(self.run_asgi(payloads, options["asgi_in_flight"])))
+        finally:
+            feedback_pipeline.set_classifier(None)
+            teardown_databases(old_config, verbosity=0)
+
+    def run_wsgi(self, payloads, threads):
+        def call(payload):
+            start = time.perf_counter()
+            Client().post(SYNC_URL, payload, content_type=FORM)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = list(executor.map(call, payloads))
+        return latencies, time.perf_counter() - start
+
+    async def run_asgi(self, payloads, in_flight):
+        client = AsyncClient()
+        slots = asyncio.Semaphore(in_flight)
+
+        async def call(payload):
+            async with slots:
+                start = time.perf_counter()
+                await client.post(ASYNC_URL, payload, content_type=FORM)
+                return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(call(payload) for payload in payloads))
+        return latencies, time.perf_counter() - start
+
+    def report(self, name, latencies, elapsed):
+        summary = summarize(latencies)
+        self.stdout.write(
+            f"{name}: {summary['count']} requests in {elapsed:.2f}s "
+            f"({summary['count'] / elapsed:.0f} req/s), "
+            f"p50 {summary['p50_ms']:.1f}ms, p95 {summary['p95_ms']:.1f}ms, p99 {summary['p99_ms']:.1f}ms"
+        )
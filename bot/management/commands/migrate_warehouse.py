@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.services.warehouse_schema import migrate_warehouse, pending_migrations
+
+
+class Command(BaseCommand):
+    help = "Apply the Snowflake schema changes the sync job needs; run it before sync_to_snowflake after upgrading"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sql", action="store_true", help="Print the pending statements instead of running them")
+
+    def handle(self, *args, **options):
+        if settings.SNOWFLAKE_DB_ALIAS not in settings.DATABASES:
+            raise CommandError("No Snowflake database configured, set DS_ENGINE and the DS_* variables")
+
+        if options["sql"]:
+            for migration in pending_migrations():
+                self.stdout.write(f"-- {migration.name}")
+                for statement in migration.statements:
+                    self.stdout.write(f"{statement};")
+            return
+        applied = migrate_warehouse()
+        self.stdout.write(f"Applied {', '.join(applied)}" if applied else "Warehouse schema is up to date")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from bot.services.rating_aggregates import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-user, dish, chef and course rating aggregates from all ratings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = rebuild(options["batch_size"])
+        self.stdout.write(f"Wrote {count} rating aggregates")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from bot.services.outbound_queue import OutboundSender
+
+
+class Command(BaseCommand):
+    help = "Deliver queued outbound WhatsApp messages through Twilio"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, help="Number of sender threads")
+        parser.add_argument("--rate", type=float, help="Messages per second allowed per sender number")
+        parser.add_argument("--once", action="store_true", help="Drain the due messages once and exit")
+
+    def handle(self, *args, **options):
+        sender = OutboundSender(concurrency=options["concurrency"], rate_per_sender=options["rate"])
+        try:
+            if options["once"]:
+                total = 0
+                while True:
+                    claimed = sender.run_once()
+                    if not claimed:
+                        break
+                    total += claimed
+                self.stdout.write(f"Processed {total} messages, queue: {sender.queue.counts()}")
+            else:
+                self.stdout.write("Outbound sender running, press CTRL-C to stop")
+                sender.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sender.close()
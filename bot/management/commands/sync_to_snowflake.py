@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.services.snowflake_sync import pull_dishes, push_to_snowflake
+from bot.services.warehouse_schema import pending_migrations
+
+
+class Command(BaseCommand):
+    help = "Copy new bot rows from the OLTP database to Snowflake (and new dishes back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Rows per INSERT")
+        parser.add_argument("--pull-dishes", action="store_true", help="Also copy new dishes from Snowflake")
+
+    def handle(self, *args, **options):
+        if settings.SNOWFLAKE_DB_ALIAS not in settings.DATABASES:
+            raise CommandError("No Snowflake database configured, set DS_ENGINE and the DS_* variables")
+        pending = pending_migrations()
+        if pending:
+            # Pushing would fail on columns the warehouse doesn't have yet
+            raise CommandError(
+                f"Warehouse migrations pending ({', '.join(m.name for m in pending)}), run migrate_warehouse first"
+            )
+
+        if options["pull_dishes"]:
+            count = pull_dishes(options["batch_size"])
+            self.stdout.write(f"dishes: pulled {count} rows")
+        for table, count in push_to_snowflake(options["batch_size"]).items():
+            self.stdout.write(f"{table}: pushed {count} rows")
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.decorators import sync_and_async_middleware
+from twilio.request_validator import RequestValidator
+
+from bot.utils.metrics import get_metrics, install_query_timer, time_queries
+from bot.utils.phone import normalize_whatsapp_number
+from bot.utils.rate_limit import CacheRateLimiter, TokenBucketRegistry
+from bot.utils.twilio import build_twiml_reply
+
+logger = logging.getLogger(__name__)
+
+THROTTLED_REPLY = "You're sending messages faster than I can keep up. Please wait a moment and send that again."
+
+
+def _build_limiter(name, rate, capacity):
+    if settings.WEBHOOK_RATE_LIMIT_BACKEND == "django":
+        return CacheRateLimiter(f"ratelimit:{name}", rate, capacity)
+    return TokenBucketRegistry(rate, capacity, max_keys=settings.WEBHOOK_RATE_LIMIT_KEYS)
+
+
+class WebhookGuard:
+    """
+    Cheap checks run on Twilio webhook requests before any view code.
+
+    The X-Twilio-Signature HMAC is checked first. Requests failing it are
+    counted in a token bucket per client IP, so a client forging requests
+    gets 429s once its bucket is empty, while signed Twilio traffic, which
+    arrives from a few shared addresses, is never limited by IP. Without
+    signature validation every request counts towards its IP's bucket.
+
+    A token bucket per sender number (trusted once the signature has been
+    checked) then limits floods from one user. A throttled message is
+    acknowledged with a reply asking the user to resend it, since Twilio
+    doesn't retry a 429 and the message would be lost without a trace.
+
+    Each check returns a response to send back instead of calling the
+    view, or None to let the request through.
+    """
+
+    def __init__(self):
+        self._limiters = {}
+        self._validator = None
+        self._lock = threading.Lock()
+        self._stats = {"allowed": 0, "forbidden": 0, "throttled_ip": 0, "throttled_number": 0}
+
+    def limiter(self, name, rate, capacity):
+        # Built on first use, so a setting of 0 never allocates anything
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.setdefault(name, _build_limiter(name, rate, capacity))
+        return limiter
+
+    def validator(self):
+        if self._validator is None:
+            self._validator = RequestValidator(settings.TWILIO_TOKEN or "")
+        return self._validator
+
+    def client_ip(self, request):
+        if settings.WEBHOOK_TRUST_FORWARDED_FOR:
+            forwarded = request.META.get("HTTP_X_FORWARDED_FOR")
+            if forwarded:
+                return forwarded.split(",")[0].strip()
+        return request.META.get("REMOTE_ADDR", "")
+
+    def webhook_url(self, request):
+        # Twilio signs the URL it called, which differs from the one Django
+        # sees behind a TLS-terminating proxy
+        if settings.TWILIO_WEBHOOK_URL:
+            return settings.TWILIO_WEBHOOK_URL.rstrip("/") + request.get_full_path()
+        return request.build_absolute_uri()
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _throttled(self, key, rate):
+        self._count(key)
+        response = HttpResponse("Too many requests", status=429, content_type="text/plain")
+        response["Retry-After"] = str(max(math.ceil(1 / rate), 1))
+        return response
+
+    def _ip_allowed(self, request):
+        rate = settings.WEBHOOK_RATE_PER_IP
+        return not rate or self.limiter("ip", rate, settings.WEBHOOK_BURST_PER_IP).consume(self.client_ip(request))
+
+    def check(self, request):
+        if request.method != "POST" or request.path not in settings.WEBHOOK_PATHS:
+            return None
+
+        if settings.TWILIO_VALIDATE_SIGNATURE:
+            signature = request.META.get("HTTP_X_TWILIO_SIGNATURE")
+            if not signature or not self.validator().validate(self.webhook_url(request), request.POST, signature):
+                if not self._ip_allowed(request):
+                    return self._throttled("throttled_ip", settings.WEBHOOK_RATE_PER_IP)
+                self._count("forbidden")
+                return HttpResponseForbidden("Invalid Twilio signature", content_type="text/plain")
+        elif not self._ip_allowed(request):
+            return self._throttled("throttled_ip", settings.WEBHOOK_RATE_PER_IP)
+
+        rate = settings.WEBHOOK_RATE_PER_NUMBER
+        if rate:
+            try:
+                number = normalize_whatsapp_number(request.POST.get("From"))
+            except ValueError:
+                # Left for the view to reject
+                number = None
+            if number and not self.limiter("number", rate, settings.WEBHOOK_BURST_PER_NUMBER).consume(number):
+                self._count("throttled_number")
+                logger.warning("Throttled a message from %s", number)
+                # A 200 so Twilio delivers the reply; the user resends
+                return HttpResponse(build_twiml_reply(THROTTLED_REPLY), content_type="application/xml")
+
+        self._count("allowed")
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+def get_guard():
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                _guard = WebhookGuard()
+                get_metrics().register_collector("webhook", _guard.stats)
+    return _guard
+
+
+@sync_and_async_middleware
+def twilio_webhook_middleware(get_response):
+    """
+    Reject forged or abusive webhook traffic before DRF parses it or the
+    view touches the database; see WebhookGuard.
+    """
+    guard = get_guard()
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            rejection = guard.check(request)
+            if rejection is not None:
+                return rejection
+            return await get_response(request)
+    else:
+        def middleware(request):
+            rejection = guard.check(request)
+            if rejection is not None:
+                return rejection
+            return get_response(request)
+
+    return middleware
+
+
+@sync_and_async_middleware
+def request_metrics_middleware(get_response):
+    """
+    Record the duration and database queries of every request, by view
+    name; see bot.utils.metrics. Not installed when METRICS_ENABLED is off.
+    """
+    metrics = get_metrics()
+    if not metrics.enabled:
+        raise MiddlewareNotUsed
+    # Every connection, in whichever thread runs the ORM, reports its
+    # queries to the request's QueryTimer
+    connection_created.connect(install_query_timer)
+    for connection in connections.all(initialized_only=True):
+        install_query_timer(connection=connection)
+
+    def record(request, start, timer):
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name else "unmatched"
+        metrics.observe("bot_request_duration_seconds", time.perf_counter() - start, view=view)
+        metrics.observe("bot_request_db_queries", timer.count, view=view)
+        metrics.observe("bot_request_db_seconds", timer.seconds, view=view)
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            with time_queries() as timer:
+                response = await get_response(request)
+            record(request, start, timer)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            with time_queries() as timer:
+                response = get_response(request)
+            record(request, start, timer)
+            return response
+
+    return middleware
@@ -0,0 +1,59 @@
+# Generated by Django 4.1.7 on 2026-10-18 06:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0002_alter_dishes_options_alter_orderdishes_options_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SyncCursors",
+            fields=[
+                (
+                    "table_name",
+                    models.CharField(max_length=100, primary_key=True, serialize=False),
+                ),
+                ("last_id", models.BigIntegerField(default=0)),
+                ("synced_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "sync_cursors",
+            },
+        ),
+        migrations.AlterModelOptions(
+            name="dishes",
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name="orderdishes",
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name="orders",
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name="ratings",
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name="users",
+            options={},
+        ),
+        # The initial migration predates this column
+        migrations.AddField(
+            model_name="orders",
+            name="user",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                to="bot.users",
+            ),
+        ),
+    ]
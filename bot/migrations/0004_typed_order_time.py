@@ -0,0 +1,84 @@
+# Generated by Django 4.1.7 on 2026-10-18 06:45
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+import django.db.models.deletion
+
+# Frozen copies of bot.services.orders.normalize_order_times and
+# backfill_latest_orders as they were when this migration was written, so
+# later changes to those functions don't change what replaying it does.
+
+
+def normalize_text_order_times(apps, schema_editor, batch_size=1000):
+    # Rewrite text order_time values into ISO 8601 so they convert cleanly
+    # to a timestamp column; values that can't be parsed are set to NULL
+    Orders = apps.get_model("bot", "Orders")
+    batch = []
+    for order_id, order_time in Orders.objects.exclude(order_time=None).values_list("id", "order_time").iterator():
+        parsed = parse_datetime(str(order_time).strip().replace("/", "-"))
+        normalized = parsed.isoformat(sep=" ") if parsed else None
+        if normalized != order_time:
+            batch.append(Orders(id=order_id, order_time=normalized))
+        if len(batch) >= batch_size:
+            Orders.objects.bulk_update(batch, ["order_time"])
+            batch = []
+    if batch:
+        Orders.objects.bulk_update(batch, ["order_time"])
+
+
+def fill_latest_orders(apps, schema_editor, batch_size=1000):
+    # Point every user's latest_order at their most recent order (by
+    # order_time, then id)
+    Users = apps.get_model("bot", "Users")
+    Orders = apps.get_model("bot", "Orders")
+    batch = []
+    for user in Users.objects.only("id", "latest_order").iterator(chunk_size=batch_size):
+        latest_id = (
+            Orders.objects.filter(user_id=user.id)
+            .order_by(F("order_time").desc(nulls_last=True), "-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if latest_id != user.latest_order_id:
+            user.latest_order_id = latest_id
+            batch.append(user)
+        if len(batch) >= batch_size:
+            Users.objects.bulk_update(batch, ["latest_order"])
+            batch = []
+    if batch:
+        Users.objects.bulk_update(batch, ["latest_order"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0003_oltp_tables"),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_text_order_times, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name="users",
+            name="latest_order",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="bot.orders",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="orders",
+            name="order_time",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="orders",
+            index=models.Index(
+                fields=["user", "order_time"], name="orders_user_order_time_idx"
+            ),
+        ),
+        migrations.RunPython(fill_latest_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.1.7 on 2026-10-18 07:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_order_lines(apps, schema_editor):
+    LegacyOrderDishes = apps.get_model("bot", "LegacyOrderDishes")
+    OrderDishes = apps.get_model("bot", "OrderDishes")
+    batch = []
+    for order_id, dish_id in LegacyOrderDishes.objects.values_list("order_id", "dish_id").iterator():
+        batch.append(OrderDishes(order_id=order_id, dish_id=dish_id, quantity=1))
+        if len(batch) >= 1000:
+            OrderDishes.objects.bulk_create(batch)
+            batch = []
+    OrderDishes.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+    # order_dishes used order_id as its primary key, so an order could hold
+    # a single dish. The old table is moved aside, the new one created with
+    # its own key and a quantity, and the rows copied over.
+
+    dependencies = [
+        ("bot", "0004_typed_order_time"),
+    ]
+
+    operations = [
+        migrations.RenameModel("OrderDishes", "LegacyOrderDishes"),
+        migrations.AlterModelTable("LegacyOrderDishes", "order_dishes_legacy"),
+        migrations.CreateModel(
+            name="OrderDishes",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("quantity", models.PositiveIntegerField(default=1)),
+                (
+                    "dish",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.DO_NOTHING, to="bot.dishes"
+                    ),
+                ),
+                (
+                    "order",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="lines",
+                        to="bot.orders",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "order_dishes",
+            },
+        ),
+        migrations.RunPython(copy_order_lines, migrations.RunPython.noop),
+        migrations.DeleteModel("LegacyOrderDishes"),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 4.1.7 on 2026-10-18 06:47
+
+import re
+
+from django.db import migrations, models
+from django.db.models import F
+
+# Frozen copies of bot.utils.phone.normalize_whatsapp_number and
+# bot.services.orders.backfill_latest_orders as they were when this
+# migration was written, so later changes to them don't change what
+# replaying it does.
+_SEPARATORS_RE = re.compile(r"[\s\-().]")
+_E164_RE = re.compile(r"^\+[1-9]\d{6,14}$")
+
+
+def normalize_whatsapp_number(value):
+    number = (value or "").strip()
+    if number.lower().startswith("whatsapp:"):
+        number = number[len("whatsapp:"):]
+    number = _SEPARATORS_RE.sub("", number)
+    if number.startswith("00"):
+        number = "+" + number[2:]
+    elif not number.startswith("+"):
+        number = "+" + number
+    if not _E164_RE.match(number):
+        raise ValueError(f"Invalid WhatsApp number: {value!r}")
+    return number
+
+
+def backfill_latest_orders(Users, Orders, batch_size=1000):
+    batch = []
+    for user in Users.objects.only("id", "latest_order").iterator(chunk_size=batch_size):
+        latest_id = (
+            Orders.objects.filter(user_id=user.id)
+            .order_by(F("order_time").desc(nulls_last=True), "-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if latest_id != user.latest_order_id:
+            user.latest_order_id = latest_id
+            batch.append(user)
+        if len(batch) >= batch_size:
+            Users.objects.bulk_update(batch, ["latest_order"])
+            batch = []
+    if batch:
+        Users.objects.bulk_update(batch, ["latest_order"])
+
+
+def normalize_and_merge_users(apps, schema_editor):
+    # Rewrite numbers to E.164 and fold users sharing a number into the
+    # oldest one, moving their orders and ratings over, so the unique index
+    # can be created. Unparseable numbers are kept as they are.
+    Users = apps.get_model("bot", "Users")
+    Orders = apps.get_model("bot", "Orders")
+    Ratings = apps.get_model("bot", "Ratings")
+    keepers = {}
+    merged = False
+    for user in Users.objects.exclude(whatsapp_number=None).order_by("id").iterator():
+        try:
+            number = normalize_whatsapp_number(user.whatsapp_number)
+        except ValueError:
+            number = user.whatsapp_number.strip()
+        keeper_id = keepers.get(number)
+        if keeper_id is None:
+            keepers[number] = user.id
+            if number != user.whatsapp_number:
+                Users.objects.filter(pk=user.id).update(whatsapp_number=number)
+            continue
+        Orders.objects.filter(user_id=user.id).update(user_id=keeper_id)
+        Ratings.objects.filter(user_id=user.id).update(user_id=keeper_id)
+        Users.objects.filter(pk=user.id).delete()
+        merged = True
+    if merged:
+        backfill_latest_orders(Users, Orders)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0005_order_lines"),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_and_merge_users, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="users",
+            name="whatsapp_number",
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.7 on 2026-10-18 06:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0006_unique_whatsapp_number"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProcessedMessages",
+            fields=[
+                (
+                    "message_sid",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("status", models.CharField(max_length=10)),
+                ("body", models.TextField(blank=True, null=True)),
+                ("message", models.CharField(blank=True, max_length=255, null=True)),
+                ("data", models.JSONField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "db_table": "processed_messages",
+            },
+        ),
+    ]
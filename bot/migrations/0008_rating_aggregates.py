@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 06:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0007_processed_messages"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RatingAggregates",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("dimension", models.CharField(max_length=10)),
+                ("key", models.CharField(max_length=255)),
+                ("rating_sum", models.BigIntegerField(default=0)),
+                ("rating_count", models.BigIntegerField(default=0)),
+                ("last_rated_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "rating_aggregates",
+                "unique_together": {("dimension", "key")},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0008_rating_aggregates"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="synccursors",
+            name="last_updated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="users",
+            name="updated_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
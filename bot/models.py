@@ -87,7 +87,6 @@ class Dishes(models.Model):
     dietaries = models.CharField(max_length=100, blank=True, null=True)
 
     class Meta:
-        managed = False
         db_table = 'dishes'
 
 
@@ -137,23 +136,27 @@ class DjangoSession(models.Model):
 
 
 class OrderDishes(models.Model):
-    order = models.OneToOneField('Orders', models.DO_NOTHING, primary_key=True)
+    # One row per dish in an order; order_id is indexed through the foreign key
+    id = models.BigAutoField(primary_key=True)
+    order = models.ForeignKey('Orders', models.DO_NOTHING, related_name='lines')
     dish = models.ForeignKey(Dishes, models.DO_NOTHING)
+    quantity = models.PositiveIntegerField(default=1)
 
     class Meta:
-        managed = False
         db_table = 'order_dishes'
 
 
 class Orders(models.Model):
     id = models.BigAutoField(primary_key=True)
-    order_time = models.TextField(blank=True, null=True)  # This field type is a guess.
+    order_time = models.DateTimeField(blank=True, null=True)
     order_status = models.CharField(max_length=50, blank=True, null=True)
     user = models.ForeignKey('Users', models.DO_NOTHING, blank=True, null=True)
 
     class Meta:
-        managed = False
         db_table = 'orders'
+        indexes = [
+            models.Index(fields=['user', 'order_time'], name='orders_user_order_time_idx'),
+        ]
 
 
 class Ratings(models.Model):
@@ -164,17 +167,62 @@ class Ratings(models.Model):
     original_feedback = models.TextField(blank=True, null=True)
 
     class Meta:
-        managed = False
         db_table = 'ratings'
         unique_together = (('user', 'order'),)
 
 
 class Users(models.Model):
     id = models.BigAutoField(primary_key=True)
-    whatsapp_number = models.CharField(max_length=20, blank=True, null=True)
+    # E.164 form of the Twilio 'whatsapp:+...' address, see bot.utils.phone
+    whatsapp_number = models.CharField(unique=True, max_length=20, blank=True, null=True)
     user_name = models.CharField(max_length=255, blank=True, null=True)
     user_email = models.CharField(max_length=255, blank=True, null=True)
+    # Most recent order, maintained on insert so it can be read without
+    # scanning the user's order history
+    latest_order = models.ForeignKey('Orders', models.DO_NOTHING, blank=True, null=True, related_name='+')
+    # Set by every write changing the row after it was inserted, so the
+    # Snowflake sync can re-send it
+    updated_at = models.DateTimeField(blank=True, null=True, db_index=True)
 
     class Meta:
-        managed = False
         db_table = 'users'
+
+
+class SyncCursors(models.Model):
+    # High-water marks of the rows already copied to Snowflake, per table:
+    # the highest id, and the newest updated_at for tables that have one
+    table_name = models.CharField(primary_key=True, max_length=100)
+    last_id = models.BigIntegerField(default=0)
+    last_updated_at = models.DateTimeField(blank=True, null=True)
+    synced_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'sync_cursors'
+
+
+class ProcessedMessages(models.Model):
+    # Inbound webhooks already handled, so Twilio retries get the first reply
+    message_sid = models.CharField(primary_key=True, max_length=64)
+    status = models.CharField(max_length=10)
+    body = models.TextField(blank=True, null=True)
+    message = models.CharField(max_length=255, blank=True, null=True)
+    data = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'processed_messages'
+
+
+class RatingAggregates(models.Model):
+    # Running rating totals per user, dish, chef or course, kept up to date
+    # by bot.services.rating_aggregates
+    id = models.BigAutoField(primary_key=True)
+    dimension = models.CharField(max_length=10)
+    key = models.CharField(max_length=255)
+    rating_sum = models.BigIntegerField(default=0)
+    rating_count = models.BigIntegerField(default=0)
+    last_rated_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'rating_aggregates'
+        unique_together = (('dimension', 'key'),)
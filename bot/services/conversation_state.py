@@ -0,0 +1,127 @@
+import threading
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from bot.models import Orders, Ratings, Users
+from bot.utils.cache import build_cache
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the conversation state cache configured by the
+    CONVERSATION_CACHE_* settings.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = build_cache(
+                    settings.CONVERSATION_CACHE_BACKEND,
+                    "conversation",
+                    maxsize=settings.CONVERSATION_CACHE_SIZE,
+                    ttl=settings.CONVERSATION_CACHE_TTL,
+                )
+    return _cache
+
+
+def _state_key(whatsapp_number):
+    return f"number:{whatsapp_number}"
+
+
+def _user_key(user_id):
+    # Lets order and rating writes, which only know the user id, find the state
+    return f"user:{user_id}"
+
+
+def get_state(whatsapp_number):
+    """
+    Return the cached conversation state of a WhatsApp number, or None.
+
+    The state is a dict with user_id, latest_order_id, latest_order_status
+    and pending_feedback (whether the latest order is still unrated).
+    """
+    return get_cache().get(_state_key(whatsapp_number))
+
+
+def _store(whatsapp_number, state):
+    cache = get_cache()
+    cache.set(_state_key(whatsapp_number), state)
+    cache.set(_user_key(state["user_id"]), whatsapp_number)
+
+
+def remember_user(user):
+    """
+    Cache the state of a user just read from or created in the database.
+
+    Costs at most one query, checking whether the latest order was rated.
+
+    Returns:
+    - The state dict.
+    """
+    state = {
+        "user_id": user.id,
+        "latest_order_id": user.latest_order_id,
+        "latest_order_status": None,
+        "pending_feedback": False,
+    }
+    if user.latest_order_id is not None:
+        rated = Exists(Ratings.objects.filter(user_id=user.id, order_id=OuterRef("pk")))
+        order_status, is_rated = (
+            Orders.objects.filter(pk=user.latest_order_id)
+            .annotate(is_rated=rated)
+            .values_list("order_status", "is_rated")
+            .get()
+        )
+        state["latest_order_status"] = order_status
+        state["pending_feedback"] = not is_rated
+    _store(user.whatsapp_number, state)
+    return state
+
+
+def record_order(user, order):
+    # Write-through from order creation: the new order is the latest one
+    _store(user.whatsapp_number, {
+        "user_id": user.id,
+        "latest_order_id": order.id,
+        "latest_order_status": order.order_status,
+        "pending_feedback": True,
+    })
+
+
+def record_rating(user_id, order_id):
+    # Write-through from add_rating: the rated order no longer awaits feedback
+    cache = get_cache()
+    whatsapp_number = cache.get(_user_key(user_id))
+    if whatsapp_number is None:
+        return
+    state = cache.get(_state_key(whatsapp_number))
+    if state is not None and state["latest_order_id"] == order_id:
+        _store(whatsapp_number, dict(state, pending_feedback=False))
+
+
+def update_state(whatsapp_number, **fields):
+    # Set extra fields (e.g. a pagination cursor) on a cached state; a no-op
+    # if the number has no state cached
+    state = get_state(whatsapp_number)
+    if state is not None:
+        _store(whatsapp_number, dict(state, **fields))
+
+
+def forget(whatsapp_number):
+    get_cache().delete(_state_key(whatsapp_number))
+
+
+def cached_user(whatsapp_number, state):
+    # Unsaved-looking Users instance built from the state, for read-only use
+    return Users(id=state["user_id"], whatsapp_number=whatsapp_number, latest_order_id=state["latest_order_id"])
+
+
+def cached_latest_order(state):
+    # Orders instance built from the state, or None; carries id, user and status only
+    if state["latest_order_id"] is None:
+        return None
+    return Orders(id=state["latest_order_id"], user_id=state["user_id"], order_status=state["latest_order_status"])
@@ -0,0 +1,238 @@
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count, Max
+
+from bot.models import Dishes
+from bot.services.dish_sampler import get_dish_sampler
+from bot.utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ("id", "dish_name", "dish_description", "price", "course", "chef_name", "dietaries")
+# Bumped in the Django cache whenever dishes change, so every process
+# sharing the cache notices edits the (count, max id) version can't see
+_GENERATION_KEY = "dishes:generation"
+
+
+class DishRecord:
+    # One dish of the catalog; __slots__ keeps it to a fixed-size object
+    # with no per-instance __dict__
+    __slots__ = ("id", "name", "description", "price", "course", "chef", "dietaries")
+
+    def __init__(self, id, name, description, price, course, chef, dietaries):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.price = price
+        self.course = course
+        self.chef = chef
+        self.dietaries = dietaries
+
+    def details(self, quantity):
+        # The dict format_order_message renders
+        return {
+            "quantity": quantity,
+            "name": self.name,
+            "description": self.description,
+            "price": self.price,
+            "course": self.course,
+            "chef": self.chef,
+            "dietaries": self.dietaries,
+        }
+
+
+def _records(rows):
+    # Courses, chefs, dietary tags and prices repeat across the menu; share
+    # one object per distinct value instead of one per dish
+    shared = {}
+    records = {}
+    for dish_id, name, description, price, course, chef, dietaries in rows:
+        records[dish_id] = DishRecord(
+            dish_id,
+            name,
+            description,
+            shared.setdefault(("price", price), price),
+            shared.setdefault(("course", course), course),
+            shared.setdefault(("chef", chef), chef),
+            shared.setdefault(("dietaries", dietaries), dietaries),
+        )
+    return records
+
+
+def catalog_size(records):
+    """
+    Estimate the bytes held by a catalog: the dict, the records and every
+    distinct field value, each shared object counted once.
+    """
+    seen = set()
+    size = sys.getsizeof(records)
+    for record in records.values():
+        size += sys.getsizeof(record)
+        for name in DishRecord.__slots__:
+            value = getattr(record, name)
+            if value is not None and id(value) not in seen:
+                seen.add(id(value))
+                size += sys.getsizeof(value)
+    return size
+
+
+class DishCatalog:
+    """
+    The dish menu held in memory, so rendering an order looks its dishes up
+    in a dict instead of joining the dishes table.
+
+    A background thread compares a version every `refresh_interval`
+    seconds and reloads the catalog when it moved: the table's row count
+    and max id, which catch appended dishes, plus a generation number in
+    the Django cache that dishes_changed() bumps whenever dishes are saved,
+    deleted or pulled. Ids missing from the catalog are read through to the
+    database in one query and kept.
+    """
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = (
+            settings.DISH_CATALOG_REFRESH_SECONDS if refresh_interval is None else refresh_interval
+        )
+        self._records = None
+        self._version = None
+        self._loaded_at = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"hits": 0, "misses": 0, "loads": 0}
+
+    def version(self):
+        row = Dishes.objects.aggregate(count=Count("id"), last_id=Max("id"))
+        return row["count"], row["last_id"], cache.get(_GENERATION_KEY, 0)
+
+    def load(self):
+        version = self.version()
+        started = time.perf_counter()
+        records = _records(Dishes.objects.order_by().values_list(*_FIELDS).iterator(chunk_size=10000))
+        size = catalog_size(records)
+        with self._lock:
+            self._records = records
+            self._version = version
+            self._loaded_at = time.monotonic()
+            self._bytes = size
+            self._stats["loads"] += 1
+        logger.info(
+            "Loaded %d dishes into the catalog in %.0f ms (%.1f MB)",
+            len(records), (time.perf_counter() - started) * 1000, size / 1e6,
+        )
+        return records
+
+    def refresh(self):
+        """
+        Reload the catalog if the dishes table changed since the last load.
+
+        Returns:
+        - True if it was reloaded.
+        """
+        if self._records is not None and self.version() == self._version:
+            return False
+        self.load()
+        return True
+
+    def invalidate(self):
+        # Reload on the next lookup, e.g. after dishes were edited
+        with self._lock:
+            self._records = None
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Could not refresh the dish catalog")
+            finally:
+                # This thread's connections would otherwise stay open
+                connections.close_all()
+
+    def start(self):
+        if self.refresh_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="dish-catalog", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get_many(self, dish_ids):
+        """
+        Look up dishes by id.
+
+        Returns:
+        - Dict of id to DishRecord; ids that don't exist are left out.
+        """
+        records = self._records
+        if records is None:
+            records = self.load()
+        found = {}
+        missing = []
+        for dish_id in dish_ids:
+            record = records.get(dish_id)
+            if record is None:
+                missing.append(dish_id)
+            else:
+                found[dish_id] = record
+        fetched = {}
+        if missing:
+            fetched = _records(Dishes.objects.filter(pk__in=missing).values_list(*_FIELDS))
+            found.update(fetched)
+        with self._lock:
+            records.update(fetched)
+            self._stats["hits"] += len(dish_ids) - len(missing)
+            self._stats["misses"] += len(missing)
+        return found
+
+    def get(self, dish_id):
+        return self.get_many([dish_id]).get(dish_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["dishes"] = len(self._records) if self._records is not None else 0
+            stats["bytes"] = self._bytes
+            stats["age_seconds"] = time.monotonic() - self._loaded_at if self._loaded_at is not None else None
+        return stats
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_dish_catalog():
+    """
+    Return the process-wide dish catalog, starting its refresh thread on
+    first use (so after a pre-forking server has forked the worker).
+    """
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = DishCatalog()
+                _catalog.start()
+                get_metrics().register_collector("dish_catalog", _catalog.stats)
+    return _catalog
+
+
+def dishes_changed():
+    """
+    Drop cached dish data after dishes were edited, added or removed: in
+    this process right away, and in every process sharing the Django cache
+    at its catalog's next refresh.
+    """
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        cache.add(_GENERATION_KEY, 1, timeout=None)
+    if _catalog is not None:
+        _catalog.invalidate()
+    get_dish_sampler().invalidate()
@@ -0,0 +1,415 @@
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+
+import numpy as np
+from django.conf import settings
+
+from bot.models import Dishes
+from bot.services.recommendations import split_dietaries
+
+logger = logging.getLogger(__name__)
+
+# Below this many dishes a query scores every vector, which is exact and
+# still takes well under a millisecond
+EXACT_SEARCH_LIMIT = 5000
+# Feature weights: the name says more about a dish than its description
+FIELD_WEIGHTS = {"name": 2.0, "description": 1.0, "course": 1.5, "chef": 1.0, "diet": 1.5}
+_FIELDS = ("id", "dish_name", "dish_description", "course", "chef_name", "dietaries")
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# Words too common in dish names and descriptions to tell dishes apart
+STOPWORDS = frozenset({"a", "an", "and", "the", "of", "with", "in", "on", "or", "for", "to", "our", "served"})
+
+
+def _stem(word):
+    # Plural folding only, so "tomatoes" matches "tomato" and "dumplings"
+    # "dumpling"; other suffixes carry meaning in dish names ("smoked")
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith("oes"):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us")):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """
+    Split dish text into lower-case, plural-folded words, dropping single
+    characters and stopwords.
+    """
+    words = _TOKEN_RE.findall((text or "").lower())
+    return [_stem(word) for word in words if len(word) > 1 and word not in STOPWORDS]
+
+
+def dish_features(dish_name, dish_description, course, chef_name, dietaries):
+    """
+    Turn a dish's text fields into weighted term counts.
+
+    Name and description are split into stemmed words; course, chef and each
+    dietary tag become single field-prefixed features, so "Chef 2" matches
+    only dishes by that chef rather than anything containing "2".
+    """
+    features = Counter()
+    for word in tokenize(dish_name):
+        features[f"w:{word}"] += FIELD_WEIGHTS["name"]
+    for word in tokenize(dish_description):
+        features[f"w:{word}"] += FIELD_WEIGHTS["description"]
+    if course:
+        features[f"course:{course.strip().lower()}"] += FIELD_WEIGHTS["course"]
+    if chef_name:
+        features[f"chef:{chef_name.strip().lower()}"] += FIELD_WEIGHTS["chef"]
+    for tag in split_dietaries(dietaries):
+        features[f"diet:{tag}"] += FIELD_WEIGHTS["diet"]
+    return features
+
+
+def hash_features(features, dim):
+    """
+    Project weighted features into `dim` buckets with the signed hashing
+    trick, using sublinear term frequency.
+
+    Returns:
+    - Tuple of (bucket indices, values) arrays.
+    """
+    buckets = np.empty(len(features), dtype=np.int64)
+    values = np.empty(len(features), dtype=np.float32)
+    for i, (feature, weight) in enumerate(features.items()):
+        # crc32 is stable across processes, unlike hash()
+        digest = zlib.crc32(feature.encode("utf-8"))
+        buckets[i] = digest % dim
+        # The top bit picks the sign, so collisions tend to cancel out
+        values[i] = (1.0 + math.log(weight)) * (-1 if digest & 0x80000000 else 1)
+    return buckets, values
+
+
+def _vectorize(features, dim, idf):
+    vector = np.zeros(dim, dtype=np.float32)
+    buckets, values = hash_features(features, dim)
+    np.add.at(vector, buckets, values)
+    vector *= idf
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _hyperplanes(seed, tables, bits, dim):
+    return np.random.default_rng(seed).standard_normal((tables * bits, dim)).astype(np.float32)
+
+
+def _lsh_codes(planes, vectors, tables, bits):
+    # One `bits`-bit bucket code per table: the signs of the projections
+    signs = (np.atleast_2d(vectors) @ planes.T > 0).reshape(-1, tables, bits)
+    return (signs.astype(np.uint32) << np.arange(bits, dtype=np.uint32)).sum(axis=2, dtype=np.uint32)
+
+
+def _meta_path(path):
+    return os.path.join(path, "meta.json")
+
+
+def _data_path(path, version, name):
+    return os.path.join(path, f"{name}-{version}.npy")
+
+
+def _write_meta(path, meta):
+    fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".json")
+    with os.fdopen(fd, "w") as handle:
+        json.dump(meta, handle)
+    os.replace(tmp_path, _meta_path(path))
+
+
+def _read_meta(path):
+    with open(_meta_path(path)) as handle:
+        return json.load(handle)
+
+
+def _write_version(path, meta, vectors, ids, idf):
+    # Files are versioned and meta.json is swapped last, so readers always
+    # see a complete set. One padding row keeps an empty index mappable.
+    rows = max(len(vectors), 1)
+    stored = np.lib.format.open_memmap(
+        _data_path(path, meta["version"], "vectors"), mode="w+", dtype=np.float32, shape=(rows, meta["dim"])
+    )
+    stored[: len(vectors)] = vectors
+    stored.flush()
+    del stored
+    padded_ids = np.full(rows, -1, dtype=np.int64)
+    padded_ids[: len(ids)] = ids
+    np.save(_data_path(path, meta["version"], "ids"), padded_ids)
+    np.save(_data_path(path, meta["version"], "idf"), idf)
+    _write_meta(path, meta)
+
+
+def _remove_old_versions(path, version):
+    # The previous version is kept too, for a reader that read meta.json
+    # just before the swap and is still opening its files
+    keep = {str(version), str(version - 1)}
+    for name in os.listdir(path):
+        stem, ext = os.path.splitext(name)
+        if ext == ".npy" and "-" in stem and stem.rsplit("-", 1)[1] not in keep:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def build_dish_index(path=None, dim=None, tables=None, bits=None, chunk_size=2000):
+    """
+    Vectorize every dish and write a fresh index to the `path` directory.
+
+    Vectors are hashed TF-IDF over the dish's text fields, L2-normalized so
+    a dot product is the cosine similarity.
+
+    Returns:
+    - The number of dishes indexed.
+    """
+    path = path or settings.DISH_INDEX_PATH
+    dim = dim or settings.DISH_INDEX_DIM
+    os.makedirs(path, exist_ok=True)
+
+    ids = []
+    features = []
+    document_frequency = np.zeros(dim, dtype=np.float64)
+    for row in Dishes.objects.order_by("id").values_list(*_FIELDS).iterator(chunk_size=chunk_size):
+        weights = dish_features(*row[1:])
+        ids.append(row[0])
+        features.append(weights)
+        buckets, _ = hash_features(weights, dim)
+        document_frequency[np.unique(buckets)] += 1
+    idf = (np.log((len(ids) + 1) / (document_frequency + 1)) + 1).astype(np.float32)
+    vectors = np.stack([_vectorize(f, dim, idf) for f in features]) if ids else np.zeros((0, dim), np.float32)
+
+    try:
+        previous = _read_meta(path)["version"]
+    except (FileNotFoundError, ValueError, KeyError):
+        previous = 0
+    meta = {
+        "version": previous + 1,
+        "dim": dim,
+        "tables": tables or settings.DISH_INDEX_TABLES,
+        "bits": bits or settings.DISH_INDEX_BITS,
+        "seed": 0,
+        "count": len(ids),
+        "built_at": time.time(),
+    }
+    _write_version(path, meta, vectors, np.array(ids, dtype=np.int64), idf)
+    _remove_old_versions(path, meta["version"])
+    return len(ids)
+
+
+def update_dish_index(dish_ids=None, path=None, chunk_size=2000):
+    """
+    Re-vectorize the given dishes, appending new ones and dropping deleted
+    ones, without rebuilding the index.
+
+    With no `dish_ids`, dishes with a higher id than any indexed one are
+    added. The result is written as a new version and swapped in like a
+    full build, so processes reading the current version never see a
+    half-written row; only the changed dishes are read and vectorized.
+    IDF weights stay those of the last full build, so run
+    build_dish_index() now and then as the menu drifts.
+
+    Returns:
+    - The number of dishes written or dropped.
+    """
+    path = path or settings.DISH_INDEX_PATH
+    meta = _read_meta(path)
+    version, dim, count = meta["version"], meta["dim"], meta["count"]
+    ids = np.load(_data_path(path, version, "ids"))[:count]
+    idf = np.load(_data_path(path, version, "idf"))
+    rows = {int(dish_id): row for row, dish_id in enumerate(ids) if dish_id >= 0}
+
+    if dish_ids is None:
+        queryset = Dishes.objects.filter(pk__gt=int(ids.max()) if count else 0)
+        dish_ids = []
+    else:
+        dish_ids = [int(dish_id) for dish_id in dish_ids]
+        queryset = Dishes.objects.filter(pk__in=dish_ids)
+    fetched = {
+        row[0]: _vectorize(dish_features(*row[1:]), dim, idf)
+        for row in queryset.order_by("id").values_list(*_FIELDS).iterator(chunk_size=chunk_size)
+    }
+    # Requested dishes that no longer exist are dropped
+    deleted = {rows[dish_id] for dish_id in dish_ids if dish_id not in fetched and dish_id in rows}
+    added = [dish_id for dish_id in fetched if dish_id not in rows]
+
+    # A private copy: the mapped file of the current version is never written
+    vectors = np.array(np.load(_data_path(path, version, "vectors"), mmap_mode="r")[:count])
+    for dish_id, vector in fetched.items():
+        if dish_id in rows:
+            vectors[rows[dish_id]] = vector
+    keep = np.array([row not in deleted and ids[row] >= 0 for row in range(count)], dtype=bool)
+    vectors = np.concatenate([vectors[keep], np.array([fetched[dish_id] for dish_id in added]).reshape(-1, dim)])
+    ids = np.concatenate([ids[keep], np.array(added, dtype=np.int64)])
+
+    meta = dict(meta, version=version + 1, count=len(ids), updated_at=time.time())
+    _write_version(path, meta, vectors, ids, idf)
+    _remove_old_versions(path, meta["version"])
+    return len(fetched) + len(deleted)
+
+
+class DishIndex:
+    """
+    Read side of the dish index: a memory-mapped vector matrix plus
+    in-memory locality-sensitive hash tables.
+
+    Each table buckets dishes by the signs of `bits` random projections, so
+    dishes at a small angle tend to share a bucket. A query scores only the
+    dishes sharing a bucket with it in some table, probing the neighbouring
+    buckets (one bit flipped) when that yields too few candidates. Small
+    menus, and queries without enough neighbours, are searched exhaustively.
+    """
+
+    def __init__(self, path):
+        meta = _read_meta(path)
+        self.meta = meta
+        self.dim = meta["dim"]
+        self.tables = meta["tables"]
+        self.bits = meta["bits"]
+        count = meta["count"]
+        self.vectors = np.load(_data_path(path, meta["version"], "vectors"), mmap_mode="r")
+        self.idf = np.load(_data_path(path, meta["version"], "idf"))
+        ids = np.load(_data_path(path, meta["version"], "ids"))[:count]
+        self.ids = ids
+        self._live = np.flatnonzero(ids >= 0)
+        self._rows = {int(ids[row]): int(row) for row in self._live}
+        self.planes = _hyperplanes(meta["seed"], self.tables, self.bits, self.dim)
+        self._buckets = None
+        if len(self._live) > EXACT_SEARCH_LIMIT:
+            codes = _lsh_codes(self.planes, self.vectors[self._live], self.tables, self.bits)
+            self._buckets = [defaultdict(list) for _ in range(self.tables)]
+            for row, row_codes in zip(self._live, codes):
+                for table, code in enumerate(row_codes):
+                    self._buckets[table][int(code)].append(int(row))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _candidates(self, vector, k):
+        if self._buckets is None:
+            return self._live
+        codes = _lsh_codes(self.planes, vector, self.tables, self.bits)[0]
+        found = set()
+        for table, code in enumerate(codes):
+            found.update(self._buckets[table].get(int(code), ()))
+        if len(found) <= k:
+            for table, code in enumerate(codes):
+                for bit in range(self.bits):
+                    found.update(self._buckets[table].get(int(code) ^ (1 << bit), ()))
+        if len(found) <= k:
+            # An outlier with no near neighbours: fall back to a full scan
+            return self._live
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+
+    def _query(self, vector, k, exclude=None):
+        candidates = self._candidates(vector, k + 1)
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if not len(candidates):
+            return []
+        scores = self.vectors[candidates] @ vector
+        keep = min(k, len(candidates))
+        best = np.argpartition(-scores, keep - 1)[:keep]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(int(self.ids[candidates[i]]), float(scores[i])) for i in best if scores[i] > 0]
+
+    def similar(self, dish_id, k=5):
+        """
+        Return up to k (dish id, cosine similarity) pairs most similar to a
+        dish, best first; an empty list for a dish not in the index.
+        """
+        row = self._rows.get(dish_id)
+        if row is None:
+            return []
+        return self._query(np.asarray(self.vectors[row]), k, exclude=row)
+
+    def search(self, text, k=5):
+        """
+        Return up to k (dish id, cosine similarity) pairs matching free text,
+        e.g. "spicy vegan curry".
+        """
+        vector = _vectorize(dish_features(text, None, None, None, None), self.dim, self.idf)
+        if not vector.any():
+            return []
+        return self._query(vector, k)
+
+
+class DishIndexLoader:
+    """
+    Keeps a DishIndex open, reopening it when meta.json changes. The file is
+    stat'ed at most every `refresh_interval` seconds.
+    """
+
+    def __init__(self, path=None, refresh_interval=None):
+        self.path = path or settings.DISH_INDEX_PATH
+        self.refresh_interval = (
+            settings.DISH_INDEX_REFRESH_SECONDS if refresh_interval is None else refresh_interval
+        )
+        self._index = None
+        self._mtime = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return self._index
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(_meta_path(self.path)).st_mtime_ns
+            except FileNotFoundError:
+                return self._index
+            if mtime != self._mtime:
+                try:
+                    self._index = DishIndex(self.path)
+                    self._mtime = mtime
+                except Exception:
+                    logger.exception("Could not load dish index %s", self.path)
+        return self._index
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_dish_index():
+    """
+    Return the process-wide dish index, or None until one has been built.
+    """
+    global _loader
+    if _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                _loader = DishIndexLoader()
+    return _loader.get()
+
+
+def similar_dishes(dish_ids, k=5):
+    """
+    Return up to k dish ids most similar to any of `dish_ids`, best first,
+    leaving out `dish_ids` themselves.
+    """
+    index = get_dish_index()
+    if index is None:
+        return []
+    best = {}
+    for dish_id in dish_ids:
+        for similar_id, score in index.similar(dish_id, k + len(dish_ids)):
+            if similar_id not in dish_ids and score > best.get(similar_id, 0):
+                best[similar_id] = score
+    return sorted(best, key=best.get, reverse=True)[:k]
+
+
+def search_dishes(text, k=5):
+    """
+    Return up to k dish ids matching free text, best first.
+    """
+    index = get_dish_index()
+    return [dish_id for dish_id, _ in index.search(text, k)] if index is not None else []
@@ -0,0 +1,62 @@
+import random
+import threading
+import time
+from array import array
+
+from django.conf import settings
+
+from bot.models import Dishes
+
+
+class DishSampler:
+    """
+    Picks random dishes from a cached array of dish ids.
+
+    Only the ids are loaded (8 bytes each, streamed in chunks), and the array
+    is reloaded at most every `refresh_interval` seconds, so sampling costs no
+    query and constant memory per request however large the menu is.
+    """
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = (
+            settings.DISH_SAMPLER_REFRESH_SECONDS if refresh_interval is None else refresh_interval
+        )
+        self._ids = array("q")
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        ids = array("q", Dishes.objects.order_by().values_list("id", flat=True).iterator(chunk_size=10000))
+        with self._lock:
+            self._ids = ids
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        # Force a reload on the next sample, e.g. after dishes were added or removed
+        with self._lock:
+            self._loaded_at = None
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval
+
+    def sample(self, k):
+        """
+        Return up to k distinct random dish ids.
+        """
+        if self._is_stale():
+            self.refresh()
+        ids = self._ids
+        return random.sample(ids, min(k, len(ids)))
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_dish_sampler():
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                _sampler = DishSampler()
+    return _sampler
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from bot.services.ratings import add_rating
+
+logger = logging.getLogger(__name__)
+
+_classifier = None
+
+
+def get_classifier():
+    # The callable turning a feedback message into an intention_classification
+    # style result, configured by settings.INTENTION_CLASSIFIER
+    global _classifier
+    if _classifier is None:
+        _classifier = import_string(settings.INTENTION_CLASSIFIER)
+    return _classifier
+
+
+def _async_classifier():
+    # The default classifier has a native async version; anything else
+    # (stubs, custom classifiers) runs in a worker thread
+    from bot.utils.gpt4 import classify_feedback, classify_feedback_async
+
+    classifier = get_classifier()
+    if classifier is classify_feedback:
+        return classify_feedback_async
+    return sync_to_async(classifier, thread_sensitive=False)
+
+
+def set_classifier(classifier):
+    """
+    Replace the classifier, e.g. with bot.utils.gpt4.stub_intention_classification
+    in tests. Passing None restores the configured one.
+    """
+    global _classifier
+    _classifier = classifier
+
+
+def _retry_delay(attempts):
+    # Seconds to wait before the next classification attempt, or None once
+    # settings.FEEDBACK_MAX_ATTEMPTS attempts have failed
+    if attempts >= settings.FEEDBACK_MAX_ATTEMPTS:
+        return None
+    logger.warning("Feedback classification failed (attempt %s), retrying", attempts, exc_info=True)
+    return settings.FEEDBACK_RETRY_BACKOFF * (2 ** (attempts - 1))
+
+
+def _rating_value(response):
+    # The rating of a classification result, or None if it isn't one
+    if not response or response.get('function_name') != "get_user_rating":
+        return None
+    return response['response']['rating']
+
+
+def process_feedback(user_id, order_id, user_message):
+    """
+    Classify a free-text message and store it as a rating of the order.
+
+    The classifier is retried with exponential backoff on errors (timeouts,
+    rate limits), up to settings.FEEDBACK_MAX_ATTEMPTS attempts.
+
+    Returns:
+    - The created Ratings object, or None if the message wasn't a rating.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            response = get_classifier()(user_message)
+            break
+        except Exception:
+            delay = _retry_delay(attempts)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+    rating_value = _rating_value(response)
+    if rating_value is None:
+        return None
+    return add_rating(user_id, order_id, rating_value, user_message)
+
+
+class FeedbackPipeline:
+    """
+    Runs process_feedback off the request thread.
+
+    At most `workers` jobs run at once and at most `max_pending` are
+    accepted (running or waiting); past that, submit() rejects new jobs so a
+    slow LLM can't pile up unbounded work in the web process.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        workers = workers or settings.FEEDBACK_WORKERS
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feedback")
+        self.slots = threading.BoundedSemaphore(max_pending or settings.FEEDBACK_MAX_PENDING)
+
+    def submit(self, user_id, order_id, user_message):
+        """
+        Schedule a feedback message for classification.
+
+        Returns:
+        - The Future of the job, or None if the pipeline is saturated.
+        """
+        if not self.slots.acquire(blocking=False):
+            logger.error("Feedback pipeline saturated, dropping feedback from user %s: %r", user_id, user_message)
+            return None
+        return self.executor.submit(self._run, user_id, order_id, user_message)
+
+    def _run(self, user_id, order_id, user_message):
+        close_old_connections()
+        try:
+            return process_feedback(user_id, order_id, user_message)
+        except Exception:
+            logger.exception("Could not process feedback from user %s", user_id)
+        finally:
+            close_old_connections()
+            self.slots.release()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline():
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = FeedbackPipeline()
+    return _pipeline
+
+
+def submit_feedback(user_id, order_id, user_message):
+    """
+    Hand a feedback message to the background pipeline, or process it in the
+    calling thread when settings.FEEDBACK_PIPELINE_MODE is "inline".
+    """
+    if settings.FEEDBACK_PIPELINE_MODE == "inline":
+        return process_feedback(user_id, order_id, user_message)
+    return get_pipeline().submit(user_id, order_id, user_message)
+
+
+# Async pipeline used by the ASGI webhook: classification awaits OpenAI on
+# the event loop instead of holding a thread, bounded by a semaphore per loop
+_async_slots = weakref.WeakKeyDictionary()
+_async_tasks = set()
+
+
+async def aprocess_feedback(user_id, order_id, user_message):
+    """
+    Async version of process_feedback, with the same retries plus a hard
+    timeout (settings.OPENAI_TIMEOUT) on each classification attempt.
+    """
+    classifier = _async_classifier()
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            response = await asyncio.wait_for(classifier(user_message), settings.OPENAI_TIMEOUT)
+            break
+        except Exception:
+            delay = _retry_delay(attempts)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+
+    rating_value = _rating_value(response)
+    if rating_value is None:
+        return None
+    return await sync_to_async(add_rating, thread_sensitive=False)(user_id, order_id, rating_value, user_message)
+
+
+async def _run_async(user_id, order_id, user_message, slots):
+    async with slots:
+        try:
+            return await aprocess_feedback(user_id, order_id, user_message)
+        except Exception:
+            logger.exception("Could not process feedback from user %s", user_id)
+
+
+def submit_feedback_async(user_id, order_id, user_message):
+    """
+    Schedule feedback classification as a task on the running event loop,
+    which must outlive the request (i.e. an ASGI server's loop).
+
+    At most settings.FEEDBACK_WORKERS classifications run at once per loop;
+    past settings.FEEDBACK_MAX_PENDING scheduled tasks new feedback is dropped.
+
+    Returns:
+    - The asyncio Task, or None if the pipeline is saturated.
+    """
+    loop = asyncio.get_running_loop()
+    slots = _async_slots.get(loop)
+    if slots is None:
+        slots = _async_slots[loop] = asyncio.Semaphore(settings.FEEDBACK_WORKERS)
+    if len(_async_tasks) >= settings.FEEDBACK_MAX_PENDING:
+        logger.error("Feedback pipeline saturated, dropping feedback from user %s: %r", user_id, user_message)
+        return None
+    task = loop.create_task(_run_async(user_id, order_id, user_message, slots))
+    # Keep a reference until the task is done, the loop only holds weak ones
+    _async_tasks.add(task)
+    task.add_done_callback(_async_tasks.discard)
+    return task
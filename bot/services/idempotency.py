@@ -0,0 +1,142 @@
+import itertools
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from bot.models import ProcessedMessages
+from bot.utils.cache import LRUCache
+from bot.utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+# Expired rows are purged on every PURGE_EVERY-th claim in a process
+PURGE_EVERY = 1000
+
+_cache = None
+_cache_lock = threading.Lock()
+_claims = itertools.count(1)
+
+
+def get_cache():
+    """
+    Return the in-process cache of recent results, which answers most
+    retries without a query.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(maxsize=settings.IDEMPOTENCY_CACHE_SIZE, ttl=settings.IDEMPOTENCY_TTL)
+                get_metrics().register_collector("idempotency_cache", _cache.stats)
+    return _cache
+
+
+def _claim(message_sid):
+    # Insert the pending row; the primary key makes exactly one delivery win
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            ProcessedMessages.objects.create(message_sid=message_sid, status=PENDING, created_at=now)
+        return True
+    except IntegrityError:
+        pass
+    # Take over a claim whose worker died, or a result past its TTL
+    stale = ProcessedMessages.objects.filter(
+        Q(status=PENDING, created_at__lt=now - timedelta(seconds=settings.IDEMPOTENCY_LEASE_SECONDS))
+        | Q(created_at__lt=now - timedelta(seconds=settings.IDEMPOTENCY_TTL)),
+        message_sid=message_sid,
+    )
+    return stale.update(status=PENDING, body=None, message=None, data=None, created_at=now) == 1
+
+
+def _wait_for_result(message_sid, timeout):
+    # Another delivery of this message is being handled; poll for its reply
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        row = ProcessedMessages.objects.filter(message_sid=message_sid).values_list(
+            "status", "body", "message", "data"
+        ).first()
+        if row is None:
+            # The first attempt failed and released its claim
+            return None
+        if row[0] == DONE:
+            return row[1:]
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def purge_expired(ttl=None):
+    """
+    Delete handled messages older than `ttl` seconds (default IDEMPOTENCY_TTL).
+
+    Returns:
+    - The number of rows deleted.
+    """
+    ttl = settings.IDEMPOTENCY_TTL if ttl is None else ttl
+    deleted, _ = ProcessedMessages.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+    return deleted
+
+
+def process_once(message_sid, handler):
+    """
+    Run `handler` once per MessageSid and replay its result for retries.
+
+    Twilio retries a webhook that answered slowly; the retry must not place
+    another order or classify the same feedback twice. The first delivery
+    claims the MessageSid in the processed_messages table, runs the handler
+    and stores its result. Later deliveries get that result from the
+    in-process cache or the table, and a delivery arriving while the first
+    is still running waits briefly for it.
+
+    Args:
+    - message_sid: Twilio's MessageSid, or None to skip deduplication.
+    - handler: Callable returning the (body, message, data) result.
+
+    Returns:
+    - Tuple of (result, duplicate). result is None for a duplicate whose
+      first delivery hasn't finished in time.
+    """
+    if not message_sid:
+        return handler(), False
+
+    cache = get_cache()
+    result = cache.get(message_sid)
+    if result is not None:
+        return result, True
+
+    if next(_claims) % PURGE_EVERY == 0:
+        try:
+            purge_expired()
+        except Exception:
+            logger.exception("Could not purge processed messages")
+
+    if not _claim(message_sid):
+        result = _wait_for_result(message_sid, settings.IDEMPOTENCY_WAIT_SECONDS)
+        if result is not None:
+            result = tuple(result)
+            cache.set(message_sid, result)
+        return result, True
+
+    try:
+        result = handler()
+    except BaseException:
+        # Let Twilio's retry have another go
+        ProcessedMessages.objects.filter(message_sid=message_sid, status=PENDING).delete()
+        raise
+    body, message, data = result
+    ProcessedMessages.objects.filter(message_sid=message_sid).update(
+        status=DONE, body=body, message=message, data=data
+    )
+    cache.set(message_sid, result)
+    return result, False
@@ -0,0 +1,63 @@
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+
+
+def normalize_order_times(Orders, batch_size=1000):
+    """
+    Rewrite text order_time values into ISO 8601 so they convert cleanly to
+    a timestamp column; values that can't be parsed are set to NULL.
+
+    Takes the Orders model as an argument so migrations can pass their
+    historical model.
+
+    Returns:
+    - The number of rows changed.
+    """
+    changed = 0
+    batch = []
+    for order_id, order_time in Orders.objects.exclude(order_time=None).values_list("id", "order_time").iterator():
+        parsed = parse_datetime(str(order_time).strip().replace("/", "-"))
+        normalized = parsed.isoformat(sep=" ") if parsed else None
+        if normalized != order_time:
+            batch.append(Orders(id=order_id, order_time=normalized))
+        if len(batch) >= batch_size:
+            Orders.objects.bulk_update(batch, ["order_time"])
+            changed += len(batch)
+            batch = []
+    if batch:
+        Orders.objects.bulk_update(batch, ["order_time"])
+        changed += len(batch)
+    return changed
+
+
+def backfill_latest_orders(Users, Orders, batch_size=1000):
+    """
+    Point every user's latest_order at their most recent order (by
+    order_time, then id), using the (user, order_time) index.
+
+    Takes the models as arguments so migrations can pass their historical
+    models.
+
+    Returns:
+    - The number of users updated.
+    """
+    updated = 0
+    batch = []
+    for user in Users.objects.only("id", "latest_order").iterator(chunk_size=batch_size):
+        latest_id = (
+            Orders.objects.filter(user_id=user.id)
+            .order_by(F("order_time").desc(nulls_last=True), "-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if latest_id != user.latest_order_id:
+            user.latest_order_id = latest_id
+            batch.append(user)
+        if len(batch) >= batch_size:
+            Users.objects.bulk_update(batch, ["latest_order"])
+            updated += len(batch)
+            batch = []
+    if batch:
+        Users.objects.bulk_update(batch, ["latest_order"])
+        updated += len(batch)
+    return updated
@@ -0,0 +1,329 @@
+import heapq
+import itertools
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from twilio.base.exceptions import TwilioRestException
+
+from bot.utils.metrics import get_metrics
+from bot.utils.rate_limit import TokenBucketRegistry
+from bot.utils.twilio import get_transport
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+# A claimed message waiting to be delivered
+OutboundMessage = namedtuple(
+    "OutboundMessage", ["id", "idempotency_key", "send_from", "send_to", "body", "attempts"]
+)
+
+
+class MemoryQueueBackend:
+    """
+    Process-local queue, intended for tests and single-process development.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._rows = {}
+        self._keys = {}
+        self._due = []  # heap of (next_attempt_at, id)
+
+    def enqueue(self, send_from, send_to, body, idempotency_key=None, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if idempotency_key is not None and idempotency_key in self._keys:
+                return False
+            message_id = next(self._ids)
+            self._rows[message_id] = {
+                "id": message_id,
+                "idempotency_key": idempotency_key,
+                "send_from": send_from,
+                "send_to": send_to,
+                "body": body,
+                "status": PENDING,
+                "attempts": 0,
+                "next_attempt_at": now,
+                "last_error": None,
+            }
+            if idempotency_key is not None:
+                self._keys[idempotency_key] = message_id
+            heapq.heappush(self._due, (now, message_id))
+            return True
+
+    def claim(self, limit, lease=60, now=None):
+        now = time.time() if now is None else now
+        claimed = []
+        with self._lock:
+            while self._due and self._due[0][0] <= now and len(claimed) < limit:
+                due_at, message_id = heapq.heappop(self._due)
+                row = self._rows[message_id]
+                # Stale heap entries are skipped; a row is only due once
+                if row["next_attempt_at"] != due_at or row["status"] not in (PENDING, SENDING):
+                    continue
+                row["status"] = SENDING
+                row["next_attempt_at"] = now + lease
+                heapq.heappush(self._due, (row["next_attempt_at"], message_id))
+                claimed.append(_to_message(row))
+        return claimed
+
+    def _update(self, message_id, **fields):
+        with self._lock:
+            row = self._rows[message_id]
+            row.update(fields)
+            if row["status"] == PENDING:
+                heapq.heappush(self._due, (row["next_attempt_at"], message_id))
+
+    def mark_sent(self, message_id):
+        self._update(message_id, status=SENT)
+
+    def mark_failed(self, message_id, attempts, error):
+        self._update(message_id, status=FAILED, attempts=attempts, last_error=error)
+
+    def reschedule(self, message_id, attempts, next_attempt_at, error=None):
+        self._update(message_id, status=PENDING, attempts=attempts, next_attempt_at=next_attempt_at, last_error=error)
+
+    def counts(self):
+        with self._lock:
+            result = {}
+            for row in self._rows.values():
+                result[row["status"]] = result.get(row["status"], 0) + 1
+            return result
+
+
+class SQLiteQueueBackend:
+    """
+    Persistent queue stored in a local SQLite file, shared by the web
+    workers (producers) and the sender worker (consumer).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbound_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT UNIQUE,
+                    send_from TEXT NOT NULL,
+                    send_to TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbound_messages_due "
+                "ON outbound_messages (status, next_attempt_at)"
+            )
+
+    def _connect(self):
+        # One connection per thread; WAL lets the web process keep enqueueing
+        # while the sender worker claims batches.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def enqueue(self, send_from, send_to, body, idempotency_key=None, now=None):
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO outbound_messages "
+                "(idempotency_key, send_from, send_to, body, status, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (idempotency_key, send_from, send_to, body, PENDING, now, now),
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, limit, lease=60, now=None):
+        # Messages stuck in "sending" past their lease (e.g. the worker died)
+        # become due again.
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, idempotency_key, send_from, send_to, body, attempts FROM outbound_messages "
+                "WHERE status IN (?, ?) AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (PENDING, SENDING, now, limit),
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE outbound_messages SET status = ?, next_attempt_at = ? WHERE id = ?",
+                    [(SENDING, now + lease, row[0]) for row in rows],
+                )
+        return [OutboundMessage(*row) for row in rows]
+
+    def mark_sent(self, message_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE outbound_messages SET status = ? WHERE id = ?", (SENT, message_id))
+
+    def mark_failed(self, message_id, attempts, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbound_messages SET status = ?, attempts = ?, last_error = ? WHERE id = ?",
+                (FAILED, attempts, error, message_id),
+            )
+
+    def reschedule(self, message_id, attempts, next_attempt_at, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbound_messages SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? "
+                "WHERE id = ?",
+                (PENDING, attempts, next_attempt_at, error, message_id),
+            )
+
+    def counts(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM outbound_messages GROUP BY status").fetchall())
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front so concurrent claimers
+    # never hand out the same row twice.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def _to_message(row):
+    return OutboundMessage(
+        row["id"], row["idempotency_key"], row["send_from"], row["send_to"], row["body"], row["attempts"]
+    )
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    Return the process-wide queue configured by settings.OUTBOUND_QUEUE_BACKEND.
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                if settings.OUTBOUND_QUEUE_BACKEND == "memory":
+                    _queue = MemoryQueueBackend()
+                else:
+                    _queue = SQLiteQueueBackend(settings.OUTBOUND_QUEUE_PATH)
+                # Messages per status, e.g. bot_outbound_messages{status="pending"}
+                get_metrics().register_collector(
+                    "outbound",
+                    lambda: {status: {"messages": count} for status, count in _queue.counts().items()},
+                    label="status",
+                )
+    return _queue
+
+
+def enqueue_whatsapp_message(send_from, send_to, body, idempotency_key=None):
+    """
+    Queue a WhatsApp message for the sender worker.
+
+    Args:
+    - send_from, send_to: WhatsApp numbers, e.g. 'whatsapp:+14155238886'.
+    - body: The message text.
+    - idempotency_key: Optional key; a second message with the same key is dropped.
+
+    Returns:
+    - True if the message was queued, False if it was a duplicate.
+    """
+    return get_queue().enqueue(send_from, send_to, body, idempotency_key)
+
+
+def is_retryable(exc):
+    # Client errors from Twilio (bad number, unverified sender, ...) won't
+    # succeed on retry; throttling (429) and server errors might.
+    if isinstance(exc, TwilioRestException):
+        return exc.status == 429 or exc.status >= 500
+    return True
+
+
+class OutboundSender:
+    """
+    Drains the outbound queue with a pool of threads.
+
+    Each sender number has its own token bucket, so a burst to one number
+    can't exceed Twilio's per-sender throughput. Failed sends are retried
+    with exponential backoff until `max_attempts` is reached.
+    """
+
+    def __init__(self, queue=None, transport=None, concurrency=None, rate_per_sender=None,
+                 max_attempts=None, backoff=None, lease=60):
+        self.queue = queue or get_queue()
+        self.transport = transport or get_transport()
+        self.concurrency = concurrency or settings.OUTBOUND_SENDER_CONCURRENCY
+        self.max_attempts = max_attempts or settings.OUTBOUND_MAX_ATTEMPTS
+        self.backoff = settings.OUTBOUND_RETRY_BACKOFF if backoff is None else backoff
+        self.lease = lease
+        self.buckets = TokenBucketRegistry(rate_per_sender or settings.OUTBOUND_RATE_PER_SENDER)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbound")
+
+    def deliver(self, message):
+        bucket = self.buckets.get(message.send_from)
+        if not bucket.consume():
+            # Over the sender's rate: put it back without counting an attempt
+            self.queue.reschedule(message.id, message.attempts, time.time() + bucket.wait_time())
+            return False
+
+        try:
+            with get_metrics().external_call("twilio", "send"):
+                self.transport.send(message.send_from, message.send_to, message.body)
+        except Exception as exc:
+            attempts = message.attempts + 1
+            if attempts >= self.max_attempts or not is_retryable(exc):
+                logger.error("Giving up on outbound message %s after %s attempts: %s", message.id, attempts, exc)
+                self.queue.mark_failed(message.id, attempts, str(exc))
+            else:
+                delay = self.backoff * (2 ** (attempts - 1))
+                delay += random.uniform(0, delay / 2)  # jitter so retries don't align
+                self.queue.reschedule(message.id, attempts, time.time() + delay, str(exc))
+            return False
+
+        self.queue.mark_sent(message.id)
+        return True
+
+    def run_once(self, batch_size=None):
+        """
+        Claim one batch of due messages and deliver them concurrently.
+
+        Returns:
+        - The number of messages claimed.
+        """
+        batch = self.queue.claim(batch_size or self.concurrency * 4, lease=self.lease)
+        list(self.executor.map(self.deliver, batch))
+        return len(batch)
+
+    def run_forever(self, idle_sleep=0.5):
+        while True:
+            if not self.run_once():
+                time.sleep(idle_sleep)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
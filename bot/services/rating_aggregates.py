@@ -0,0 +1,186 @@
+from django.db import connections, router, transaction
+from django.db.models import Case, F, Q, Value, When
+
+from bot.models import OrderDishes, Orders, RatingAggregates, Ratings
+
+USER = "user"
+DISH = "dish"
+CHEF = "chef"
+COURSE = "course"
+DIMENSIONS = (USER, DISH, CHEF, COURSE)
+
+
+def aggregate_keys(user_id, lines):
+    """
+    List the (dimension, key) pairs a rating counts towards.
+
+    A rating applies to the user and, once each, to every distinct dish,
+    chef and course on the rated order.
+
+    Parameters:
+    - user_id: The rating user's id.
+    - lines: (dish_id, chef_name, course) tuples of the order's dishes.
+    """
+    keys = {(USER, str(user_id))}
+    for dish_id, chef_name, course in lines:
+        keys.add((DISH, str(dish_id)))
+        if chef_name:
+            keys.add((CHEF, chef_name))
+        if course:
+            keys.add((COURSE, course))
+    return sorted(keys)
+
+
+def _order_lines(order_id):
+    # The order's (dish_id, chef_name, course) lines and its order time,
+    # read with the lines when it has any
+    rows = list(
+        OrderDishes.objects.filter(order_id=order_id).values_list(
+            "dish_id", "dish__chef_name", "dish__course", "order__order_time"
+        )
+    )
+    if not rows:
+        return [], Orders.objects.filter(pk=order_id).values_list("order_time", flat=True).first()
+    return [row[:3] for row in rows], rows[0][3]
+
+
+def apply_rating(user_id, order_id, rating_value):
+    """
+    Add a new rating to the running totals of every key it counts towards.
+
+    Call it in the transaction inserting the rating, so the totals never
+    disagree with the Ratings table. On PostgreSQL and SQLite all keys are
+    updated by one INSERT ... ON CONFLICT DO UPDATE statement.
+
+    Ratings don't record when they were given, so last_rated_at is the
+    time of the most recent rated order, as rebuild() computes it.
+    """
+    lines, order_time = _order_lines(order_id)
+    keys = aggregate_keys(user_id, lines)
+    alias = router.db_for_write(RatingAggregates)
+    connection = connections[alias]
+
+    if connection.vendor in ("postgresql", "sqlite"):
+        table = connection.ops.quote_name(RatingAggregates._meta.db_table)
+        key_column = connection.ops.quote_name("key")
+        values = ", ".join(["(%s, %s, %s, 1, %s)"] * len(keys))
+        params = []
+        for dimension, key in keys:
+            params += [dimension, key, rating_value, connection.ops.adapt_datetimefield_value(order_time)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (dimension, {key_column}, rating_sum, rating_count, last_rated_at) "
+                f"VALUES {values} ON CONFLICT (dimension, {key_column}) DO UPDATE SET "
+                f"rating_sum = {table}.rating_sum + EXCLUDED.rating_sum, "
+                f"rating_count = {table}.rating_count + EXCLUDED.rating_count, "
+                f"last_rated_at = CASE WHEN {table}.last_rated_at IS NULL "
+                f"OR EXCLUDED.last_rated_at > {table}.last_rated_at "
+                f"THEN EXCLUDED.last_rated_at ELSE {table}.last_rated_at END",
+                params,
+            )
+        return
+
+    for dimension, key in keys:
+        updates = {"rating_sum": F("rating_sum") + rating_value, "rating_count": F("rating_count") + 1}
+        if order_time is not None:
+            updates["last_rated_at"] = Case(
+                When(Q(last_rated_at__isnull=True) | Q(last_rated_at__lt=order_time), then=Value(order_time)),
+                default=F("last_rated_at"),
+            )
+        updated = RatingAggregates.objects.filter(dimension=dimension, key=key).update(**updates)
+        if not updated:
+            RatingAggregates.objects.create(
+                dimension=dimension, key=key, rating_sum=rating_value, rating_count=1, last_rated_at=order_time
+            )
+
+
+def _scan_ratings(chunk_size):
+    # Totals per (dimension, key) from one pass over ratings joined to their
+    # order lines, grouped by rating
+    totals = {}
+
+    def add(rating):
+        user_id, rating_value, order_time, lines = rating
+        for dimension_key in aggregate_keys(user_id, lines):
+            total = totals.setdefault(dimension_key, [0, 0, None])
+            total[0] += rating_value
+            total[1] += 1
+            if order_time is not None and (total[2] is None or order_time > total[2]):
+                total[2] = order_time
+
+    rows = (
+        Ratings.objects.filter(rating__isnull=False, user__isnull=False)
+        .order_by("id")
+        .values_list("id", "user_id", "rating", "order__order_time",
+                     "order__lines__dish_id", "order__lines__dish__chef_name", "order__lines__dish__course")
+        .iterator(chunk_size=chunk_size)
+    )
+    current_id, current = None, None
+    for rating_id, user_id, rating_value, order_time, dish_id, chef_name, course in rows:
+        if rating_id != current_id:
+            if current is not None:
+                add(current)
+            current_id, current = rating_id, (user_id, rating_value, order_time, [])
+        if dish_id is not None:
+            current[3].append((dish_id, chef_name, course))
+    if current is not None:
+        add(current)
+    return totals
+
+
+def rebuild(batch_size=1000, chunk_size=10000):
+    """
+    Recompute every aggregate from the Ratings table, e.g. to backfill.
+
+    The old rows are deleted before the scan, in the same transaction, so a
+    rating added meanwhile waits for the rebuild and is then applied on top
+    of it instead of being lost. PostgreSQL also gets the table locked, as
+    its row locks wouldn't stop new keys being inserted.
+
+    Returns:
+    - The number of aggregate rows written.
+    """
+    alias = router.db_for_write(RatingAggregates)
+    connection = connections[alias]
+    with transaction.atomic(using=alias):
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                table = connection.ops.quote_name(RatingAggregates._meta.db_table)
+                cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+        RatingAggregates.objects.all().delete()
+        totals = _scan_ratings(chunk_size)
+        RatingAggregates.objects.bulk_create(
+            [
+                RatingAggregates(
+                    dimension=dimension, key=key, rating_sum=rating_sum, rating_count=rating_count,
+                    last_rated_at=last_rated_at,
+                )
+                for (dimension, key), (rating_sum, rating_count, last_rated_at) in totals.items()
+            ],
+            batch_size=batch_size,
+        )
+    return len(totals)
+
+
+def get_summary(dimension, key):
+    """
+    Read the rating summary of one user, dish, chef or course.
+
+    Returns:
+    - Dict with sum, count, average and last_rated_at, or None if it was
+      never rated.
+    """
+    row = (
+        RatingAggregates.objects.filter(dimension=dimension, key=str(key))
+        .values_list("rating_sum", "rating_count", "last_rated_at")
+        .first()
+    )
+    if row is None or not row[1]:
+        return None
+    rating_sum, rating_count, last_rated_at = row
+    return {
+        "sum": rating_sum,
+        "count": rating_count,
+        "average": rating_sum / rating_count,
+        "last_rated_at": last_rated_at,
+    }
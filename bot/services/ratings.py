@@ -0,0 +1,69 @@
+from django.db import transaction
+from django.db.models import F, Q
+
+from bot.models import Ratings
+from bot.services import conversation_state, rating_aggregates, snowflake_service
+
+
+def add_rating(user_id, order_id, rating_value, feedback):
+    """
+    Insert a new rating row into the Ratings table, updating the rating
+    aggregates in the same transaction.
+
+    Parameters:
+    - user_id: The id of the user giving the rating.
+    - order_id: The id of the rated order.
+    - rating_value: The numerical rating value (0-10).
+    - feedback: The text feedback from the user.
+
+    Returns:
+    - The created Ratings object.
+    """
+    rating = Ratings(user_id=user_id, order_id=order_id, rating=rating_value, original_feedback=feedback)
+    with transaction.atomic():
+        rating.save()
+        rating_aggregates.apply_rating(user_id, order_id, rating_value)
+    conversation_state.record_rating(user_id, order_id)
+    snowflake_service.record(rating)
+    return rating
+
+
+def ratings_page(user_id, cursor=None, page_size=10):
+    """
+    Read one page of a user's ratings, newest order first.
+
+    Keyset pagination on (order time, rating id): each page starts right
+    after the last row of the previous one, so page N costs the same as
+    page 1 and rows are neither skipped nor repeated when ratings are added
+    between pages. Ratings of orders without a time come last.
+
+    Parameters:
+    - user_id: The user's id.
+    - cursor: The cursor returned with the previous page, or None for the first page.
+    - page_size: Ratings per page.
+
+    Returns:
+    - Tuple of (rows, next cursor or None after the last page). Rows are
+      (order_time, order_status, rating, original_feedback) tuples.
+    """
+    queryset = Ratings.objects.filter(user_id=user_id)
+    if cursor is not None:
+        order_time, rating_id = cursor
+        if order_time is None:
+            queryset = queryset.filter(order__order_time__isnull=True, id__lt=rating_id)
+        else:
+            queryset = queryset.filter(
+                Q(order__order_time__lt=order_time)
+                | Q(order__order_time=order_time, id__lt=rating_id)
+                | Q(order__order_time__isnull=True)
+            )
+    rows = list(
+        queryset.order_by(F("order__order_time").desc(nulls_last=True), "-id").values_list(
+            "order__order_time", "id", "order__order_status", "rating", "original_feedback"
+        )[: page_size + 1]
+    )
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1][0], rows[-1][1])
+    return [(order_time, status, rating, feedback) for order_time, _, status, rating, feedback in rows], next_cursor
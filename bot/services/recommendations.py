@@ -0,0 +1,433 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from array import array
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from scipy import sparse
+
+from bot.models import Dishes, Ratings
+
+logger = logging.getLogger(__name__)
+
+# Ratings run from 0 to 10; centring on the midpoint makes poor ratings
+# count against similar dishes instead of merely less in their favour
+RATING_MIDPOINT = 5.0
+# Weight of the global mean in the popularity ranking, in ratings
+POPULARITY_PRIOR = 5.0
+
+_TAG_SPLIT_RE = re.compile(r"[\s,;/|]+")
+
+
+def split_dietaries(value):
+    """
+    Split a dietaries string such as 'Vegan, GF' into lower-case tags.
+    """
+    return frozenset(tag for tag in _TAG_SPLIT_RE.split((value or "").lower()) if tag)
+
+
+def load_ratings(chunk_size=10000):
+    """
+    Stream every rated (user, dish, rating) triple into NumPy arrays.
+
+    An order's rating applies to each dish on it.
+
+    Returns:
+    - Tuple of (user_ids, dish_ids, ratings) arrays of equal length.
+    """
+    users, dishes, ratings = array("q"), array("q"), array("d")
+    rows = (
+        Ratings.objects.filter(rating__isnull=False, user__isnull=False, order__lines__dish__isnull=False)
+        .order_by()
+        .values_list("user_id", "order__lines__dish_id", "rating")
+        .iterator(chunk_size=chunk_size)
+    )
+    for user_id, dish_id, rating in rows:
+        users.append(user_id)
+        dishes.append(dish_id)
+        ratings.append(rating)
+    return (
+        np.frombuffer(users, dtype=np.int64),
+        np.frombuffer(dishes, dtype=np.int64),
+        np.frombuffer(ratings, dtype=np.float64),
+    )
+
+
+def rating_matrix(user_ids, dish_ids, ratings, catalog_ids):
+    """
+    Build the sparse user x dish matrix of mean centred ratings.
+
+    Args:
+    - user_ids, dish_ids, ratings: Parallel arrays, see load_ratings().
+    - catalog_ids: Sorted array of the dish ids making up the columns.
+      Ratings of dishes not in it are dropped.
+
+    Returns:
+    - Tuple of (row user ids, CSR matrix). A dish rated several times by
+      the same user gets the mean of those ratings.
+    """
+    columns = np.searchsorted(catalog_ids, dish_ids)
+    columns = np.minimum(columns, max(len(catalog_ids) - 1, 0))
+    known = (catalog_ids[columns] == dish_ids) if len(catalog_ids) else np.zeros(len(dish_ids), dtype=bool)
+    rated_users, rows = np.unique(user_ids[known], return_inverse=True)
+    shape = (len(rated_users), len(catalog_ids))
+    columns = columns[known]
+    totals = sparse.csr_matrix((ratings[known], (rows, columns)), shape=shape)
+    counts = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=shape)
+    # Same sparsity structure, so the data arrays line up element for element
+    matrix = totals.copy()
+    matrix.data = totals.data / counts.data - RATING_MIDPOINT
+    # A rating exactly at the midpoint still marks the dish as tried
+    matrix.data[matrix.data == 0] = 1e-6
+    return rated_users, matrix
+
+
+def item_similarity(matrix):
+    """
+    Cosine similarity between the dish columns of `matrix`, as a sparse
+    dish x dish matrix with an empty diagonal.
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    normalized = matrix @ sparse.diags(inverse)
+    similarity = (normalized.T @ normalized).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    return similarity
+
+
+def popularity_ranking(matrix, catalog_ids):
+    """
+    Rank every catalog dish by its shrunk mean rating, the cold-start list.
+
+    Dishes with few ratings are pulled towards the global mean, so one
+    enthusiastic rating doesn't put a dish at the top.
+    """
+    counts = np.diff(matrix.tocsc().indptr).astype(np.float64)
+    totals = np.asarray(matrix.sum(axis=0)).ravel()
+    global_mean = totals.sum() / counts.sum() if counts.sum() else 0.0
+    scores = (totals + POPULARITY_PRIOR * global_mean) / (counts + POPULARITY_PRIOR)
+    # Stable sort keeps unrated dishes in id order behind the rated ones
+    return catalog_ids[np.argsort(-scores, kind="stable")]
+
+
+# Dense arrays of chunk rows x dishes alive at once while a chunk is
+# ranked: the float64 scores, their negation and the argpartition indices
+_CHUNK_ARRAYS = 3
+
+
+def top_candidates(matrix, similarity, catalog_ids, top_n, memory_budget=None):
+    """
+    Score every dish for every user and keep the best `top_n` unrated ones.
+
+    A user's score for a dish is the sum of their centred ratings weighted
+    by each rated dish's similarity to it. Scores of a block of users are
+    densified to rank them, so users are scored as many rows at a time as
+    fit in `memory_budget` bytes (RECOMMENDATIONS_MEMORY_BUDGET by
+    default); a larger menu means smaller blocks.
+
+    Returns:
+    - Array of shape (users, top_n) of dish ids, best first, padded with -1
+      when a user has fewer positively scored dishes.
+    """
+    memory_budget = memory_budget or settings.RECOMMENDATIONS_MEMORY_BUDGET
+    top = np.full((matrix.shape[0], top_n), -1, dtype=np.int64)
+    if not matrix.shape[1]:
+        return top
+    keep = min(top_n, matrix.shape[1])
+    chunk_size = max(1, memory_budget // (matrix.shape[1] * 8 * _CHUNK_ARRAYS))
+    for start in range(0, matrix.shape[0], chunk_size):
+        block = matrix[start:start + chunk_size]
+        scores = (block @ similarity).toarray()
+        # Don't recommend what the user already rated, nor anything the
+        # similarities argue against
+        scores[block.nonzero()] = -np.inf
+        scores[scores <= 0] = -np.inf
+        best = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        ids = catalog_ids[best]
+        ids[~np.isfinite(best_scores)] = -1
+        top[start:start + len(ids), :keep] = ids
+    return top
+
+
+def _catalog_rows():
+    return list(Dishes.objects.order_by("id").values_list("id", "dish_name", "course", "price", "dietaries"))
+
+
+def _dish(dish_id, name, course, price, dietaries):
+    return {
+        "id": int(dish_id),
+        "name": str(name or ""),
+        "course": str(course or ""),
+        "price": str(price),
+        "dietaries": split_dietaries(str(dietaries or "")),
+    }
+
+
+def build_index(path=None, top_n=None):
+    """
+    Build the recommendation index from all ratings and write it to `path`.
+
+    The file is written next to the target and moved into place, so
+    running workers never read a half-written index.
+
+    Returns:
+    - Dict of counts describing the build.
+    """
+    path = path or settings.RECOMMENDATIONS_PATH
+    top_n = top_n or settings.RECOMMENDATIONS_TOP_N
+
+    catalog = _catalog_rows()
+    catalog_ids = np.array([row[0] for row in catalog], dtype=np.int64)
+    user_ids, dish_ids, ratings = load_ratings()
+    rated_users, matrix = rating_matrix(user_ids, dish_ids, ratings, catalog_ids)
+    similarity = item_similarity(matrix)
+    top = top_candidates(matrix, similarity, catalog_ids, top_n)
+    popular = popularity_ranking(matrix, catalog_ids)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            np.savez(
+                handle,
+                user_ids=rated_users.astype(np.int64),
+                top=top,
+                popular=popular,
+                dish_ids=catalog_ids,
+                dish_names=np.array([row[1] or "" for row in catalog], dtype=str),
+                dish_courses=np.array([row[2] or "" for row in catalog], dtype=str),
+                dish_prices=np.array([str(row[3]) for row in catalog], dtype=str),
+                dish_dietaries=np.array([row[4] or "" for row in catalog], dtype=str),
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return {
+        "users": len(rated_users),
+        "dishes": len(catalog_ids),
+        "ratings": len(ratings),
+        "similar_pairs": similarity.nnz,
+    }
+
+
+def popularity_index():
+    """
+    Build a RecommendationIndex holding only the popularity ranking, from
+    the database, for when no index has been built yet. Everyone gets the
+    same popular dishes.
+    """
+    catalog = _catalog_rows()
+    catalog_ids = np.array([row[0] for row in catalog], dtype=np.int64)
+    _, matrix = rating_matrix(*load_ratings(), catalog_ids)
+    return RecommendationIndex(
+        np.empty(0, dtype=np.int64),
+        np.empty((0, 0), dtype=np.int64),
+        popularity_ranking(matrix, catalog_ids),
+        {row[0]: _dish(*row) for row in catalog},
+    )
+
+
+class RecommendationIndex:
+    """
+    Read side of the index written by build_index().
+
+    Every lookup is a dict access plus a walk over a short candidate list;
+    users without personal candidates, or whose dietary filter removes
+    them, are topped up from the popularity ranking. The ranking is also
+    kept per dietary tag, so a filter matching a handful of dishes walks
+    those instead of the whole menu.
+    """
+
+    def __init__(self, user_ids, top, popular, dishes):
+        self._rows = {int(user_id): row for row, user_id in enumerate(user_ids)}
+        self._top = top
+        self._popular = popular
+        self._dishes = dishes
+        by_tag = {}
+        for dish_id in popular:
+            dish = dishes.get(int(dish_id))
+            for tag in dish["dietaries"] if dish is not None else ():
+                by_tag.setdefault(tag, array("q")).append(int(dish_id))
+        self._popular_by_tag = by_tag
+
+    @property
+    def tags(self):
+        # Every dietary tag carried by some dish
+        return self._popular_by_tag.keys()
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.int64), np.empty(0, dtype=np.int64), {})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            dishes = {
+                int(row[0]): _dish(*row)
+                for row in zip(
+                    data["dish_ids"], data["dish_names"], data["dish_courses"],
+                    data["dish_prices"], data["dish_dietaries"],
+                )
+            }
+            return cls(data["user_ids"], data["top"], data["popular"], dishes)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _candidates(self, user_id, wanted):
+        row = self._rows.get(user_id)
+        if row is not None:
+            for dish_id in self._top[row]:
+                if dish_id < 0:
+                    break
+                yield int(dish_id)
+        if wanted:
+            # Only dishes carrying the rarest wanted tag can match
+            popular = min((self._popular_by_tag[tag] for tag in wanted), key=len)
+        else:
+            popular = self._popular
+        for dish_id in popular:
+            yield int(dish_id)
+
+    def recommend(self, user_id, k=3, dietaries=()):
+        """
+        Return up to k dish dicts for the user.
+
+        Args:
+        - user_id: The user's id.
+        - k: Number of dishes wanted.
+        - dietaries: Tags every returned dish must carry, e.g. {"vegan"}.
+          Tags no dish carries, such as the "something" of "something
+          spicy", are ignored.
+        """
+        wanted = frozenset(tag.lower() for tag in dietaries) & self.tags
+        seen = set()
+        result = []
+        for dish_id in self._candidates(user_id, wanted):
+            dish = self._dishes.get(dish_id)
+            if dish is None or dish_id in seen or not wanted <= dish["dietaries"]:
+                continue
+            seen.add(dish_id)
+            result.append(dish)
+            if len(result) == k:
+                break
+        return result
+
+
+class IndexLoader:
+    """
+    Keeps the current RecommendationIndex loaded.
+
+    The index is loaded when the loader starts; after that a background
+    thread stats the file every `refresh_interval` seconds and reloads it
+    when its modification time changes, so requests never wait on a load.
+    Until an index has been built, the popularity ranking computed from the
+    database stands in for it.
+    """
+
+    def __init__(self, path=None, refresh_interval=None):
+        self.path = path or settings.RECOMMENDATIONS_PATH
+        self.refresh_interval = (
+            settings.RECOMMENDATIONS_REFRESH_SECONDS if refresh_interval is None else refresh_interval
+        )
+        self._index = RecommendationIndex.empty()
+        self._mtime = None
+        self._fallback = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """
+        Load the index file if it changed since the last load, or the
+        popularity fallback if there is no file and nothing was loaded yet.
+
+        Returns:
+        - True if the index was replaced.
+        """
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                if self._mtime is not None or self._fallback:
+                    return False
+                self._index = popularity_index()
+                self._fallback = True
+                return True
+            if mtime == self._mtime:
+                return False
+            try:
+                self._index = RecommendationIndex.load(self.path)
+                self._mtime = mtime
+            except Exception:
+                logger.exception("Could not load recommendation index %s", self.path)
+                return False
+            return True
+
+    def invalidate(self):
+        # Reload on the next refresh, even if the file looks unchanged
+        with self._lock:
+            self._mtime = None
+            self._fallback = False
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Could not refresh the recommendation index")
+            finally:
+                # This thread's connections would otherwise stay open
+                connections.close_all()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Could not load the recommendation index")
+        if self.refresh_interval:
+            self._thread = threading.Thread(target=self._run, name="recommendation-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self):
+        return self._index
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Return the process-wide recommendation index, loading it and starting
+    its refresh thread on first use (so after a pre-forking server has
+    forked the worker).
+    """
+    global _loader
+    if _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                loader = IndexLoader()
+                loader.start()
+                _loader = loader
+    return _loader.get()
+
+
+def recommend_dishes(user_id, k=3, dietaries=()):
+    return get_index().recommend(user_id, k=k, dietaries=dietaries)
@@ -0,0 +1,292 @@
+import atexit
+import csv
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from bot.utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _delete_rows(cursor, model, rows):
+    # Rows may be sent more than once (write-behind plus the sync job, or a
+    # re-scanned window), so every load replaces the rows it carries
+    table = model._meta.db_table
+    placeholders = ", ".join(["%s"] * len(rows))
+    cursor.execute(f"DELETE FROM {table} WHERE {model._meta.pk.column} IN ({placeholders})", [row.pk for row in rows])
+
+
+class BulkInsertBackend:
+    """
+    Writes a batch as one multi-row INSERT through the ORM on `alias`,
+    replacing any rows with the same primary keys in the same transaction.
+
+    Pointing `alias` at a SQLite database gives a local stand-in for
+    Snowflake.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or settings.SNOWFLAKE_DB_ALIAS
+
+    def write(self, model, rows):
+        with transaction.atomic(using=self.alias):
+            with connections[self.alias].cursor() as cursor:
+                _delete_rows(cursor, model, rows)
+            model.objects.using(self.alias).bulk_create(rows, batch_size=len(rows))
+
+
+class StagedCopyBackend:
+    """
+    Loads a batch the way Snowflake prefers bulk data: the rows are written
+    to a local CSV file, PUT into the table's internal stage and loaded with
+    COPY INTO, which is far cheaper than row-by-row or large VALUES inserts.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or settings.SNOWFLAKE_DB_ALIAS
+
+    def write(self, model, rows):
+        table = model._meta.db_table
+        columns = [field.column for field in model._meta.concrete_fields]
+        attnames = [field.attname for field in model._meta.concrete_fields]
+        fd, path = tempfile.mkstemp(prefix=f"{table}_", suffix=".csv")
+        try:
+            with os.fdopen(fd, "w", newline="") as handle:
+                writer = csv.writer(handle)
+                for row in rows:
+                    writer.writerow(["" if getattr(row, name) is None else getattr(row, name) for name in attnames])
+            with transaction.atomic(using=self.alias), connections[self.alias].cursor() as cursor:
+                _delete_rows(cursor, model, rows)
+                cursor.execute(f"PUT file://{path} @%{table} AUTO_COMPRESS=TRUE OVERWRITE=TRUE")
+                cursor.execute(
+                    f"COPY INTO {table} ({', '.join(columns)}) FROM @%{table} "
+                    f"FILES = ('{os.path.basename(path)}.gz') "
+                    "FILE_FORMAT = (TYPE = CSV FIELD_OPTIONALLY_ENCLOSED_BY = '\"' NULL_IF = ('')) PURGE = TRUE"
+                )
+        finally:
+            os.remove(path)
+
+
+class MemoryBackend:
+    # Keeps written batches in memory, for tests
+    def __init__(self):
+        self.batches = []
+
+    def write(self, model, rows):
+        self.batches.append((model, list(rows)))
+
+
+_backends = {
+    "insert": BulkInsertBackend,
+    "stage": StagedCopyBackend,
+    "memory": MemoryBackend,
+}
+
+
+def get_backend(name=None):
+    """
+    Build the load backend named by settings.SNOWFLAKE_LOAD_BACKEND
+    ("insert", "stage" or "memory").
+    """
+    return _backends[name or settings.SNOWFLAKE_LOAD_BACKEND]()
+
+
+class SnowflakeBatchWriter:
+    """
+    Write-behind buffer for rows headed to Snowflake.
+
+    Rows are grouped per model and flushed as one batch when a model has
+    `max_rows` pending, or once the oldest pending row is `max_age` seconds
+    old. Both flushes run on the background thread, never on the thread
+    adding the row, and write at most `max_rows` rows per batch. A failed
+    batch stays buffered and is retried on the next flush, but at most
+    `max_pending` rows are kept per model: during a long Snowflake outage
+    the oldest are dropped (counted in metrics()) and left to the sync job,
+    which pushes every table anyway.
+
+    `flush_hooks` are called as hook(model, row_count, seconds, error) after
+    every flush attempt; metrics() returns running counters.
+    """
+
+    def __init__(self, backend=None, max_rows=None, max_age=None, max_pending=None):
+        self.backend = backend or get_backend()
+        self.max_rows = max_rows or settings.SNOWFLAKE_BATCH_MAX_ROWS
+        self.max_age = settings.SNOWFLAKE_BATCH_MAX_AGE if max_age is None else max_age
+        self.max_pending = max_pending or self.max_rows * settings.SNOWFLAKE_BATCH_MAX_PENDING_BATCHES
+        self.flush_hooks = []
+        self._buffers = {}
+        self._first_added = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self._stopped = threading.Event()
+        # Set to wake the background thread early, e.g. for a full buffer
+        self._wake = threading.Event()
+        self._metrics = {
+            "rows_buffered": 0,
+            "rows_written": 0,
+            "batches_written": 0,
+            "failed_flushes": 0,
+            "rows_dropped": 0,
+            "last_flush_seconds": 0.0,
+        }
+
+    def add(self, obj):
+        """
+        Buffer a saved model instance for loading into Snowflake.
+        """
+        model = type(obj)
+        with self._lock:
+            buffer = self._buffers.setdefault(model, [])
+            if not buffer:
+                self._first_added[model] = time.monotonic()
+            buffer.append(obj)
+            self._metrics["rows_buffered"] += 1
+            self._trim(model, buffer)
+            full = len(buffer) >= self.max_rows
+        if full:
+            if self._timer is not None:
+                self._wake.set()
+            else:
+                # Not started, so no thread to hand the flush to
+                self.flush(model)
+
+    def _take(self, model):
+        with self._lock:
+            rows = self._buffers.pop(model, [])
+            self._first_added.pop(model, None)
+            return rows
+
+    def _trim(self, model, buffer):
+        # Called with self._lock held
+        over = len(buffer) - self.max_pending
+        if over > 0:
+            del buffer[:over]
+            self._metrics["rows_dropped"] += over
+            logger.warning("Dropped %s pending %s rows, left to the sync job", over, model._meta.db_table)
+
+    def _restore(self, model, rows):
+        with self._lock:
+            buffer = self._buffers[model] = rows + self._buffers.get(model, [])
+            self._first_added[model] = time.monotonic()
+            self._trim(model, buffer)
+
+    def flush(self, model=None):
+        """
+        Write the pending rows of `model`, or of every model.
+
+        Returns:
+        - The number of rows written.
+        """
+        models = [model] if model is not None else list(self._buffers)
+        written = 0
+        with self._flush_lock:
+            for current in models:
+                pending = self._take(current)
+                for offset in range(0, len(pending), self.max_rows):
+                    rows = pending[offset:offset + self.max_rows]
+                    start = time.perf_counter()
+                    error = None
+                    try:
+                        self.backend.write(current, rows)
+                    except Exception as exc:
+                        error = exc
+                        self._restore(current, pending[offset:])
+                        logger.exception("Could not load %s %s rows into Snowflake", len(rows), current._meta.db_table)
+                    elapsed = time.perf_counter() - start
+                    with self._lock:
+                        self._metrics["last_flush_seconds"] = elapsed
+                        if error is None:
+                            self._metrics["rows_written"] += len(rows)
+                            self._metrics["batches_written"] += 1
+                            written += len(rows)
+                        else:
+                            self._metrics["failed_flushes"] += 1
+                    for hook in self.flush_hooks:
+                        hook(current, len(rows), elapsed, error)
+                    if error is not None:
+                        break
+        return written
+
+    def flush_due(self):
+        # Flush the models that have max_rows pending or whose oldest pending
+        # row is older than max_age
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                model for model, added in self._first_added.items()
+                if now - added >= self.max_age or len(self._buffers.get(model, ())) >= self.max_rows
+            ]
+        for model in due:
+            self.flush(model)
+
+    def start(self, interval=None):
+        """
+        Start the background thread flushing batches by age.
+        """
+        if self._timer is not None:
+            return
+        interval = interval or max(self.max_age / 2, 0.1)
+
+        def run():
+            while not self._stopped.is_set():
+                self._wake.wait(interval)
+                self._wake.clear()
+                if self._stopped.is_set():
+                    break
+                try:
+                    self.flush_due()
+                except Exception:
+                    logger.exception("Snowflake batch flush failed")
+
+        self._timer = threading.Thread(target=run, name="snowflake-writer", daemon=True)
+        self._timer.start()
+
+    def stop(self):
+        # Stop the timer and write whatever is still buffered
+        self._stopped.set()
+        self._wake.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["rows_pending"] = sum(len(rows) for rows in self._buffers.values())
+        return metrics
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Return the process-wide writer, started on first use and flushed at exit.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = SnowflakeBatchWriter()
+                _writer.start()
+                get_metrics().register_collector("snowflake_writer", _writer.metrics)
+                atexit.register(_writer.stop)
+    return _writer
+
+
+def record(obj):
+    """
+    Queue a freshly written row for Snowflake when write-behind is enabled
+    (settings.SNOWFLAKE_WRITE_BEHIND); otherwise the sync job picks it up.
+    """
+    if settings.SNOWFLAKE_WRITE_BEHIND and settings.SNOWFLAKE_DB_ALIAS in settings.DATABASES:
+        get_writer().add(obj)
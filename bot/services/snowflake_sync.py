@@ -0,0 +1,143 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from bot.models import Dishes, OrderDishes, Orders, Ratings, SyncCursors, Users
+from bot.services.dish_catalog import dishes_changed
+from bot.services.snowflake_service import get_backend
+
+logger = logging.getLogger(__name__)
+
+# Tables copied from the OLTP database to Snowflake, parents first so the
+# warehouse never sees a row before the row it references
+PUSH_MODELS = [Users, Orders, OrderDishes, Ratings]
+
+
+def _get_cursor(name):
+    cursor, _ = SyncCursors.objects.get_or_create(table_name=name)
+    return cursor
+
+
+def _push_rows(model, rows, backend, cursor, fields):
+    backend.write(model, rows)
+    cursor.synced_at = timezone.now()
+    cursor.save(update_fields=[*fields, "synced_at"])
+
+
+def _push_new(model, cursor, batch_size, backend):
+    # Ids are allocated when a row is inserted but become visible when its
+    # transaction commits, so on Postgres a row can appear below the cursor
+    # after a higher id was already copied. Every run starts
+    # SNOWFLAKE_SYNC_RESCAN_IDS below the cursor to pick those up.
+    last_id = max(cursor.last_id - settings.SNOWFLAKE_SYNC_RESCAN_IDS, 0)
+    copied = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=last_id).order_by("pk")[:batch_size])
+        if not rows:
+            break
+        last_id = rows[-1].pk
+        cursor.last_id = max(cursor.last_id, last_id)
+        _push_rows(model, rows, backend, cursor, ["last_id"])
+        copied += len(rows)
+        logger.info("Synced %s rows of %s to Snowflake (up to id %s)", len(rows), model._meta.db_table, last_id)
+    return copied
+
+
+def _push_updated(model, cursor, batch_size, backend):
+    # Rows changed since the last run, by their updated_at. The timestamp is
+    # taken before the change commits, so runs look back
+    # SNOWFLAKE_SYNC_LAG_SECONDS before the newest one already copied.
+    rows = model.objects.filter(updated_at__isnull=False)
+    if cursor.last_updated_at is not None:
+        rows = rows.filter(updated_at__gte=cursor.last_updated_at - timedelta(seconds=settings.SNOWFLAKE_SYNC_LAG_SECONDS))
+    copied = 0
+    last = None
+    while True:
+        batch = rows
+        if last is not None:
+            batch = batch.filter(Q(updated_at__gt=last.updated_at) | Q(updated_at=last.updated_at, pk__gt=last.pk))
+        batch = list(batch.order_by("updated_at", "pk")[:batch_size])
+        if not batch:
+            break
+        last = batch[-1]
+        if cursor.last_updated_at is None or last.updated_at > cursor.last_updated_at:
+            cursor.last_updated_at = last.updated_at
+        _push_rows(model, batch, backend, cursor, ["last_updated_at"])
+        copied += len(batch)
+        logger.info("Synced %s updated rows of %s to Snowflake", len(batch), model._meta.db_table)
+    return copied
+
+
+def push_model(model, batch_size=None, backend=None):
+    """
+    Copy rows of `model` created or changed since the last sync from the
+    OLTP database to Snowflake.
+
+    New rows are read in primary key order from a little below the id
+    cursor, so rows that committed out of id order are not skipped. Models
+    with an `updated_at` column (Users) also have the rows changed since
+    the last run re-sent. Rows are loaded in batches of `batch_size` with
+    the configured Snowflake backend (one multi-row INSERT, or a staged
+    COPY), which replaces rows by primary key, so rows sent more than once
+    (re-scanned, or re-sent after a crash before the cursor update) are
+    stored once. The cursor is advanced after every batch, so an
+    interrupted run resumes where it stopped.
+
+    Returns:
+    - The number of rows sent, re-sent rows included.
+    """
+    batch_size = batch_size or settings.SNOWFLAKE_SYNC_BATCH_SIZE
+    backend = backend or get_backend()
+    cursor = _get_cursor(model._meta.db_table)
+    copied = _push_new(model, cursor, batch_size, backend)
+    if any(field.name == "updated_at" for field in model._meta.concrete_fields):
+        copied += _push_updated(model, cursor, batch_size, backend)
+    return copied
+
+
+def push_to_snowflake(batch_size=None, backend=None):
+    """
+    Copy new Users, Orders, OrderDishes and Ratings rows to Snowflake.
+
+    Tables the write-behind writer loads are pushed too: its buffer lives
+    in memory and is lost if the process dies, and rows written outside
+    create_random_order/add_rating never reach it. Loads replace rows by
+    primary key, so rows sent by both end up in Snowflake once.
+
+    Returns:
+    - Dict of table name to number of rows copied.
+    """
+    backend = backend or get_backend()
+    return {model._meta.db_table: push_model(model, batch_size, backend) for model in PUSH_MODELS}
+
+
+def pull_dishes(batch_size=None, using=None):
+    """
+    Copy dishes added to the Snowflake menu since the last pull into the
+    OLTP database, so order creation never reads from the warehouse, and
+    tell the dish caches (see dishes_changed).
+
+    Returns:
+    - The number of dishes copied.
+    """
+    batch_size = batch_size or settings.SNOWFLAKE_SYNC_BATCH_SIZE
+    using = using or settings.SNOWFLAKE_DB_ALIAS
+    cursor = _get_cursor("pull:dishes")
+    copied = 0
+    while True:
+        rows = list(Dishes.objects.using(using).filter(pk__gt=cursor.last_id).order_by("pk")[:batch_size])
+        if not rows:
+            break
+        with transaction.atomic():
+            Dishes.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+            cursor.last_id = rows[-1].pk
+            cursor.synced_at = timezone.now()
+            cursor.save(update_fields=["last_id", "synced_at"])
+        copied += len(rows)
+    if copied:
+        dishes_changed()
+    return copied
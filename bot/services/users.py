@@ -0,0 +1,58 @@
+from django.db import connections, router
+
+from bot.models import Users
+
+_RETURNING = "id, user_name, user_email, latest_order_id"
+
+
+def _from_row(whatsapp_number, row):
+    user = Users(
+        id=row[0], whatsapp_number=whatsapp_number, user_name=row[1], user_email=row[2], latest_order_id=row[3]
+    )
+    user._state.adding = False
+    user._state.db = router.db_for_write(Users)
+    return user
+
+
+def _supports_insert_returning(connection):
+    if connection.vendor == "postgresql":
+        return True
+    return connection.vendor == "sqlite" and connection.Database.sqlite_version_info >= (3, 35)
+
+
+def upsert_user(whatsapp_number):
+    """
+    Get or create the user of a normalized WhatsApp number, race-free.
+
+    On PostgreSQL and SQLite returning users, the common case, are read
+    with a plain SELECT, which writes nothing. Only unknown numbers go
+    through INSERT ... ON CONFLICT DO NOTHING RETURNING, re-reading the row
+    if another request won the race. Other backends fall back to
+    get_or_create, which relies on the unique index to resolve concurrent
+    first messages.
+
+    Returns:
+    - Tuple of (Users instance, created).
+    """
+    alias = router.db_for_write(Users)
+    connection = connections[alias]
+    if not _supports_insert_returning(connection):
+        return Users.objects.get_or_create(whatsapp_number=whatsapp_number)
+
+    table = connection.ops.quote_name(Users._meta.db_table)
+    select = f"SELECT {_RETURNING} FROM {table} WHERE whatsapp_number = %s"
+    with connection.cursor() as cursor:
+        cursor.execute(select, [whatsapp_number])
+        row = cursor.fetchone()
+        if row is not None:
+            return _from_row(whatsapp_number, row), False
+        cursor.execute(
+            f"INSERT INTO {table} (whatsapp_number) VALUES (%s) "
+            f"ON CONFLICT (whatsapp_number) DO NOTHING RETURNING {_RETURNING}",
+            [whatsapp_number],
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            return _from_row(whatsapp_number, row), True
+        cursor.execute(select, [whatsapp_number])
+        return _from_row(whatsapp_number, cursor.fetchone()), False
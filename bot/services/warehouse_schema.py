@@ -0,0 +1,102 @@
+import logging
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from bot.models import SyncCursors
+
+logger = logging.getLogger(__name__)
+
+_APPLIED_TABLE = "warehouse_migrations"
+
+
+class WarehouseMigration:
+    """
+    One schema change of the Snowflake tables the sync job loads.
+
+    `statements` run in order; `resync` names tables whose sync cursor is
+    reset afterwards, so every row is pushed again (loads replace rows by
+    primary key) to fill a new column or replace rows the change dropped.
+    """
+
+    def __init__(self, name, statements, resync=()):
+        self.name = name
+        self.statements = statements
+        self.resync = tuple(resync)
+
+
+# Django migrations never run on the warehouse (see BotRouter), so every
+# OLTP column pushed to Snowflake needs its DDL here. Append new entries,
+# never edit applied ones.
+MIGRATIONS = [
+    # order_time becomes a timestamp, users point at their latest order
+    WarehouseMigration(
+        "0001_typed_order_time",
+        [
+            "ALTER TABLE orders ADD COLUMN order_time_ts TIMESTAMP_TZ",
+            "UPDATE orders SET order_time_ts = TRY_TO_TIMESTAMP_TZ(REPLACE(TRIM(order_time), '/', '-'))",
+            "ALTER TABLE orders DROP COLUMN order_time",
+            "ALTER TABLE orders RENAME COLUMN order_time_ts TO order_time",
+            "ALTER TABLE users ADD COLUMN latest_order_id NUMBER(38, 0)",
+        ],
+        resync=["users"],
+    ),
+    # Order lines get their own key and a quantity. The OLTP database
+    # renumbered every line, so the keyless rows are replaced by a full push.
+    WarehouseMigration(
+        "0002_order_lines",
+        [
+            "ALTER TABLE order_dishes ADD COLUMN id NUMBER(38, 0)",
+            "ALTER TABLE order_dishes ADD COLUMN quantity NUMBER(38, 0) DEFAULT 1",
+            "DELETE FROM order_dishes",
+        ],
+        resync=["order_dishes"],
+    ),
+    # Lets the sync re-send users changed after they were inserted
+    WarehouseMigration(
+        "0003_users_updated_at",
+        ["ALTER TABLE users ADD COLUMN updated_at TIMESTAMP_TZ"],
+    ),
+]
+
+
+def applied_migrations(using=None):
+    using = using or settings.SNOWFLAKE_DB_ALIAS
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {_APPLIED_TABLE} (name VARCHAR(255) PRIMARY KEY, applied_at TIMESTAMP_TZ)"
+        )
+        cursor.execute(f"SELECT name FROM {_APPLIED_TABLE}")
+        return {row[0] for row in cursor.fetchall()}
+
+
+def pending_migrations(using=None):
+    applied = applied_migrations(using)
+    return [migration for migration in MIGRATIONS if migration.name not in applied]
+
+
+def migrate_warehouse(using=None):
+    """
+    Apply the pending warehouse migrations in order, recording each one.
+
+    Snowflake commits DDL as it runs, so a migration failing half way has to
+    be finished by hand before it is recorded.
+
+    Returns:
+    - The names of the migrations applied.
+    """
+    using = using or settings.SNOWFLAKE_DB_ALIAS
+    applied = []
+    for migration in pending_migrations(using):
+        with connections[using].cursor() as cursor:
+            for statement in migration.statements:
+                cursor.execute(statement)
+            cursor.execute(
+                f"INSERT INTO {_APPLIED_TABLE} (name, applied_at) VALUES (%s, %s)", [migration.name, timezone.now()]
+            )
+        if migration.resync:
+            SyncCursors.objects.filter(table_name__in=migration.resync).update(last_id=0, last_updated_at=None)
+        logger.info("Applied warehouse migration %s", migration.name)
+        applied.append(migration.name)
+    return applied
@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from bot.models import Dishes
+from bot.services.dish_catalog import dishes_changed
+
+
+@receiver(post_save, sender=Dishes)
+@receiver(post_delete, sender=Dishes)
+def invalidate_dish_caches(sender, **kwargs):
+    # The catalog's version only sees appended rows; edits in place and
+    # deletes have to be announced
+    dishes_changed()
@@ -0,0 +1,33 @@
+from decimal import Decimal
+
+from django.test import TestCase
+
+from bot.models import Dishes
+from bot.services import dish_catalog
+from bot.services.dish_catalog import DishCatalog
+
+
+class DishCatalogTests(TestCase):
+    def setUp(self):
+        self.dish = Dishes.objects.create(dish_name="Curry", price=Decimal("10.00"), course="main")
+
+    def test_refresh_sees_edits_in_place(self):
+        # Another process's catalog: only the shared generation tells it
+        catalog = DishCatalog(refresh_interval=0)
+        catalog.load()
+        self.dish.price = Decimal("12.50")
+        self.dish.save()
+        self.assertTrue(catalog.refresh())
+        self.assertEqual(catalog.get(self.dish.id).price, Decimal("12.50"))
+        self.assertFalse(catalog.refresh())
+
+    def test_save_invalidates_the_process_catalog(self):
+        catalog = DishCatalog(refresh_interval=0)
+        catalog.load()
+        previous, dish_catalog._catalog = dish_catalog._catalog, catalog
+        try:
+            Dishes.objects.filter(pk=self.dish.pk).delete()
+            Dishes.objects.create(id=self.dish.id, dish_name="Stew", price=Decimal("9.00"))
+            self.assertEqual(catalog.get(self.dish.id).name, "Stew")
+        finally:
+            dish_catalog._catalog = previous
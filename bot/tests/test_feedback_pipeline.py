@@ -0,0 +1,55 @@
+from concurrent.futures import Future
+from decimal import Decimal
+
+from django.test import TransactionTestCase, override_settings
+
+from bot.api.views import MessageView
+from bot.models import Dishes, Orders, Ratings, Users
+from bot.services import conversation_state, feedback_pipeline
+from bot.utils.gpt4 import stub_intention_classification
+
+
+class FeedbackPipelineTests(TransactionTestCase):
+    # Transactional, so the pipeline's worker thread sees the rows
+
+    def setUp(self):
+        self.messages = []
+
+        def classifier(user_message):
+            self.messages.append(user_message)
+            return stub_intention_classification(user_message)
+
+        feedback_pipeline.set_classifier(classifier)
+        self.addCleanup(feedback_pipeline.set_classifier, None)
+        self.user = Users.objects.create(whatsapp_number="+61400000001")
+        self.order = Orders.objects.create(user=self.user, order_status="delivered")
+
+    @override_settings(FEEDBACK_PIPELINE_MODE="inline")
+    def test_inline_mode_rates_before_returning(self):
+        rating = feedback_pipeline.submit_feedback(self.user.id, self.order.id, "8, lovely")
+        self.assertEqual((rating.order_id, rating.rating), (self.order.id, 8))
+        self.assertEqual(self.messages, ["8, lovely"])
+
+    @override_settings(FEEDBACK_PIPELINE_MODE="thread")
+    def test_thread_mode_rates_in_the_background(self):
+        future = feedback_pipeline.submit_feedback(self.user.id, self.order.id, "7")
+        self.assertIsInstance(future, Future)
+        future.result(timeout=10)
+        self.assertEqual(Ratings.objects.get(order=self.order).rating, 7)
+
+    def test_message_that_is_not_a_rating_is_not_stored(self):
+        self.assertIsNone(feedback_pipeline.process_feedback(self.user.id, self.order.id, "where is it"))
+        self.assertFalse(Ratings.objects.exists())
+
+    @override_settings(FEEDBACK_PIPELINE_MODE="inline")
+    def test_rated_order_is_not_classified_again(self):
+        Dishes.objects.create(dish_name="Curry", price=Decimal("10.00"))
+        number = "+61400000002"
+        self.addCleanup(conversation_state.forget, number)
+        view = MessageView()
+        view.handle_message(number, "hi")  # welcome order
+        view.handle_message(number, "9")
+        body, _, _ = view.handle_message(number, "actually 3")
+        self.assertIn("already rated", body)
+        self.assertEqual(self.messages, ["9"])
+        self.assertEqual(list(Ratings.objects.values_list("rating", flat=True)), [9])
@@ -0,0 +1,38 @@
+from django.test import SimpleTestCase
+
+from bot.utils.gpt4 import parse_rating
+
+
+class ParseRatingTests(SimpleTestCase):
+    def test_ratings(self):
+        cases = {
+            "8": 8,
+            "8.5": 9,
+            "9/10": 9,
+            "4 out of 5 stars": 8,
+            "I would give it 5 stars": 10,
+            "Love it!": 9,
+            "I really loved this dish": 9,
+            "not bad": 7,
+        }
+        for message, rating in cases.items():
+            with self.subTest(message=message):
+                self.assertEqual(parse_rating(message), rating)
+
+    def test_left_to_the_llm(self):
+        messages = [
+            "I'd like to cancel my order",
+            "I would like a refund",
+            "good morning",
+            "what is the best dish",
+            "best regards",
+            "ok thanks",
+            "I like turtles",
+            "is 8 ok?",
+            "2/3 of the dish was cold",
+            "10/10 awful",
+            "I gave the chef a 10 but the food 4",
+        ]
+        for message in messages:
+            with self.subTest(message=message):
+                self.assertIsNone(parse_rating(message))
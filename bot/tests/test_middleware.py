@@ -0,0 +1,38 @@
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from bot.middleware import WebhookGuard
+
+URL = "/api/bot/whatsapp/message"
+
+
+@override_settings(WEBHOOK_RATE_LIMIT_BACKEND="memory", WEBHOOK_TRUST_FORWARDED_FOR=False)
+class WebhookGuardTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.guard = WebhookGuard()
+
+    def post(self, number="whatsapp:+61400000001"):
+        return self.factory.post(URL, {"From": number, "Body": "hi"}, HTTP_X_TWILIO_SIGNATURE="sig")
+
+    @override_settings(TWILIO_VALIDATE_SIGNATURE=True, WEBHOOK_RATE_PER_IP=1, WEBHOOK_BURST_PER_IP=2,
+                       WEBHOOK_RATE_PER_NUMBER=0)
+    def test_ip_limit_counts_only_forged_requests(self):
+        with mock.patch.object(self.guard, "validator") as validator:
+            validator.return_value.validate.return_value = True
+            for _ in range(10):
+                self.assertIsNone(self.guard.check(self.post()))
+            validator.return_value.validate.return_value = False
+            statuses = [self.guard.check(self.post()).status_code for _ in range(3)]
+        self.assertEqual(statuses, [403, 403, 429])
+
+    @override_settings(TWILIO_VALIDATE_SIGNATURE=False, WEBHOOK_RATE_PER_IP=0, WEBHOOK_RATE_PER_NUMBER=1,
+                       WEBHOOK_BURST_PER_NUMBER=1)
+    def test_throttled_number_is_answered(self):
+        self.assertIsNone(self.guard.check(self.post()))
+        response = self.guard.check(self.post())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("faster than I can keep up", response.content.decode())
+        self.assertIsNone(self.guard.check(self.post("whatsapp:+61400000002")))
+        self.assertEqual(self.guard.stats()["throttled_number"], 1)
@@ -0,0 +1,63 @@
+from django.test import SimpleTestCase
+from twilio.base.exceptions import TwilioRestException
+
+from bot.services.outbound_queue import FAILED, PENDING, SENT, MemoryQueueBackend, OutboundSender
+from bot.utils.twilio import FakeTwilioTransport
+
+SENDER = "whatsapp:+14155238886"
+OTHER_SENDER = "whatsapp:+14155238887"
+
+
+class OutboundSenderTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = MemoryQueueBackend()
+        self.transport = FakeTwilioTransport()
+
+    def sender(self, **kwargs):
+        kwargs.setdefault("rate_per_sender", 100)
+        sender = OutboundSender(self.queue, self.transport, concurrency=1, backoff=0, **kwargs)
+        self.addCleanup(sender.close)
+        return sender
+
+    def test_messages_go_out_in_queue_order(self):
+        for number, body in enumerate(["first", "second", "third"]):
+            self.queue.enqueue(SENDER, f"whatsapp:+1415555010{number}", body, now=number)
+        self.assertEqual(self.sender().run_once(), 3)
+        self.assertEqual([message["body"] for message in self.transport.sent], ["first", "second", "third"])
+        self.assertEqual(self.queue.counts(), {SENT: 3})
+
+    def test_duplicate_idempotency_key_is_dropped(self):
+        self.assertTrue(self.queue.enqueue(SENDER, "whatsapp:+14155550100", "hi", idempotency_key="k"))
+        self.assertFalse(self.queue.enqueue(SENDER, "whatsapp:+14155550100", "hi", idempotency_key="k"))
+
+    def test_rate_limit_is_per_sender(self):
+        for body in ["a", "b", "c"]:
+            self.queue.enqueue(SENDER, "whatsapp:+14155550100", body, now=0)
+        self.queue.enqueue(OTHER_SENDER, "whatsapp:+14155550100", "d", now=0)
+        self.sender(rate_per_sender=1).run_once()
+        # One token each: the other sender isn't held back by the first's burst
+        self.assertEqual(sorted(message["body"] for message in self.transport.sent), ["a", "d"])
+        self.assertEqual(self.queue.counts(), {SENT: 2, PENDING: 2})
+        # Throttled messages are put back without using up an attempt
+        self.assertTrue(all(row["attempts"] == 0 for row in self.queue._rows.values()))
+
+    def test_transport_error_is_retried(self):
+        self.transport.fail_times = 1
+        self.queue.enqueue(SENDER, "whatsapp:+14155550100", "hello", now=0)
+        sender = self.sender()
+        sender.run_once()
+        self.assertEqual(self.transport.sent, [])
+        self.assertEqual(self.queue.counts(), {PENDING: 1})
+
+        sender.run_once()
+        self.assertEqual([message["body"] for message in self.transport.sent], ["hello"])
+        row = self.queue._rows[1]
+        self.assertEqual((row["status"], row["attempts"]), (SENT, 1))
+
+    def test_client_error_is_not_retried(self):
+        self.transport.fail_times = 1
+        self.transport.error = TwilioRestException(400, "https://api.twilio.com", "Invalid 'To' number")
+        self.queue.enqueue(SENDER, "whatsapp:+14155550100", "hello", now=0)
+        with self.assertLogs("bot.services.outbound_queue", "ERROR"):
+            self.sender().run_once()
+        self.assertEqual(self.queue.counts(), {FAILED: 1})
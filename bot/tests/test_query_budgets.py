@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+
+from bot.api.views import MessageView
+from bot.management.commands.benchmark_webhook import QUERY_BUDGETS
+from bot.models import Dishes, OrderDishes, Orders, Ratings, Users
+from bot.services.dish_catalog import get_dish_catalog
+from bot.utils.querycount import assert_max_queries
+
+
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Users.objects.create(whatsapp_number="+61400000001")
+        dishes = Dishes.objects.bulk_create(
+            Dishes(dish_name=f"Dish {number}", price=Decimal("10.00"), course="main") for number in range(50)
+        )
+        cls.order = Orders.objects.create(user=cls.user)
+        OrderDishes.objects.bulk_create(
+            OrderDishes(order=cls.order, dish=dish, quantity=number % 3 + 1) for number, dish in enumerate(dishes)
+        )
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        orders = Orders.objects.bulk_create(
+            Orders(user=cls.user, order_time=start + timedelta(days=day), order_status="delivered")
+            for day in range(25)
+        )
+        Ratings.objects.bulk_create(
+            Ratings(user=cls.user, order=order, rating=day % 11, original_feedback="x" * 200)
+            for day, order in enumerate(orders)
+        )
+
+    def setUp(self):
+        self.view = MessageView()
+        # The catalog is loaded once per process, not per order
+        get_dish_catalog().load()
+
+    def test_gather_order_details(self):
+        with assert_max_queries(QUERY_BUDGETS["gather_order_details"]):
+            details = self.view.gather_order_details(self.order)
+        self.assertEqual(len(details), 50)
+
+    @override_settings(RATINGS_PAGE_SIZE=10)
+    def test_format_ratings_page(self):
+        pages = 0
+        cursor = None
+        while True:
+            with assert_max_queries(QUERY_BUDGETS["format_ratings_page"]):
+                _, cursor = self.view.format_ratings_page(self.user, cursor)
+            pages += 1
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
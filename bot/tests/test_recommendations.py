@@ -0,0 +1,62 @@
+import os
+import tempfile
+from decimal import Decimal
+
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+
+from bot.models import Dishes, OrderDishes, Orders, Ratings, Users
+from bot.services.recommendations import IndexLoader, RecommendationIndex, _dish
+
+
+def make_index(top_rows, popular, dietaries):
+    dishes = {dish_id: _dish(dish_id, f"Dish {dish_id}", "main", "10.00", tags) for dish_id, tags in dietaries.items()}
+    return RecommendationIndex(
+        np.array(list(top_rows), dtype=np.int64),
+        np.array(list(top_rows.values()), dtype=np.int64).reshape(len(top_rows), -1),
+        np.array(popular, dtype=np.int64),
+        dishes,
+    )
+
+
+class RecommendationIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = make_index(
+            {7: [3, 1, -1]},
+            [1, 2, 3, 4, 5],
+            {1: "", 2: "vegan", 3: "Vegan, GF", 4: "gf", 5: "vegan"},
+        )
+
+    def ids(self, dishes):
+        return [dish["id"] for dish in dishes]
+
+    def test_personal_candidates_come_first(self):
+        self.assertEqual(self.ids(self.index.recommend(7, k=3)), [3, 1, 2])
+        self.assertEqual(self.ids(self.index.recommend(8, k=3)), [1, 2, 3])
+
+    def test_dietary_filter(self):
+        self.assertEqual(self.ids(self.index.recommend(8, k=3, dietaries={"vegan"})), [2, 3, 5])
+        self.assertEqual(self.ids(self.index.recommend(8, k=3, dietaries={"vegan", "gf"})), [3])
+
+    def test_unknown_tags_are_ignored(self):
+        self.assertEqual(self.ids(self.index.recommend(8, k=2, dietaries={"something", "spicy"})), [1, 2])
+        self.assertEqual(self.ids(self.index.recommend(8, k=2, dietaries={"something", "gf"})), [3, 4])
+
+
+class IndexLoaderTests(TestCase):
+    def test_falls_back_to_popularity_without_an_index(self):
+        user = Users.objects.create(whatsapp_number="+14155550100")
+        liked, disliked = (
+            Dishes.objects.create(dish_name=name, price=Decimal("10.00")) for name in ("Curry", "Stew")
+        )
+        for dish, rating in ((disliked, 2), (liked, 9)):
+            order = Orders.objects.create(user=user)
+            OrderDishes.objects.create(order=order, dish=dish)
+            Ratings.objects.create(user=user, order=order, rating=rating)
+
+        with tempfile.TemporaryDirectory() as directory:
+            loader = IndexLoader(os.path.join(directory, "missing.npz"), refresh_interval=0)
+            loader.start()
+        dishes = loader.get().recommend(user.id + 1, k=2)
+        self.assertEqual([dish["name"] for dish in dishes], ["Curry", "Stew"])
+        self.assertFalse(loader.refresh())
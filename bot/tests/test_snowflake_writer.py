@@ -0,0 +1,81 @@
+from django.test import SimpleTestCase
+
+from bot.models import Ratings, Users
+from bot.services.snowflake_service import MemoryBackend, SnowflakeBatchWriter
+
+
+class FlakyBackend(MemoryBackend):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def write(self, model, rows):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Snowflake unavailable")
+        super().write(model, rows)
+
+
+def users(*ids):
+    return [Users(id=pk) for pk in ids]
+
+
+class SnowflakeBatchWriterTests(SimpleTestCase):
+    def test_flushes_at_max_rows(self):
+        backend = MemoryBackend()
+        writer = SnowflakeBatchWriter(backend, max_rows=3, max_age=60)
+        for user in users(1, 2):
+            writer.add(user)
+        self.assertEqual(backend.batches, [])
+        writer.add(Users(id=3))
+        self.assertEqual([(model, [row.id for row in rows]) for model, rows in backend.batches], [(Users, [1, 2, 3])])
+        self.assertEqual(writer.metrics()["rows_pending"], 0)
+
+    def test_flushes_at_max_age(self):
+        backend = MemoryBackend()
+        writer = SnowflakeBatchWriter(backend, max_rows=100, max_age=60)
+        writer.add(Users(id=1))
+        writer.flush_due()
+        self.assertEqual(backend.batches, [])
+
+        writer.max_age = 0
+        writer.flush_due()
+        self.assertEqual(len(backend.batches), 1)
+
+    def test_failed_batch_is_restored_and_retried(self):
+        backend = FlakyBackend(failures=1)
+        writer = SnowflakeBatchWriter(backend, max_rows=100, max_age=60)
+        for user in users(1, 2):
+            writer.add(user)
+        with self.assertLogs("bot.services.snowflake_service", "ERROR"):
+            self.assertEqual(writer.flush(), 0)
+        writer.add(Users(id=3))
+        metrics = writer.metrics()
+        self.assertEqual((metrics["failed_flushes"], metrics["rows_pending"]), (1, 3))
+
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual([row.id for row in backend.batches[0][1]], [1, 2, 3])
+
+    def test_pending_rows_are_capped(self):
+        backend = FlakyBackend(failures=10)
+        writer = SnowflakeBatchWriter(backend, max_rows=2, max_age=60, max_pending=4)
+        with self.assertLogs("bot.services.snowflake_service", "WARNING"):
+            for user in users(1, 2, 3, 4, 5, 6):
+                writer.add(user)
+        metrics = writer.metrics()
+        self.assertEqual((metrics["rows_pending"], metrics["rows_dropped"]), (4, 2))
+
+        backend.failures = 0
+        writer.flush()
+        # The oldest went first, in batches of max_rows
+        self.assertEqual([[row.id for row in rows] for model, rows in backend.batches], [[3, 4], [5, 6]])
+
+    def test_stop_flushes_the_rest(self):
+        backend = MemoryBackend()
+        writer = SnowflakeBatchWriter(backend, max_rows=100, max_age=60)
+        writer.start(interval=60)
+        writer.add(Users(id=1))
+        writer.add(Ratings(id=1))
+        writer.stop()
+        self.assertEqual({model for model, rows in backend.batches}, {Users, Ratings})
+        self.assertEqual(writer.metrics()["rows_pending"], 0)
@@ -0,0 +1,19 @@
+from django.test import TestCase
+
+from bot.models import Users
+from bot.services.users import upsert_user
+
+
+class UpsertUserTests(TestCase):
+    def test_creates_then_reads(self):
+        user, created = upsert_user("+61400000001")
+        self.assertTrue(created)
+        again, created = upsert_user("+61400000001")
+        self.assertFalse(created)
+        self.assertEqual(again.pk, user.pk)
+        self.assertEqual(Users.objects.count(), 1)
+
+    def test_returning_user_costs_one_read(self):
+        upsert_user("+61400000001")
+        with self.assertNumQueries(1):
+            upsert_user("+61400000001")
@@ -0,0 +1,146 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with a per-entry TTL.
+
+    Holds at most `maxsize` entries; the least recently used one is evicted
+    first. Entries older than `ttl` seconds (None: never) count as misses.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self.clock():
+                    self._data.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._data[key]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = self.clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return with_hit_rate(dict(self._stats, size=len(self._data), maxsize=self.maxsize))
+
+
+class DjangoCacheBackend:
+    """
+    Same interface as LRUCache on top of a Django cache alias, so entries are
+    shared by every worker pointing at the same cache server. Size limits and
+    eviction are those of the underlying cache; stats are per process.
+    """
+
+    def __init__(self, prefix, ttl=None, alias="default"):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, key):
+        # Hash the key so arbitrary text is safe for memcached and friends
+        digest = hashlib.sha1(str(key).encode("utf-8")).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def get(self, key, default=None):
+        value = self.cache.get(self.make_key(key), _MISSING)
+        with self._lock:
+            self._stats["hits" if value is not _MISSING else "misses"] += 1
+        return default if value is _MISSING else value
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(self.make_key(key), value, timeout=self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def clear(self):
+        # Only safe on a cache dedicated to this prefix
+        self.cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return with_hit_rate(dict(self._stats))
+
+
+class NullCache:
+    # Cache that never stores anything, for switching a cache layer off
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def build_cache(backend, prefix, maxsize=1024, ttl=None):
+    """
+    Build a cache from a backend name: "lru" (in-process), "django"
+    (shared through the Django cache framework) or "none".
+    """
+    if backend == "lru":
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+    if backend == "django":
+        return DjangoCacheBackend(prefix, ttl=ttl)
+    if backend == "none":
+        return NullCache()
+    raise ValueError(f"Unknown cache backend {backend!r}")
+
+
+def with_hit_rate(stats):
+    """
+    Add the hit rate to a stats dict with "hits" and "misses" counters.
+    """
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
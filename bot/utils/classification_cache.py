@@ -0,0 +1,170 @@
+import logging
+import re
+import threading
+
+from django.conf import settings
+
+from bot.utils.cache import build_cache
+from bot.utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"[a-z0-9/']+")
+_REPEATS_RE = re.compile(r"(.)\1{2,}")
+
+
+def _stem(word):
+    # Crude suffix stripping so "loved"/"love" and "liked"/"likes"/"like"
+    # share a key; only consistency matters here, not linguistics.
+    if len(word) > 4 and word.endswith("ed"):
+        word = word[:-2]
+    elif len(word) > 4 and word.endswith("es"):
+        word = word[:-2]
+    elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    if len(word) > 3 and word.endswith("e"):
+        word = word[:-1]
+    return word
+
+
+def normalize_message(user_message):
+    """
+    Reduce a feedback message to its cache key.
+
+    "Love it!", "love it" and "LOVED it!!!" all normalize to "lov it".
+    """
+    text = _REPEATS_RE.sub(r"\1\1", (user_message or "").lower())
+    return " ".join(_stem(word) for word in _WORD_RE.findall(text))
+
+
+class EmbeddingTier:
+    """
+    Optional second tier matching paraphrases by embedding similarity.
+
+    Uses a local sentence-transformers model (`model_name` should be a path
+    to a downloaded model so nothing is fetched at runtime). If the package
+    isn't installed the tier disables itself. Holds at most `max_entries`
+    vectors, replacing the oldest first.
+    """
+
+    def __init__(self, model_name, threshold=0.92, max_entries=5000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._values = []
+        self._next = 0
+        self._stats = {"hits": 0, "misses": 0}
+        try:
+            import numpy
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            logger.warning("sentence-transformers is not installed, embedding cache tier disabled")
+            self.model = None
+            return
+        self.np = numpy
+        self.model = SentenceTransformer(model_name)
+
+    @property
+    def enabled(self):
+        return self.model is not None
+
+    def _embed(self, text):
+        return self.model.encode([text], normalize_embeddings=True)[0].astype("float32")
+
+    def get(self, text):
+        if not self.enabled:
+            return None
+        vector = self._embed(text)
+        with self._lock:
+            if self._vectors is not None and len(self._values):
+                scores = self._vectors[: len(self._values)] @ vector
+                best = int(scores.argmax())
+                if scores[best] >= self.threshold:
+                    self._stats["hits"] += 1
+                    return self._values[best]
+            self._stats["misses"] += 1
+        return None
+
+    def set(self, text, value):
+        if not self.enabled:
+            return
+        vector = self._embed(text)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = self.np.zeros((self.max_entries, len(vector)), dtype="float32")
+            # Ring buffer: once full, overwrite the oldest entry
+            slot = self._next % self.max_entries
+            self._vectors[slot] = vector
+            if slot < len(self._values):
+                self._values[slot] = value
+            else:
+                self._values.append(value)
+            self._next += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._values))
+
+
+class ClassificationCache:
+    """
+    Cache of intention_classification results keyed on the normalized
+    message, with an optional embedding-similarity tier behind it.
+    """
+
+    def __init__(self, backend, embedding_tier=None):
+        self.backend = backend
+        self.embedding_tier = embedding_tier
+
+    def get(self, user_message):
+        key = normalize_message(user_message)
+        result = self.backend.get(key)
+        if result is None and self.embedding_tier is not None:
+            result = self.embedding_tier.get(key)
+            if result is not None:
+                # Promote so the next identical phrasing skips the model
+                self.backend.set(key, result)
+        return result
+
+    def set(self, user_message, result):
+        key = normalize_message(user_message)
+        self.backend.set(key, result)
+        if self.embedding_tier is not None:
+            self.embedding_tier.set(key, result)
+
+    def stats(self):
+        stats = {"exact": self.backend.stats()}
+        if self.embedding_tier is not None:
+            stats["embedding"] = self.embedding_tier.stats()
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_classification_cache():
+    """
+    Return the process-wide cache configured by the CLASSIFICATION_CACHE_* settings.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                backend = build_cache(
+                    settings.CLASSIFICATION_CACHE_BACKEND,
+                    "classification",
+                    maxsize=settings.CLASSIFICATION_CACHE_SIZE,
+                    ttl=settings.CLASSIFICATION_CACHE_TTL,
+                )
+                embedding_tier = None
+                if settings.CLASSIFICATION_CACHE_EMBEDDING_MODEL:
+                    embedding_tier = EmbeddingTier(
+                        settings.CLASSIFICATION_CACHE_EMBEDDING_MODEL,
+                        threshold=settings.CLASSIFICATION_CACHE_SIMILARITY,
+                        max_entries=settings.CLASSIFICATION_CACHE_SIZE,
+                    )
+                _cache = ClassificationCache(backend, embedding_tier)
+                get_metrics().register_collector("classification_cache", _cache.stats, label="tier")
+    return _cache
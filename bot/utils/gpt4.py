@@ -1,11 +1,22 @@
 import openai
 import json
+import math
+import re
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from bot.utils.cache import with_hit_rate
+from bot.utils.classification_cache import get_classification_cache
+from bot.utils.metrics import get_metrics
 
 def gpt_response(prompt):
-    response = openai.Completion.create(
-        model="gpt-3.5-turbo-instruct",
-        prompt=prompt
-    )
+    with get_metrics().external_call("openai", "completion"):
+        response = openai.Completion.create(
+            model="gpt-3.5-turbo-instruct",
+            prompt=prompt
+        )
     return response.choices[0].text
 
 def get_user_rating(user_rating):
@@ -17,7 +28,7 @@ def get_user_rating(user_rating):
     # """
     # )
     rating = {
-        "rating": int(user_rating),
+        "rating": int(user_rating) if user_rating is not None else None,
     }
     return rating
 
@@ -25,7 +36,8 @@ def provide_recommendations(user_previous_ratings, all_dishes):
     pass
 
 
-def intention_classification(user_message):
+def _classification_request(user_message):
+    # Keyword arguments of the ChatCompletion call classifying user_message
     messages = [{"role": "user", "content": user_message}]
     functions = [
         {
@@ -56,12 +68,16 @@ def intention_classification(user_message):
             },
         }
     ]
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo-0613",
-        messages=messages,
-        functions=functions,
-        function_call={"name": "get_user_rating"}  # auto is default, but we'll be explicit
-    )
+    return {
+        "model": "gpt-3.5-turbo-0613",
+        "messages": messages,
+        "functions": functions,
+        "function_call": {"name": "get_user_rating"},  # auto is default, but we'll be explicit
+        "request_timeout": settings.OPENAI_TIMEOUT,
+    }
+
+
+def _parse_classification(response):
     response_message = response["choices"][0]["message"]
     # Step 2: check if GPT wanted to call a function
     if response_message.get("function_call"):
@@ -79,4 +95,258 @@ def intention_classification(user_message):
         return {
             "response": function_response,
             "function_name": function_name,
-        }
\ No newline at end of file
+        }
+
+
+def intention_classification(user_message):
+    with get_metrics().external_call("openai", "classification"):
+        response = openai.ChatCompletion.create(**_classification_request(user_message))
+    return _parse_classification(response)
+
+
+async def intention_classification_async(user_message):
+    # Same as intention_classification, awaiting OpenAI without holding a thread
+    with get_metrics().external_call("openai", "classification"):
+        response = await openai.ChatCompletion.acreate(**_classification_request(user_message))
+    return _parse_classification(response)
+
+
+def stub_intention_classification(user_message):
+    # Offline replacement for intention_classification: takes the first
+    # number in the message as the rating, without calling OpenAI.
+    match = re.search(r"\d+", user_message or "")
+    rating = min(int(match.group()), 10) if match else None
+    return {
+        "response": get_user_rating(rating),
+        "function_name": "get_user_rating",
+    }
+
+
+# Fast path: most feedback is a bare number ("8"), a fraction ("9/10",
+# "10 out of 10"), a "give it a 7" phrase or a short sentiment ("love it").
+# Those are parsed locally; only messages the parser isn't confident about
+# go to the LLM.
+_NUMBER_WORDS = {
+    "zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+_NUM = r"(\d+(?:\.\d+)?|" + "|".join(_NUMBER_WORDS) + r")"
+_BARE_NUMBER_RE = re.compile(rf"^\s*{_NUM}\s*[!.]*\s*$")
+_FRACTION_RE = re.compile(rf"\b{_NUM}\s*(?:/|out of)\s*(\d+)\b")
+_STARS_RE = re.compile(rf"\b{_NUM}\s*stars?\b")
+_DIGITS_RE = re.compile(r"\d+(?:\.\d+)?")
+# Denominators people rate on; "2/3 of the dish" is a quantity, not a rating
+_RATING_SCALES = {5, 10, 100}
+_PHRASE_RE = re.compile(
+    rf"\b(?:give|giving|gave|rate|rating|rated|score|scored)\b"
+    rf"(?:\s+(?:it|this|that|them|the\s+\w+))?(?:\s+(?:a|an))?[\s:]*{_NUM}\b"
+)
+_WORD_RE = re.compile(r"[a-z']+")
+
+# Rating on the 0-10 scale implied by a sentiment word
+SENTIMENT_LEXICON = {
+    "perfect": 10, "best": 10, "amazing": 10, "fantastic": 10, "incredible": 10, "outstanding": 10,
+    "awesome": 9, "excellent": 9, "delicious": 9, "love": 9, "loved": 9, "superb": 9, "brilliant": 9,
+    "great": 8, "tasty": 8, "yummy": 8, "lovely": 8,
+    "good": 7, "nice": 7, "like": 7, "liked": 7, "enjoyed": 7,
+    "decent": 6, "average": 5,
+    "mediocre": 4, "meh": 4, "bland": 3,
+    "bad": 2, "poor": 2, "disappointing": 2, "dislike": 2, "disliked": 2,
+    "terrible": 1, "horrible": 1, "awful": 1, "hate": 1, "hated": 1, "gross": 1,
+    "worst": 0, "disgusting": 0, "inedible": 0,
+}
+_NEGATIONS = {"not", "no", "never", "isn't", "wasn't", "don't", "didn't", "doesn't", "aren't", "weren't"}
+_CONTRAST_WORDS = {"but", "though", "although", "however", "except", "yet"}
+# Besides lexicon words and negations, the only words a sentiment-only
+# message may contain ("I really loved this dish"). Anything else, e.g.
+# "I'd like to cancel my order", "good morning" or "best regards", means the
+# message may not be a rating at all and goes to the LLM.
+_SENTIMENT_FILLER = {
+    "i", "it", "it's", "this", "that", "was", "is", "the", "dish", "food", "meal", "order",
+    "so", "very", "really", "absolutely", "pretty", "quite", "too", "just", "a", "bit",
+}
+_MAX_SENTIMENT_WORDS = 6  # longer messages are left to the LLM
+# How far a sentiment word may be from a numeric rating before the message
+# counts as contradictory ("10/10, awful")
+_MAX_SENTIMENT_CONFLICT = 3
+
+_fast_path_stats = {"hits": 0, "misses": 0}
+_fast_path_lock = threading.Lock()
+
+
+def _round_half_up(value):
+    # round() rounds halves to even, which would read "8.5" as 8
+    return int(math.floor(value + 0.5))
+
+
+def _to_number(token):
+    if token in _NUMBER_WORDS:
+        return _NUMBER_WORDS[token]
+    return float(token)
+
+
+def _sentiment_scores(words):
+    scores = []
+    for i, word in enumerate(words):
+        score = SENTIMENT_LEXICON.get(word)
+        if score is None:
+            continue
+        if i > 0 and words[i - 1] in _NEGATIONS:
+            # "not good" lands below the middle, "not bad" just above it
+            score = (15 - score) / 2
+        scores.append(score)
+    return scores
+
+
+def _rating_candidates(text):
+    # (span, rating) of every fraction, star count and "give it a 7" phrase
+    candidates = []
+    for match in _FRACTION_RE.finditer(text):
+        value, scale = _to_number(match.group(1)), int(match.group(2))
+        if scale not in _RATING_SCALES or not 0 <= value <= scale:
+            return None
+        candidates.append((match.span(), value / scale * 10))
+    fraction_spans = [span for span, _ in candidates]
+
+    def in_fraction(position):
+        return any(start <= position < end for start, end in fraction_spans)
+
+    stars = []
+    for match in _STARS_RE.finditer(text):
+        if in_fraction(match.start()):
+            # The "5 stars" of "4 out of 5 stars"
+            continue
+        value = _to_number(match.group(1))
+        if not 0 <= value <= 5:
+            return None
+        stars.append((match.span(), value * 2))
+    candidates += stars
+
+    taken = [span for span, _ in candidates]
+    for match in _PHRASE_RE.finditer(text):
+        if any(start <= match.start(1) < end for start, end in taken):
+            # "give it 5 stars" was read as stars already
+            continue
+        value = _to_number(match.group(1))
+        if not 0 <= value <= 10:
+            return None
+        candidates.append((match.span(1), value))
+    return candidates
+
+
+def _parse_numeric_rating(text):
+    match = _BARE_NUMBER_RE.match(text)
+    if match:
+        value = _to_number(match.group(1))
+        return _round_half_up(value) if 0 <= value <= 10 else None
+
+    words = _WORD_RE.findall(text)
+    # "I gave the chef a 10 but the food 4" is for the LLM to untangle
+    if _CONTRAST_WORDS.intersection(words):
+        return None
+    candidates = _rating_candidates(text)
+    if not candidates or len(candidates) > 1:
+        return None
+    (start, end), rating = candidates[0]
+    # Any number outside the rating ("2 of us, 8/10") makes it ambiguous
+    numbers = _DIGITS_RE.findall(text)
+    if len(numbers) != len(_DIGITS_RE.findall(text[start:end])):
+        return None
+    if any(abs(score - rating) > _MAX_SENTIMENT_CONFLICT for score in _sentiment_scores(words)):
+        return None
+    return _round_half_up(rating)
+
+
+def _parse_sentiment_rating(text):
+    words = _WORD_RE.findall(text)
+    if not words or len(words) > _MAX_SENTIMENT_WORDS:
+        return None
+    allowed = SENTIMENT_LEXICON.keys() | _NEGATIONS | _SENTIMENT_FILLER
+    if not allowed.issuperset(words):
+        return None
+    scores = _sentiment_scores(words)
+    # Mixed signals ("good ... awful") are left to the LLM
+    if not scores or max(scores) - min(scores) > 2:
+        return None
+    return _round_half_up(sum(scores) / len(scores))
+
+
+def parse_rating(user_message):
+    """
+    Extract a 0-10 rating from a feedback message without calling the LLM.
+
+    Handles bare numbers ("8"), fractions out of 5, 10 or 100 ("9/10",
+    "4 out of 5"), star counts ("5 stars"), phrases ("I'll give it a 7") and
+    short messages made only of sentiment words ("Loved it!"). Anything
+    ambiguous, such as questions, several numbers, a contrast ("but"),
+    words contradicting the number or words outside the sentiment
+    vocabulary ("I'd like a refund"), is left to the LLM. Halves round up.
+
+    Returns:
+    - The rating as an int, or None when the parser isn't confident.
+    """
+    text = (user_message or "").strip().lower()
+    if not text:
+        return None
+    if "?" in text:
+        return None
+    rating = _parse_numeric_rating(text)
+    if rating is None and not re.search(r"\d", text):
+        rating = _parse_sentiment_rating(text)
+    return rating
+
+
+def fast_path_stats():
+    """
+    Hit/miss counters of the local parser; each hit is one LLM call saved.
+    """
+    with _fast_path_lock:
+        return with_hit_rate(dict(_fast_path_stats))
+
+
+get_metrics().register_collector("fast_path", fast_path_stats)
+
+
+def _fast_path(user_message):
+    rating = parse_rating(user_message)
+    with _fast_path_lock:
+        _fast_path_stats["hits" if rating is not None else "misses"] += 1
+    if rating is None:
+        return None
+    return {
+        "response": get_user_rating(rating),
+        "function_name": "get_user_rating",
+    }
+
+
+def classify_feedback(user_message):
+    # parse_rating first, then the classification cache, and
+    # intention_classification only when both miss
+    response = _fast_path(user_message)
+    if response is not None:
+        return response
+
+    cache = get_classification_cache()
+    response = cache.get(user_message)
+    if response is None:
+        response = intention_classification(user_message)
+        if response is not None:
+            cache.set(user_message, response)
+    return response
+
+
+async def classify_feedback_async(user_message):
+    # classify_feedback for the async webhook. The cache may embed the
+    # message or call a cache server, so it runs in a worker thread rather
+    # than blocking the event loop
+    response = _fast_path(user_message)
+    if response is not None:
+        return response
+
+    cache = get_classification_cache()
+    response = await sync_to_async(cache.get, thread_sensitive=False)(user_message)
+    if response is None:
+        response = await intention_classification_async(user_message)
+        if response is not None:
+            await sync_to_async(cache.set, thread_sensitive=False)(user_message, response)
+    return response
@@ -0,0 +1,62 @@
+# Twilio rejects WhatsApp message bodies longer than this
+WHATSAPP_MAX_BODY = 1600
+
+
+class MessageBuilder:
+    """
+    Collects message blocks in a list and packs them into chunks of at most
+    `limit` characters, joining each chunk once instead of growing a string
+    with repeated concatenation.
+
+    A block is kept whole when it fits in a chunk, so a rating or an order
+    line is never split across two messages; only a block longer than the
+    limit on its own is cut.
+    """
+
+    def __init__(self, limit=WHATSAPP_MAX_BODY):
+        self.limit = limit
+        self._chunks = []
+        self._parts = []
+        self._size = 0
+
+    def add(self, block):
+        if self._size + len(block) > self.limit:
+            self._flush()
+        while len(block) > self.limit:
+            self._chunks.append(block[: self.limit])
+            block = block[self.limit:]
+        self._parts.append(block)
+        self._size += len(block)
+        return self
+
+    def _flush(self):
+        if self._parts:
+            self._chunks.append("".join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def chunks(self):
+        self._flush()
+        return [chunk for chunk in self._chunks if chunk.strip()]
+
+    def build(self):
+        # Everything as one string, for callers that don't need chunks
+        return "".join(self.chunks())
+
+
+def split_message(body, limit=WHATSAPP_MAX_BODY):
+    """
+    Split a reply into messages of at most `limit` characters, breaking
+    between lines where possible.
+
+    Returns:
+    - List of message bodies; empty for an empty body.
+    """
+    if not body:
+        return []
+    if len(body) <= limit:
+        return [body]
+    builder = MessageBuilder(limit)
+    for line in body.splitlines(keepends=True):
+        builder.add(line)
+    return builder.chunks()
@@ -0,0 +1,290 @@
+import bisect
+import contextvars
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+
+# Histogram bucket upper bounds; durations are in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 50, 100)
+BUCKETS = {"bot_request_db_queries": QUERY_BUCKETS}
+
+HELP = {
+    "bot_stage_duration_seconds": "Time spent in each stage of handling a webhook.",
+    "bot_request_duration_seconds": "Time to answer an HTTP request, by view.",
+    "bot_request_db_queries": "Database queries run per HTTP request, by view.",
+    "bot_request_db_seconds": "Time spent in database queries per HTTP request, by view.",
+    "bot_external_call_duration_seconds": "Latency of calls to Twilio and OpenAI.",
+    "bot_external_call_errors_total": "Calls to Twilio and OpenAI that raised.",
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _metric_name(*parts):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(str(part) for part in parts))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    return None
+
+
+class Histogram:
+    # Cumulative bucket counts are computed when rendering; observe() only
+    # increments the first bucket the value fits in
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms, rendered in the Prometheus text
+    exposition format.
+
+    Other modules register collectors, callables returning the stats dicts
+    they already keep (e.g. CommandRegistry.stats), which are exported as
+    gauges when the metrics are scraped.
+
+    Usage:
+        metrics = get_metrics()
+        with metrics.span("upsert_user"):
+            ...
+        with metrics.external_call("twilio", "send"):
+            ...
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def span(self, stage):
+        # Times one stage of handling a webhook
+        return self.timer("bot_stage_duration_seconds", stage=stage)
+
+    @contextmanager
+    def external_call(self, service, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as exc:
+            self.inc("bot_external_call_errors_total", service=service, operation=operation, error=type(exc).__name__)
+            raise
+        finally:
+            self.observe(
+                "bot_external_call_duration_seconds", time.perf_counter() - start,
+                service=service, operation=operation,
+            )
+
+    def register_collector(self, name, collect, label=None):
+        """
+        Export the dict returned by `collect()` as gauges named bot_<name>_<key>.
+
+        Values that are dicts themselves are exported per outer key under
+        the label `label`, e.g. {"/new": {"p50_ms": 3.1}} with label
+        "command" becomes bot_<name>_p50_ms{command="/new"}. Values that
+        aren't numbers are skipped.
+        """
+        with self._lock:
+            self._collectors[name] = (collect, label)
+
+    def _collected(self):
+        gauges = {}
+        with self._lock:
+            collectors = list(self._collectors.items())
+        for name, (collect, label) in collectors:
+            try:
+                stats = collect() or {}
+            except Exception:
+                gauges.setdefault(_metric_name("bot", name, "collect_errors"), []).append(((), 1))
+                continue
+            for key, value in stats.items():
+                if isinstance(value, dict):
+                    for inner_key, inner_value in value.items():
+                        inner_value = _number(inner_value)
+                        if inner_value is not None:
+                            gauges.setdefault(_metric_name("bot", name, inner_key), []).append(
+                                (((label or "key", key),), inner_value)
+                            )
+                else:
+                    value = _number(value)
+                    if value is not None:
+                        gauges.setdefault(_metric_name("bot", name, key), []).append(((), value))
+        return gauges
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count, h.buckets)) for key, h in self._histograms.items()
+            )
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for name, samples in sorted(self._collected().items()):
+            declare(name, "gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics:
+    # Same interface as MetricsRegistry doing nothing, for METRICS_ENABLED=false
+    enabled = False
+    _context = nullcontext()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self._context
+
+    def span(self, stage):
+        return self._context
+
+    def external_call(self, service, operation):
+        return self._context
+
+    def register_collector(self, name, collect, label=None):
+        pass
+
+    def render(self):
+        return ""
+
+
+class QueryTimer:
+    # Number and total duration of the database queries of one request
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# The QueryTimer of the request being handled. Thread pools running ORM
+# code for an async view see it through a copied context.
+_query_timer = contextvars.ContextVar("query_timer", default=None)
+
+
+@contextmanager
+def time_queries():
+    """
+    Count the queries run in this context, on any thread it is copied to.
+
+    Unlike QueryCounter no SQL is kept, so it is cheap enough to run on
+    every request.
+    """
+    timer = QueryTimer()
+    token = _query_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _query_timer.reset(token)
+
+
+def _timed_execute(execute, sql, params, many, context):
+    timer = _query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.count += 1
+        timer.seconds += time.perf_counter() - start
+
+
+def install_query_timer(sender=None, connection=None, **kwargs):
+    # connection_created receiver adding _timed_execute to every new
+    # connection (each thread has its own)
+    if connection is not None and _timed_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_timed_execute)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Return the process-wide metrics registry, or a NullMetrics when
+    settings.METRICS_ENABLED is off so instrumented code costs next to nothing.
+    """
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = MetricsRegistry() if settings.METRICS_ENABLED else NullMetrics()
+    return _metrics
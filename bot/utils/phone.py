@@ -0,0 +1,27 @@
+import re
+
+_SEPARATORS_RE = re.compile(r"[\s\-().]")
+_E164_RE = re.compile(r"^\+[1-9]\d{6,14}$")
+
+
+def normalize_whatsapp_number(value):
+    """
+    Canonicalise a Twilio WhatsApp address to E.164.
+
+    'whatsapp:+1 (415) 523-8886', 'whatsapp:0014155238886' and
+    '+14155238886' all become '+14155238886'.
+
+    Raises:
+    - ValueError if the value isn't a plausible international number.
+    """
+    number = (value or "").strip()
+    if number.lower().startswith("whatsapp:"):
+        number = number[len("whatsapp:"):]
+    number = _SEPARATORS_RE.sub("", number)
+    if number.startswith("00"):
+        number = "+" + number[2:]
+    elif not number.startswith("+"):
+        number = "+" + number
+    if not _E164_RE.match(number):
+        raise ValueError(f"Invalid WhatsApp number: {value!r}")
+    return number
@@ -0,0 +1,54 @@
+import time
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class QueryCounter:
+    """
+    Context manager recording every query run on a database connection.
+
+    Usage:
+        with QueryCounter() as counter:
+            view.gather_order_details(order)
+        counter.count, counter.duration, counter.queries
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.queries = []
+        self.duration = 0.0
+        self._wrapper = None
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.duration += elapsed
+            self.queries.append((sql, elapsed))
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._wrapper.__exit__(exc_type, exc, tb)
+
+
+@contextmanager
+def assert_max_queries(limit, using=DEFAULT_DB_ALIAS):
+    """
+    Fail with AssertionError if the block runs more than `limit` queries.
+    """
+    with QueryCounter(using) as counter:
+        yield counter
+    if counter.count > limit:
+        statements = "\n".join(f"  {sql}" for sql, _ in counter.queries)
+        raise AssertionError(f"{counter.count} queries executed, {limit} allowed:\n{statements}")
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; each
+    allowed action consumes one token.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def consume(self, tokens=1):
+        """
+        Take `tokens` from the bucket if available.
+
+        Returns:
+        - True if the action is allowed, False if it should be throttled.
+        """
+        with self._lock:
+            self._refill(self.clock())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        # Seconds until `tokens` will be available
+        with self._lock:
+            self._refill(self.clock())
+            missing = tokens - self.tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate if self.rate > 0 else float("inf")
+
+
+class TokenBucketRegistry:
+    # Lazily created buckets keyed by an arbitrary identifier (sender number,
+    # client IP, ...), all sharing the same rate and capacity. With
+    # `max_keys` set, the least recently used bucket is dropped beyond that
+    # many keys, so a flood of distinct keys can't grow memory unbounded.
+
+    def __init__(self, rate, capacity=None, max_keys=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                if self.max_keys is not None and len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            elif self.max_keys is not None:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def consume(self, key, tokens=1):
+        return self.get(key).consume(tokens)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class CacheRateLimiter:
+    """
+    Rate limiter shared by every worker through a Django cache alias.
+
+    Cache backends have no atomic token bucket, so this counts requests in
+    fixed windows with cache.incr, allowing `capacity` per window of
+    capacity / rate seconds: the same average rate and burst size as a
+    TokenBucket, with the burst allowed once per window. Same consume()
+    interface as TokenBucketRegistry.
+    """
+
+    def __init__(self, prefix, rate, capacity=None, alias="default", clock=time.time):
+        self.prefix = prefix
+        self.rate = float(rate)
+        self.capacity = int(capacity if capacity is not None else max(rate, 1))
+        self.window = self.capacity / self.rate
+        self.timeout = int(self.window) + 1
+        self.alias = alias
+        self.clock = clock
+
+    def consume(self, key, tokens=1):
+        cache = caches[self.alias]
+        cache_key = f"{self.prefix}:{key}:{int(self.clock() / self.window)}"
+        # add() is a no-op if another worker created the counter first
+        cache.add(cache_key, 0, timeout=self.timeout)
+        try:
+            count = cache.incr(cache_key, tokens)
+        except ValueError:
+            # Expired between add() and incr(); count from scratch
+            cache.set(cache_key, tokens, timeout=self.timeout)
+            count = tokens
+        return count <= self.capacity
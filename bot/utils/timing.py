@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of a list of numbers (pct from 0 to 100).
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    # Latency summary in milliseconds of a list of durations in seconds
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+class LatencyTimer:
+    """
+    Thread-safe recorder of the most recent `window` durations.
+
+    Usage:
+        with timer.time():
+            ...
+    """
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start)
+
+    def summary(self):
+        # summarize() over the window, with "count" being the all-time total
+        with self._lock:
+            samples = list(self._samples)
+            count = self._count
+        return dict(summarize(samples), count=count)
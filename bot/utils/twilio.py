@@ -1,15 +1,113 @@
+import asyncio
+import threading
+import time
+import weakref
+
 from django.conf import settings
+from requests.adapters import HTTPAdapter
 
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
+from twilio.twiml.messaging_response import MessagingResponse
+
+from bot.utils.messages import split_message
+from bot.utils.metrics import get_metrics
+
+# Process-wide Twilio clients keyed by (account_sid, auth_token). Each client
+# owns a requests.Session, so connections to api.twilio.com are kept alive and
+# reused across messages and threads instead of opening a new TLS connection
+# per send.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _build_http_client():
+    http_client = TwilioHttpClient(
+        pool_connections=True,
+        timeout=settings.TWILIO_TIMEOUT,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.TWILIO_POOL_SIZE,
+        pool_maxsize=settings.TWILIO_POOL_SIZE,
+        max_retries=settings.TWILIO_MAX_RETRIES,
+    )
+    http_client.session.mount("https://", adapter)
+    return http_client
+
+
+def get_twilio_client(account_sid=None, auth_token=None):
+    """
+    Return the shared Twilio client for the given credentials, creating it on first use.
+
+    Args:
+    - account_sid: Twilio account SID, defaults to settings.TWILIO_ACCOUNT_SID.
+    - auth_token: Twilio auth token, defaults to settings.TWILIO_TOKEN.
+
+    Returns:
+    - twilio.rest.Client backed by a pooled keep-alive HTTP session.
+    """
+    key = (account_sid or settings.TWILIO_ACCOUNT_SID, auth_token or settings.TWILIO_TOKEN)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = Client(key[0], key[1], http_client=_build_http_client())
+                _clients[key] = client
+    return client
+
+
+def reset_twilio_clients():
+    # Drop the cached clients and close their sessions, e.g. after the
+    # credentials or pool settings change.
+    with _clients_lock:
+        for client in _clients.values():
+            client.http_client.session.close()
+        _clients.clear()
+
+
+# aiohttp sessions belong to the event loop that created them, so async
+# clients are kept per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_twilio_client():
+    """
+    Return the Twilio client for the running event loop, backed by a pooled
+    aiohttp session.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        http_client = AsyncTwilioHttpClient(
+            timeout=settings.TWILIO_TIMEOUT,
+            max_retries=settings.TWILIO_MAX_RETRIES or None,
+        )
+        client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_TOKEN, http_client=http_client)
+        _async_clients[loop] = client
+    return client
 
 
 def send_whatsapp_message(send_from, send_to, body):
     # send_from and send_to are WhatsApp numbers, in the format 'whatsapp:+14155238886'
     # body is the message to be sent
+    with get_metrics().external_call("twilio", "send"):
+        return get_transport().send(send_from, send_to, body)
+
 
-    account_sid = settings.TWILIO_ACCOUNT_SID
-    auth_token = settings.TWILIO_TOKEN
-    client = Client(account_sid, auth_token)
+async def send_whatsapp_message_async(send_from, send_to, body):
+    # send_whatsapp_message for async views
+    transport = get_transport()
+    with get_metrics().external_call("twilio", "send"):
+        if isinstance(transport, RestTransport):
+            client = get_async_twilio_client()
+            return await client.messages.create_async(from_=send_from, body=body, to=send_to)
+        return await transport.asend(send_from, send_to, body)
+
+
+def _send_rest(send_from, send_to, body):
+    client = get_twilio_client()
 
     message = client.messages.create(
         from_=send_from,
@@ -17,3 +115,77 @@ def send_whatsapp_message(send_from, send_to, body):
         to=send_to
     )
     return message
+
+
+class RestTransport:
+    # Delivers messages through the Twilio REST API
+    def send(self, send_from, send_to, body):
+        return _send_rest(send_from, send_to, body)
+
+
+class FakeTwilioTransport:
+    """
+    In-memory stand-in for the Twilio REST API.
+
+    Sent messages are recorded in `sent` instead of leaving the process.
+    `fail_times` makes the next N sends raise, to exercise retry paths, and
+    `latency` (seconds) simulates the API round trip.
+    """
+
+    def __init__(self, fail_times=0, error=None, latency=0):
+        self.sent = []
+        self.fail_times = fail_times
+        self.error = error or RuntimeError("fake Twilio failure")
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def send(self, send_from, send_to, body):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._record(send_from, send_to, body)
+
+    async def asend(self, send_from, send_to, body):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._record(send_from, send_to, body)
+
+    def _record(self, send_from, send_to, body):
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise self.error
+            message = {"sid": f"SMfake{len(self.sent)}", "from_": send_from, "to": send_to, "body": body}
+            self.sent.append(message)
+            return message
+
+
+_transport_classes = {
+    "rest": RestTransport,
+    "fake": FakeTwilioTransport,
+}
+_transports = {}
+
+
+def get_transport(name=None):
+    """
+    Return the shared outbound transport named by settings.TWILIO_TRANSPORT
+    ("rest" or "fake"), so everything a fake transport sends can be inspected
+    in one place.
+    """
+    name = name or settings.TWILIO_TRANSPORT
+    transport = _transports.get(name)
+    if transport is None:
+        with _clients_lock:
+            transport = _transports.setdefault(name, _transport_classes[name]())
+    return transport
+
+
+def build_twiml_reply(body=None):
+    # Render a TwiML document that makes Twilio deliver body as the reply to
+    # the inbound message, as several <Message> elements if it is longer
+    # than one WhatsApp message. An empty <Response/> acknowledges without
+    # replying.
+    response = MessagingResponse()
+    for chunk in split_message(body):
+        response.message(chunk)
+    return str(response)
@@ -22,6 +22,74 @@ ENV=os.getenv("ENV")
 PORT=os.getenv("PORT")
 HOST=os.getenv("HOST")
 OPENAI_API_KEY=os.getenv("OPENAI_API_KEY")
+OPENAI_TIMEOUT=float(os.getenv("OPENAI_TIMEOUT", "15"))
+# Callable used to classify free-text feedback; classify_feedback tries the
+# local rating parser before OpenAI. Point it at
+# bot.utils.gpt4.stub_intention_classification to run without OpenAI
+INTENTION_CLASSIFIER=os.getenv("INTENTION_CLASSIFIER", "bot.utils.gpt4.classify_feedback")
+# Free-text feedback is classified in a background thread pool ("thread"),
+# or in the request thread ("inline")
+FEEDBACK_PIPELINE_MODE=os.getenv("FEEDBACK_PIPELINE_MODE", "thread")
+FEEDBACK_WORKERS=int(os.getenv("FEEDBACK_WORKERS", "4"))
+FEEDBACK_MAX_PENDING=int(os.getenv("FEEDBACK_MAX_PENDING", "100"))
+FEEDBACK_MAX_ATTEMPTS=int(os.getenv("FEEDBACK_MAX_ATTEMPTS", "3"))
+FEEDBACK_RETRY_BACKOFF=float(os.getenv("FEEDBACK_RETRY_BACKOFF", "1"))  # seconds, doubled per attempt
+# Threads running ORM work for the async (ASGI) webhook
+ASYNC_DB_WORKERS=int(os.getenv("ASYNC_DB_WORKERS", "16"))
+# Cache of LLM classification results keyed on the normalized message:
+# "lru" (per process), "django" (shared through CACHES) or "none"
+CLASSIFICATION_CACHE_BACKEND=os.getenv("CLASSIFICATION_CACHE_BACKEND", "lru")
+CLASSIFICATION_CACHE_SIZE=int(os.getenv("CLASSIFICATION_CACHE_SIZE", "10000"))
+CLASSIFICATION_CACHE_TTL=int(os.getenv("CLASSIFICATION_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+# Path to a local sentence-transformers model enables the similarity tier
+CLASSIFICATION_CACHE_EMBEDDING_MODEL=os.getenv("CLASSIFICATION_CACHE_EMBEDDING_MODEL")
+CLASSIFICATION_CACHE_SIMILARITY=float(os.getenv("CLASSIFICATION_CACHE_SIMILARITY", "0.92"))
+# Per-number conversation state (user id, latest order, pending feedback).
+# In production CACHE_BACKEND points at Redis or Memcached and the state is
+# kept there ("django"), so order and rating writes are seen by every
+# worker. Without a shared cache it falls back to a per-process "lru" with
+# a TTL of seconds, so a worker that missed another's write is only briefly
+# stale.
+_SHARED_CACHE=os.getenv("CACHE_BACKEND", "").rsplit(".", 1)[-1] not in ("", "LocMemCache", "DummyCache")
+CONVERSATION_CACHE_BACKEND=os.getenv("CONVERSATION_CACHE_BACKEND", "django" if _SHARED_CACHE else "lru")
+CONVERSATION_CACHE_SIZE=int(os.getenv("CONVERSATION_CACHE_SIZE", "50000"))
+CONVERSATION_CACHE_TTL=int(  # seconds
+    os.getenv("CONVERSATION_CACHE_TTL", "1800" if CONVERSATION_CACHE_BACKEND == "django" else "10")
+)
+# Webhook dedupe on MessageSid: handled messages are remembered for
+# IDEMPOTENCY_TTL seconds (the most recent ones also in process); a retry
+# arriving while the first delivery is still running waits up to
+# IDEMPOTENCY_WAIT_SECONDS for its reply, and a claim older than
+# IDEMPOTENCY_LEASE_SECONDS is assumed abandoned
+IDEMPOTENCY_TTL=int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_WAIT_SECONDS=float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "5"))
+IDEMPOTENCY_LEASE_SECONDS=int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "60"))
+# How often the cached list of dish ids used for random orders is reloaded
+DISH_SAMPLER_REFRESH_SECONDS=int(os.getenv("DISH_SAMPLER_REFRESH_SECONDS", "300"))
+# How often each worker's in-memory dish catalog checks the dishes table for
+# changes, in a background thread (0 disables the thread)
+DISH_CATALOG_REFRESH_SECONDS=int(os.getenv("DISH_CATALOG_REFRESH_SECONDS", "60"))
+# Ratings shown per /ratings or /more reply
+RATINGS_PAGE_SIZE=int(os.getenv("RATINGS_PAGE_SIZE", "10"))
+# Recommendation index written by `manage.py build_recommendations` and
+# served by /recommend; workers check the file for a new build this often
+RECOMMENDATIONS_PATH=os.getenv("RECOMMENDATIONS_PATH", str(BASE_DIR / "recommendations.npz"))
+RECOMMENDATIONS_TOP_N=int(os.getenv("RECOMMENDATIONS_TOP_N", "20"))
+# Bytes of dense scores a build may hold at once; users are scored in blocks
+# sized to fit
+RECOMMENDATIONS_MEMORY_BUDGET=int(os.getenv("RECOMMENDATIONS_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+# How often each worker's background thread checks for a new index build
+# (0 disables the thread)
+RECOMMENDATIONS_REFRESH_SECONDS=int(os.getenv("RECOMMENDATIONS_REFRESH_SECONDS", "60"))
+# Dish similarity index written by `manage.py build_dish_index`: hashed
+# TF-IDF vectors of DISH_INDEX_DIM floats, bucketed into DISH_INDEX_TABLES
+# LSH tables of DISH_INDEX_BITS bits each
+DISH_INDEX_PATH=os.getenv("DISH_INDEX_PATH", str(BASE_DIR / "dish_index"))
+DISH_INDEX_DIM=int(os.getenv("DISH_INDEX_DIM", "512"))
+DISH_INDEX_TABLES=int(os.getenv("DISH_INDEX_TABLES", "16"))
+DISH_INDEX_BITS=int(os.getenv("DISH_INDEX_BITS", "8"))
+DISH_INDEX_REFRESH_SECONDS=int(os.getenv("DISH_INDEX_REFRESH_SECONDS", "60"))
 DS_ENGINE=os.getenv("DS_ENGINE")
 DS_NAME=os.getenv("DS_NAME")
 DS_USER=os.getenv("DS_USER")
@@ -32,6 +100,49 @@ DS_SCHEMA=os.getenv("DS_SCHEMA")
 TWILIO_ACCOUNT_SID=os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_TOKEN=os.getenv("TWILIO_TOKEN")
 TWILIO_NUMBER=os.getenv("TWILIO_NUMBER")
+# Webhook protection (bot.middleware): Twilio requests must carry a valid
+# X-Twilio-Signature, checked against TWILIO_WEBHOOK_URL when set (the
+# public base URL Twilio calls, needed behind a TLS-terminating proxy)
+TWILIO_VALIDATE_SIGNATURE=os.getenv("TWILIO_VALIDATE_SIGNATURE", "true").lower() == "true"
+TWILIO_WEBHOOK_URL=os.getenv("TWILIO_WEBHOOK_URL")
+WEBHOOK_PATHS=["/api/bot/whatsapp/message", "/api/bot/whatsapp/message/async"]
+# Webhook rate limits in requests per second (0 disables) with burst sizes,
+# both off by default. The IP limit counts only requests failing signature
+# validation (all requests when validation is off): behind a load balancer,
+# or from Twilio's shared addresses, genuine traffic shares a few IPs. The
+# number limit answers throttled messages asking the user to resend them.
+# "memory" keeps up to WEBHOOK_RATE_LIMIT_KEYS buckets per process,
+# "django" shares counters through CACHES
+WEBHOOK_RATE_LIMIT_BACKEND=os.getenv("WEBHOOK_RATE_LIMIT_BACKEND", "memory")
+WEBHOOK_RATE_LIMIT_KEYS=int(os.getenv("WEBHOOK_RATE_LIMIT_KEYS", "100000"))
+WEBHOOK_RATE_PER_IP=float(os.getenv("WEBHOOK_RATE_PER_IP", "0"))
+WEBHOOK_BURST_PER_IP=int(os.getenv("WEBHOOK_BURST_PER_IP", "100"))
+WEBHOOK_RATE_PER_NUMBER=float(os.getenv("WEBHOOK_RATE_PER_NUMBER", "0"))
+WEBHOOK_BURST_PER_NUMBER=int(os.getenv("WEBHOOK_BURST_PER_NUMBER", "20"))
+WEBHOOK_TRUST_FORWARDED_FOR=os.getenv("WEBHOOK_TRUST_FORWARDED_FOR", "false").lower() == "true"
+# "twiml" answers the webhook inline with a TwiML body, "rest" sends the reply
+# through a separate Twilio REST API call, "queue" hands it to the outbound
+# message queue
+TWILIO_REPLY_MODE=os.getenv("TWILIO_REPLY_MODE", "twiml")
+# Shared HTTP connection pool used by the Twilio REST client
+TWILIO_POOL_SIZE=int(os.getenv("TWILIO_POOL_SIZE", "10"))
+TWILIO_TIMEOUT=float(os.getenv("TWILIO_TIMEOUT", "10"))
+TWILIO_MAX_RETRIES=int(os.getenv("TWILIO_MAX_RETRIES", "2"))
+# "rest" talks to Twilio, "fake" records messages in memory (offline runs)
+TWILIO_TRANSPORT=os.getenv("TWILIO_TRANSPORT", "rest")
+# Outbound message queue drained by `manage.py run_outbound_sender`
+OUTBOUND_QUEUE_BACKEND=os.getenv("OUTBOUND_QUEUE_BACKEND", "sqlite")  # "sqlite" or "memory"
+OUTBOUND_QUEUE_PATH=os.getenv("OUTBOUND_QUEUE_PATH", str(BASE_DIR / "outbound_queue.sqlite3"))
+OUTBOUND_SENDER_CONCURRENCY=int(os.getenv("OUTBOUND_SENDER_CONCURRENCY", "8"))
+OUTBOUND_RATE_PER_SENDER=float(os.getenv("OUTBOUND_RATE_PER_SENDER", "10"))  # messages per second
+OUTBOUND_MAX_ATTEMPTS=int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+OUTBOUND_RETRY_BACKOFF=float(os.getenv("OUTBOUND_RETRY_BACKOFF", "2"))  # seconds, doubled per attempt
+# Stage timings, query counts and Twilio/OpenAI latencies served at
+# /api/bot/metrics in the Prometheus text format; when disabled the
+# instrumentation is a no-op. Scrapers must send "Authorization: Bearer
+# <METRICS_TOKEN>"; without a token set the endpoint answers 403.
+METRICS_ENABLED=os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN=os.getenv("METRICS_TOKEN", "")
 
 
 
@@ -61,7 +172,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "bot.middleware.request_metrics_middleware",
     "django.middleware.security.SecurityMiddleware",
+    "bot.middleware.twilio_webhook_middleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -94,8 +207,24 @@ WSGI_APPLICATION = "providoor_bot.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# The bot's transactional tables live in a low-latency OLTP database
+# ("default", SQLite unless OLTP_ENGINE says otherwise). Snowflake is kept as
+# the "snowflake" alias for analytics and is fed by `manage.py sync_to_snowflake`.
 DATABASES = {
     'default': {
+        'ENGINE': os.getenv("OLTP_ENGINE", "django.db.backends.sqlite3"),
+        'NAME': os.getenv("OLTP_NAME", str(BASE_DIR / "db.sqlite3")),
+        'USER': os.getenv("OLTP_USER", ""),
+        'PASSWORD': os.getenv("OLTP_PASSWORD", ""),
+        'HOST': os.getenv("OLTP_HOST", ""),
+        'PORT': os.getenv("OLTP_PORT", ""),
+        'CONN_MAX_AGE': int(os.getenv("OLTP_CONN_MAX_AGE", "60")),
+    }
+}
+
+SNOWFLAKE_DB_ALIAS = "snowflake"
+if DS_ENGINE:
+    DATABASES[SNOWFLAKE_DB_ALIAS] = {
         'ENGINE': os.getenv("DS_ENGINE"),
         'NAME': os.getenv("DS_NAME"),
         'USER': os.getenv("DS_USER"),
@@ -104,6 +233,41 @@ DATABASES = {
         'WAREHOUSE': os.getenv("DS_WAREHOUSE"),
         'SCHEMA': os.getenv("DS_SCHEMA")
     }
+
+DATABASE_ROUTERS = ["bot.db_router.BotRouter"]
+
+# Rows per INSERT when copying OLTP rows to Snowflake
+SNOWFLAKE_SYNC_BATCH_SIZE=int(os.getenv("SNOWFLAKE_SYNC_BATCH_SIZE", "5000"))
+# How far below its id cursor each sync re-reads, for rows whose transaction
+# committed after a higher id was copied; cover the ids allocated while the
+# longest write transaction is open
+SNOWFLAKE_SYNC_RESCAN_IDS=int(os.getenv("SNOWFLAKE_SYNC_RESCAN_IDS", "1000"))
+# How far before the newest updated_at already copied each sync re-reads
+# changed rows, for changes committed after a later one was copied
+SNOWFLAKE_SYNC_LAG_SECONDS=int(os.getenv("SNOWFLAKE_SYNC_LAG_SECONDS", "300"))
+# How batches are loaded: "insert" (multi-row INSERT), "stage" (PUT + COPY INTO)
+# or "memory" (kept in process, for tests)
+SNOWFLAKE_LOAD_BACKEND=os.getenv("SNOWFLAKE_LOAD_BACKEND", "insert")
+# Write-behind: orders and ratings are buffered in process and loaded into
+# Snowflake in batches as they are written; the sync job still pushes them
+# as a backstop for rows lost with the process
+SNOWFLAKE_WRITE_BEHIND=os.getenv("SNOWFLAKE_WRITE_BEHIND", "false").lower() == "true"
+SNOWFLAKE_BATCH_MAX_ROWS=int(os.getenv("SNOWFLAKE_BATCH_MAX_ROWS", "500"))
+SNOWFLAKE_BATCH_MAX_AGE=float(os.getenv("SNOWFLAKE_BATCH_MAX_AGE", "5"))  # seconds
+# Batches' worth of rows kept per table while Snowflake is failing; older
+# rows are dropped and left to the sync job
+SNOWFLAKE_BATCH_MAX_PENDING_BATCHES=int(os.getenv("SNOWFLAKE_BATCH_MAX_PENDING_BATCHES", "10"))
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Point CACHE_BACKEND/CACHE_LOCATION at Redis or Memcached to share cached
+# data between workers
+
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
+    }
 }
 
 # Password validation